@@ -0,0 +1,237 @@
+"""
+Microbenchmarks for the hot paths of a sync: evaluating properties, building and encoding
+payloads and the bookkeeping `HubSpot.request` does around each HTTP call. Nothing touches
+the network; users are synthetic object graphs and the HTTP session is a stub.
+
+    python benchmarks/bench_hubbypy.py --depth 3 --properties 40 --output bench.json
+
+Each benchmark reports the best and median time per call, in microseconds, over
+`--repeat` runs. The JSON output also records the parameters and the Python version so
+that results from different versions can be compared.
+"""
+import argparse
+import functools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import timeit
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hubbypy.contact_properties import (  # noqa: E402
+    AccessorProperty,
+    ConstantProperty,
+    FunctionProperty,
+    UserPropertyManager,
+    rgetattr
+)
+from hubbypy.hub_api import HubSpot  # noqa: E402
+from hubbypy.json_codec import JSONCodec, OrjsonCodec, UjsonCodec, orjson, ujson  # noqa: E402
+from hubbypy.rate_limit import SQLiteTokenBucket, TokenBucket  # noqa: E402
+
+NATIVE_TYPES = ['varchar', 'number', 'bool', 'date', 'datetime']
+
+
+class Node:
+    """
+    One level of a synthetic user graph. Every level has the same `field_<n>` attributes
+    and a `child` pointing at the next level down.
+    """
+
+    def __init__(self, index, depth, fields):
+        for field in range(fields):
+            native_type = NATIVE_TYPES[field % len(NATIVE_TYPES)]
+            setattr(self, 'field_%s' % field, sample_value(native_type, index + field))
+        self.child = Node(index, depth - 1, fields) if depth > 1 else None
+
+
+def sample_value(native_type, seed):
+    if native_type == 'varchar':
+        return 'value %s' % seed
+    if native_type == 'number':
+        return seed
+    if native_type == 'bool':
+        return bool(seed % 2)
+    if native_type == 'date':
+        return date(2018, 1, 1) + timedelta(days=seed % 365)
+    return datetime(2018, 1, 1) + timedelta(seconds=seed * 7919)
+
+
+def make_users(count, depth, fields):
+    users = []
+    for index in range(count):
+        user = Node(index, depth, fields)
+        user.email = 'user%s@example.com' % index
+        users.append(user)
+    return users
+
+
+def accessor_path(depth, field):
+    return '.'.join(['child'] * (depth - 1) + ['field_%s' % field])
+
+
+def make_manager(depth, properties):
+    """
+    A manager with `properties` accessor properties spread across every level of the
+    graph, plus one function and one constant property.
+    """
+    manager = UserPropertyManager(groups=[{'name': 'bench', 'displayName': 'Bench'}])
+    manager.add_prop(AccessorProperty(name='email', native_type='varchar', accessor='email',
+                                      built_in=True))
+    for index in range(properties):
+        level = index % depth + 1
+        native_type = NATIVE_TYPES[index % len(NATIVE_TYPES)]
+        manager.add_prop(AccessorProperty(
+            name='bench_%s' % index,
+            label='Bench %s' % index,
+            group_name='bench',
+            native_type=native_type,
+            accessor=accessor_path(level, index),
+        ))
+    manager.add_prop(FunctionProperty(name='bench_synced', label='Synced', group_name='bench',
+                                      native_type='datetime', func=datetime.now))
+    manager.add_prop(ConstantProperty(name='bench_constant', label='Constant',
+                                      group_name='bench', native_type='varchar',
+                                      value='constant'))
+    return manager
+
+
+class StubResponse:
+    status_code = 200
+    headers = {
+        'X-HubSpot-RateLimit-Interval-Milliseconds': '10000',
+        'X-HubSpot-RateLimit-Max': '100000000',
+        'X-HubSpot-RateLimit-Remaining': '99999999',
+        'X-HubSpot-RateLimit-Daily-Remaining': '99999999',
+    }
+
+    def json(self):
+        return {}
+
+
+class StubSession:
+
+    def __init__(self):
+        self.response = StubResponse()
+
+    def request(self, method, url, **kwargs):
+        return self.response
+
+    def close(self):
+        pass
+
+
+def available_codecs():
+    codecs = [JSONCodec()]
+    if orjson is not None:
+        codecs.append(OrjsonCodec())
+    if ujson is not None:
+        codecs.append(UjsonCodec())
+    return codecs
+
+
+def make_hubspot(manager, rate_limiter):
+    hubspot = HubSpot(api_key='benchmark', user_property_manager=manager,
+                      rate_limiter=rate_limiter)
+    hubspot._session = StubSession()
+    return hubspot
+
+
+def measure(func, repeat, calls_per_run=1):
+    """
+    Time `func`, running it enough times per run to make each run last at least 0.2s.
+    Returns the best and median time per call in microseconds.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = timer.repeat(repeat=repeat, number=number)
+    per_call = [t / number / calls_per_run * 1e6 for t in times]
+    return {
+        'best_us': round(min(per_call), 3),
+        'median_us': round(statistics.median(per_call), 3),
+        'loops': number,
+    }
+
+
+def run(*, depth=3, properties=40, users=200, repeat=5):
+    user_list = make_users(users, depth, properties)
+    user = user_list[0]
+    manager = make_manager(depth, properties)
+    prop = manager._user_properties[-3]
+    deepest = accessor_path(depth, properties - 1)
+    hubspot = make_hubspot(manager, TokenBucket(max_calls=100000000, period=10))
+
+    benchmarks = {
+        'rgetattr': (lambda: rgetattr(user, deepest), 1),
+        'get_formatted_value': (lambda: prop.get_formatted_value(user), 1),
+        'get_dict': (lambda: [p.get_dict() for p in manager.custom_user_properties],
+                     len(manager.custom_user_properties)),
+        'generate_sync_data': (lambda: manager.generate_sync_data(user), 1),
+        'generate_sync_data_per_user': (
+            lambda: [manager.generate_sync_data(u, run={}) for u in user_list], users),
+        'generate_bulk_sync_data_per_user': (
+            lambda: manager.generate_bulk_sync_data(user_list, run={}), users),
+        'token_bucket_reserve': (hubspot.rate_limiter.reserve, 1),
+        'request_overhead': (lambda: hubspot.request('get', 'http://localhost/'), 1),
+    }
+
+    # encoding and parsing a batch worth of payloads, per contact, with each codec installed
+    payload = manager.generate_bulk_sync_data(user_list, run={})
+    for codec in available_codecs():
+        encoded = codec.dumps(payload)
+        benchmarks['encode_%s' % codec.name] = (functools.partial(codec.dumps, payload), users)
+        benchmarks['decode_%s' % codec.name] = (functools.partial(codec.loads, encoded), users)
+
+    results = {}
+    for name, (func, calls) in benchmarks.items():
+        results[name] = measure(func, repeat, calls)
+
+    with tempfile.TemporaryDirectory() as directory:
+        limiter = SQLiteTokenBucket(path=os.path.join(directory, 'bench.sqlite3'),
+                                    max_calls=100000000, period=10)
+        results['sqlite_token_bucket_reserve'] = measure(limiter.reserve, repeat)
+        limiter.close()
+
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'parameters': {
+            'depth': depth,
+            'properties': properties,
+            'users': users,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--depth', type=int, default=3,
+                        help='levels of nested objects in each synthetic user')
+    parser.add_argument('--properties', type=int, default=40,
+                        help='number of accessor properties on the manager')
+    parser.add_argument('--users', type=int, default=200,
+                        help='number of users for the per-user payload benchmarks')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of timed runs of each benchmark')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args(argv)
+
+    report = run(depth=args.depth, properties=args.properties, users=args.users,
+                 repeat=args.repeat)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,483 @@
+"""
+A local stand-in for the parts of the HubSpot API that `hubbypy` calls, for load testing
+without spending the production quota.
+
+It keeps contacts, companies, property groups and properties in memory, enforces a HubSpot
+style rate limit (`max_calls` every `interval` seconds, plus a daily limit), answers with the
+same rate limit headers HubSpot sends, and can add latency and inject 429s and 5xx
+errors at random.
+
+Run it on its own:
+
+    python benchmarks/fake_hubspot.py --port 8000 --max-calls 100 --interval 10
+
+or start it in-process with `FakeHubSpotServer(...).start()` and point a `HubSpot`
+client at it with `point_at`.
+"""
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from requests.adapters import HTTPAdapter
+
+HUBSPOT_URL = 'https://api.hubapi.com'
+
+
+class RateLimitWindow:
+    """
+    HubSpot's limits: `max_calls` per fixed window of `interval` seconds, and `daily_limit`
+    calls in total.
+    """
+
+    def __init__(self, *, max_calls, interval, daily_limit):
+        self.max_calls = max_calls
+        self.interval = interval
+        self.daily_limit = daily_limit
+        self.daily_used = 0
+        self._window_start = time.monotonic()
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        Count a call. Returns `(allowed, headers)`.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= self.interval:
+                self._window_start = now
+                self._used = 0
+            allowed = self._used < self.max_calls and self.daily_used < self.daily_limit
+            if allowed:
+                self._used += 1
+                self.daily_used += 1
+            reset = self.interval - (now - self._window_start)
+            headers = {
+                'X-HubSpot-RateLimit-Interval-Milliseconds': str(int(self.interval * 1000)),
+                'X-HubSpot-RateLimit-Max': str(self.max_calls),
+                'X-HubSpot-RateLimit-Remaining': str(self.max_calls - self._used),
+                'X-HubSpot-RateLimit-Daily': str(self.daily_limit),
+                'X-HubSpot-RateLimit-Daily-Remaining': str(self.daily_limit - self.daily_used),
+            }
+            if not allowed:
+                headers['Retry-After'] = '%.3f' % max(reset, 0)
+            return allowed, headers
+
+
+class FakeHubSpot:
+    """
+    The in-memory state of the fake API and the handlers for each endpoint. Handlers take
+    the match of their route, the parsed JSON body and the query (a dict of lists, as
+    from `parse_qs`), and return `(status_code, body)`.
+    """
+
+    def __init__(self, *, max_calls=100, interval=10, daily_limit=1000000, latency=0,
+                 jitter=0, throttle_rate=0, error_rate=0, seed=None):
+        self.limits = RateLimitWindow(max_calls=max_calls, interval=interval,
+                                      daily_limit=daily_limit)
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.contacts = {}
+        self.companies = {}
+        self.associations = set()
+        self.groups = {}
+        self.properties = {}
+        self.stats = {'requests': 0, 'throttled': 0, 'injected_throttles': 0,
+                      'injected_errors': 0}
+        self._vids = itertools.count(1)
+        self._company_ids = itertools.count(1001)
+        self._lock = threading.Lock()
+        self.routes = [
+            ('POST', r'/contacts/v1/contact/createOrUpdate/email/([^/]+)/?',
+             self.create_or_update_contact),
+            ('POST', r'/contacts/v1/contact/vid/(\d+)/profile', self.update_contact_by_vid),
+            ('GET', r'/contacts/v1/contact/email/([^/]+)/profile', self.get_contact),
+            ('POST', r'/contacts/v1/contact/batch/?', self.batch_contacts),
+            ('GET', r'/contacts/v1/lists/all/contacts/all', self.all_contacts),
+            ('GET', r'/contacts/v1/lists/recently_updated/contacts/recent',
+             self.recent_contacts),
+            ('POST', r'/companies/v2/companies/?', self.create_company),
+            ('PUT', r'/companies/v2/companies/(\d+)', self.update_company),
+            ('POST', r'/companies/v1/batch-async/update', self.batch_companies),
+            ('PUT', r'/companies/v2/companies/(\d+)/contacts/(\d+)', self.associate),
+            ('PUT', r'/crm-associations/v1/associations/create-batch', self.associate_batch),
+            ('GET', r'/properties/v1/contacts/groups/?', self.list_groups),
+            ('POST', r'/properties/v1/contacts/groups/?', self.create_group),
+            ('PUT', r'/properties/v1/contacts/groups/named/([^/]+)', self.update_group),
+            ('GET', r'/properties/v1/contacts/properties/?', self.list_properties),
+            ('POST', r'/properties/v1/contacts/properties/?', self.create_property),
+            ('PUT', r'/properties/v1/contacts/properties/named/([^/]+)', self.update_property),
+            ('DELETE', r'/properties/v1/contacts/properties/named/([^/]+)',
+             self.delete_property),
+        ]
+
+    def handle(self, method, path, body, query):
+        """
+        Answer one request. Returns `(status_code, headers, body)`.
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        allowed, headers = self.limits.take()
+        if not allowed:
+            self._count('throttled')
+            return 429, headers, self._rate_limit_error()
+        if self.throttle_rate and self.random.random() < self.throttle_rate:
+            self._count('injected_throttles')
+            headers['Retry-After'] = '0.1'
+            return 429, headers, self._rate_limit_error()
+        if self.error_rate and self.random.random() < self.error_rate:
+            self._count('injected_errors')
+            return 502, headers, {'status': 'error', 'message': 'Bad gateway'}
+
+        for route_method, pattern, handler in self.routes:
+            if route_method == method:
+                match = re.fullmatch(pattern, path)
+                if match:
+                    with self._lock:
+                        status_code, response_body = handler(*map(unquote, match.groups()),
+                                                             body=body, query=query)
+                    return status_code, headers, response_body
+        return 404, headers, {'status': 'error', 'message': 'Not found'}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    @staticmethod
+    def _rate_limit_error():
+        return {'status': 'error', 'errorType': 'RATE_LIMIT', 'policyName': 'SECONDLY',
+                'message': 'You have reached your secondly limit.'}
+
+    @staticmethod
+    def _valid_email(email):
+        return isinstance(email, str) and re.fullmatch(r'[^@\s]+@[^@\s]+\.[^@\s]+', email)
+
+    def _upsert(self, email, properties):
+        contact = self.contacts.get(email)
+        is_new = contact is None
+        if is_new:
+            contact = self.contacts[email] = {'vid': next(self._vids), 'email': email,
+                                              'properties': {}}
+        self._set_contact_properties(contact, properties)
+        return contact, is_new
+
+    @staticmethod
+    def _set_contact_properties(contact, properties):
+        for prop in properties or []:
+            contact['properties'][prop['property']] = prop['value']
+        contact['properties']['lastmodifieddate'] = str(int(time.time() * 1000))
+
+    # contacts
+    def create_or_update_contact(self, email, body, query):
+        if not self._valid_email(email):
+            return 400, {'status': 'error', 'message': 'Email address %s is invalid' % email}
+        contact, is_new = self._upsert(email, (body or {}).get('properties'))
+        return 200, {'vid': contact['vid'], 'isNew': is_new}
+
+    def _contact_by_vid(self, vid):
+        for contact in self.contacts.values():
+            if contact['vid'] == int(vid):
+                return contact
+        return None
+
+    def update_contact_by_vid(self, vid, body, query):
+        contact = self._contact_by_vid(vid)
+        if contact is None:
+            return 404, {'status': 'error', 'message': 'resource not found'}
+        self._set_contact_properties(contact, (body or {}).get('properties'))
+        return 204, None
+
+    def get_contact(self, email, body, query):
+        contact = self.contacts.get(email)
+        if contact is None:
+            return 404, {'status': 'error', 'message': 'contact does not exist'}
+        return 200, self._contact_body(contact, query.get('property'))
+
+    @staticmethod
+    def _contact_body(contact, properties):
+        if properties is None:
+            properties = contact['properties']
+        return {
+            'vid': contact['vid'],
+            'properties': {name: {'value': contact['properties'][name]}
+                           for name in properties if name in contact['properties']},
+            'identity-profiles': [{'vid': contact['vid'], 'identities': [
+                {'type': 'EMAIL', 'value': contact['email'], 'is-primary': True}]}],
+        }
+
+    def all_contacts(self, body, query):
+        count = min(int(query.get('count', ['20'])[0]), 100)
+        offset = int(query.get('vidOffset', ['0'])[0])
+        contacts = sorted((c for c in self.contacts.values() if c['vid'] > offset),
+                          key=lambda c: c['vid'])
+        page = contacts[:count]
+        return 200, {
+            'contacts': [self._contact_body(c, query.get('property')) for c in page],
+            'has-more': len(contacts) > count,
+            'vid-offset': page[-1]['vid'] if page else offset,
+        }
+
+    def recent_contacts(self, body, query):
+        # newest first, continuing after the (timeOffset, vidOffset) of the previous page
+        count = min(int(query.get('count', ['20'])[0]), 100)
+        contacts = sorted(self.contacts.values(), reverse=True,
+                          key=lambda c: (int(c['properties']['lastmodifieddate']), c['vid']))
+        if 'timeOffset' in query:
+            offset = (int(query['timeOffset'][0]), int(query['vidOffset'][0]))
+            contacts = [c for c in contacts
+                        if (int(c['properties']['lastmodifieddate']), c['vid']) < offset]
+        page = contacts[:count]
+        last = page[-1] if page else None
+        return 200, {
+            'contacts': [self._contact_body(c, query.get('property')) for c in page],
+            'has-more': len(contacts) > count,
+            'time-offset': int(last['properties']['lastmodifieddate']) if last else 0,
+            'vid-offset': last['vid'] if last else 0,
+        }
+
+    def batch_contacts(self, body, query):
+        if not isinstance(body, list) or len(body) > 100:
+            return 400, {'status': 'error', 'message': 'Batches hold up to 100 contacts'}
+        failures = []
+        for index, c in enumerate(body):
+            if 'vid' in c:
+                if self._contact_by_vid(c['vid']) is None:
+                    failures.append((index, 'Contact %s does not exist' % c['vid']))
+            elif not self._valid_email(c.get('email')):
+                failures.append((index, 'Email address %s is invalid' % c.get('email')))
+        if failures:
+            return 400, {
+                'status': 'error',
+                'message': 'Errors found processing batch update',
+                'invalidEmails': [body[index].get('email') for index, _ in failures
+                                  if 'vid' not in body[index]],
+                'failureMessages': [
+                    {'index': index, 'error': {'status': 'error', 'message': message}}
+                    for index, message in failures
+                ],
+            }
+        for contact in body:
+            if 'vid' in contact:
+                self._set_contact_properties(self._contact_by_vid(contact['vid']),
+                                             contact.get('properties'))
+            else:
+                self._upsert(contact['email'], contact.get('properties'))
+        return 202, None
+
+    # companies
+    def _set_company_properties(self, company_id, properties):
+        company = self.companies.setdefault(company_id, {})
+        for prop in properties or []:
+            company[prop['name']] = prop['value']
+
+    def create_company(self, body, query):
+        company_id = next(self._company_ids)
+        self._set_company_properties(company_id, (body or {}).get('properties'))
+        return 200, {'companyId': company_id}
+
+    def update_company(self, company_id, body, query):
+        if int(company_id) not in self.companies:
+            return 404, {'status': 'error', 'message': 'company not found'}
+        self._set_company_properties(int(company_id), (body or {}).get('properties'))
+        return 200, {'companyId': int(company_id)}
+
+    def batch_companies(self, body, query):
+        if not isinstance(body, list) or len(body) > 100:
+            return 400, {'status': 'error', 'message': 'Batches hold up to 100 companies'}
+        missing = [c['objectId'] for c in body if c.get('objectId') not in self.companies]
+        if missing:
+            return 400, {'status': 'error', 'message': 'Unknown companies %s' % missing}
+        for company in body:
+            self._set_company_properties(company['objectId'], company.get('properties'))
+        return 202, None
+
+    def associate(self, company_id, contact_id, body, query):
+        self.associations.add((int(contact_id), int(company_id)))
+        return 204, None
+
+    def associate_batch(self, body, query):
+        for association in body or []:
+            self.associations.add((association['fromObjectId'], association['toObjectId']))
+        return 204, None
+
+    # property groups
+    def list_groups(self, body, query):
+        return 200, list(self.groups.values())
+
+    def create_group(self, body, query):
+        if body['name'] in self.groups:
+            return 409, {'status': 'error', 'message': 'group already exists'}
+        group = self.groups[body['name']] = dict(body, displayOrder=-1)
+        return 200, group
+
+    def update_group(self, name, body, query):
+        if name not in self.groups:
+            return 404, {'status': 'error', 'message': 'group not found'}
+        self.groups[name].update(body)
+        return 200, self.groups[name]
+
+    # properties
+    def list_properties(self, body, query):
+        return 200, list(self.properties.values())
+
+    def create_property(self, body, query):
+        if body['name'] in self.properties:
+            return 409, {'status': 'error', 'message': 'property already exists'}
+        if body.get('groupName') not in self.groups:
+            return 400, {'status': 'error', 'message': 'group does not exist'}
+        prop = self.properties[body['name']] = dict(body, description=body.get('description', ''),
+                                                    hidden=False, displayOrder=-1)
+        return 200, prop
+
+    def update_property(self, name, body, query):
+        if name not in self.properties:
+            return 404, {'status': 'error', 'message': 'property not found'}
+        self.properties[name].update(body)
+        return 200, self.properties[name]
+
+    def delete_property(self, name, body, query):
+        if self.properties.pop(name, None) is None:
+            return 404, {'status': 'error', 'message': 'property not found'}
+        return 204, None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and body go out in separate writes; with Nagle's algorithm on, every
+    # keep-alive response would stall on the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def _respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        try:
+            body = json.loads(raw) if raw else None
+        except ValueError:
+            self._send(400, {}, {'status': 'error', 'message': 'Invalid JSON'})
+            return
+        url = urlsplit(self.path)
+        status_code, headers, response_body = self.server.api.handle(
+            self.command, url.path, body, parse_qs(url.query))
+        self._send(status_code, headers, response_body)
+
+    def _send(self, status_code, headers, body):
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if payload:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeHubSpotServer:
+    """
+    Serves a `FakeHubSpot` over HTTP on `host:port` from a background thread. Port 0
+    picks a free port; `url` holds the address once `start` has been called. Keyword
+    arguments are passed on to `FakeHubSpot`.
+    """
+
+    def __init__(self, *, host='127.0.0.1', port=0, **kwargs):
+        self.api = FakeHubSpot(**kwargs)
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.api = self.api
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class RedirectAdapter(HTTPAdapter):
+    """
+    A `requests` transport adapter that sends requests meant for HubSpot to `base_url`.
+    """
+
+    def __init__(self, base_url, **kwargs):
+        self.base_url = base_url.rstrip('/')
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        request.url = self.base_url + request.url[len(HUBSPOT_URL):]
+        return super().send(request, **kwargs)
+
+
+def point_at(hubspot, base_url):
+    """
+    Make a `HubSpot` client send its requests to `base_url` instead of the real API.
+    """
+    hubspot.client.mount(HUBSPOT_URL, RedirectAdapter(base_url, pool_maxsize=hubspot.pool_size))
+    return hubspot
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the HubSpot API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-calls', type=int, default=100,
+                        help='calls allowed per interval')
+    parser.add_argument('--interval', type=float, default=10,
+                        help='length of the rate limit window in seconds')
+    parser.add_argument('--daily-limit', type=int, default=1000000)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='up to this many extra seconds added at random')
+    parser.add_argument('--throttle-rate', type=float, default=0,
+                        help='fraction of requests answered with an injected 429')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of requests answered with a 502')
+    args = parser.parse_args(argv)
+
+    server = FakeHubSpotServer(
+        host=args.host, port=args.port, max_calls=args.max_calls, interval=args.interval,
+        daily_limit=args.daily_limit, latency=args.latency, jitter=args.jitter,
+        throttle_rate=args.throttle_rate, error_rate=args.error_rate)
+    print('Fake HubSpot listening on %s' % server.url)
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+An end-to-end load test: drives a real `HubSpot` client, rate limiter, retries and all,
+against the local fake in `fake_hubspot.py` and reports throughput, request latency and
+how long the client spent sleeping in the rate limiter.
+
+    python benchmarks/run_load_test.py --mode batch --users 5000 --max-calls 100 --interval 10
+
+Use `--url` to aim at a fake that is already running; otherwise one is started
+in-process with the given limits. Results are printed, or written with `--output`, as JSON.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+if __name__ == '__main__':
+    # run as a script, so make the repo importable
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_hubbypy import make_manager, make_users  # noqa: E402
+from benchmarks.fake_hubspot import FakeHubSpotServer, point_at  # noqa: E402
+from hubbypy.hub_api import HubSpot  # noqa: E402
+from hubbypy.rate_limit import RateLimiter, TokenBucket  # noqa: E402
+
+
+class MeasuredLimiter(RateLimiter):
+    """
+    Wraps a limiter and adds up the waits it hands out, which `HubSpot.request` sleeps for.
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.blocking = limiter.blocking
+        self.slept = 0
+        self.reservations = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        wait = self.limiter.reserve(tokens)
+        with self._lock:
+            self.slept += wait
+            self.reservations += 1
+        return wait
+
+    def update(self, **kwargs):
+        self.limiter.update(**kwargs)
+
+    def pause(self, seconds):
+        self.limiter.pause(seconds)
+
+
+class MeasuredHubSpot(HubSpot):
+    """
+    Records how long each call to `request` took, including its retries and waits.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.latencies = []
+        self.status_codes = {}
+        self._latency_lock = threading.Lock()
+
+    def request(self, method, url, params={}, **kwargs):
+        started = time.perf_counter()
+        response = super().request(method, url, params=params, **kwargs)
+        elapsed = time.perf_counter() - started
+        status_code = str(getattr(response, 'status_code', None))
+        with self._latency_lock:
+            self.latencies.append(elapsed)
+            self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+        return response
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def drive(hubspot, users, *, mode, workers, batch_size):
+    if mode == 'single':
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(hubspot.sync_user, users))
+    if mode == 'batch':
+        return hubspot.sync_users(users, batch_size=batch_size)
+    if mode == 'stream':
+        return list(hubspot.sync_stream(iter(users), batch_size=batch_size))
+    if mode == 'schema':
+        return hubspot.sync_schema(max_workers=workers)
+    raise ValueError('Unknown mode %s' % mode)
+
+
+def run(*, url=None, mode='batch', users=1000, workers=8, batch_size=100, properties=20,
+        depth=2, max_calls=100, interval=10, latency=0, jitter=0, throttle_rate=0,
+        error_rate=0, client_max_calls=None, client_period=None):
+    server = None
+    if url is None:
+        server = FakeHubSpotServer(max_calls=max_calls, interval=interval, latency=latency,
+                                   jitter=jitter, throttle_rate=throttle_rate,
+                                   error_rate=error_rate, seed=1).start()
+        url = server.url
+
+    manager = make_manager(depth, properties)
+    user_list = make_users(users, depth, properties)
+    limiter = MeasuredLimiter(TokenBucket(max_calls=client_max_calls or max_calls,
+                                          period=client_period or interval))
+    hubspot = MeasuredHubSpot(api_key='load-test', user_property_manager=manager,
+                              rate_limiter=limiter, pool_size=max(workers, 10),
+                              backoff_base=0.05)
+    point_at(hubspot, url)
+    if mode != 'schema':
+        hubspot.sync_schema(max_workers=workers)
+        hubspot.latencies.clear()
+        hubspot.status_codes.clear()
+        limiter.slept = 0
+        limiter.reservations = 0
+
+    started = time.perf_counter()
+    try:
+        results = drive(hubspot, user_list, mode=mode, workers=workers, batch_size=batch_size)
+    finally:
+        elapsed = time.perf_counter() - started
+        hubspot.close()
+        if server is not None:
+            server.stop()
+
+    latencies = hubspot.latencies
+    report = {
+        'mode': mode,
+        'users': users,
+        'results': len(results),
+        'elapsed_s': round(elapsed, 3),
+        'requests': len(latencies),
+        'requests_per_s': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'latency_p50_ms': round(percentile(latencies, 0.5) * 1e3, 2) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1e3, 2) if latencies else None,
+        'latency_mean_ms': round(statistics.mean(latencies) * 1e3, 2) if latencies else None,
+        'limiter_sleep_s': round(limiter.slept, 3),
+        'limiter_reservations': limiter.reservations,
+        'status_codes': hubspot.status_codes,
+    }
+    if mode != 'schema':
+        report['users_per_s'] = round(users / elapsed, 2) if elapsed else None
+    if server is not None:
+        report['server'] = dict(server.api.stats, contacts=len(server.api.contacts))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test HubSpot against a local fake')
+    parser.add_argument('--url', help='the URL of a fake that is already running')
+    parser.add_argument('--mode', choices=['single', 'batch', 'stream', 'schema'],
+                        default='batch')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=8,
+                        help='threads calling sync_user in single mode')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--properties', type=int, default=20)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--max-calls', type=int, default=100,
+                        help="the fake's limit of calls per interval")
+    parser.add_argument('--interval', type=float, default=10,
+                        help="the length of the fake's rate limit window in seconds")
+    parser.add_argument('--client-max-calls', type=int,
+                        help="the client limiter's calls per period (defaults to --max-calls)")
+    parser.add_argument('--client-period', type=float,
+                        help="the client limiter's period (defaults to --interval)")
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args(argv)
+
+    report = run(url=args.url, mode=args.mode, users=args.users, workers=args.workers,
+                 batch_size=args.batch_size, properties=args.properties, depth=args.depth,
+                 max_calls=args.max_calls, interval=args.interval, latency=args.latency,
+                 jitter=args.jitter, throttle_rate=args.throttle_rate,
+                 error_rate=args.error_rate, client_max_calls=args.client_max_calls,
+                 client_period=args.client_period)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
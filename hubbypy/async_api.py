@@ -0,0 +1,552 @@
+import asyncio
+import collections
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .hub_api import (
+    ALL_CONTACTS_URL,
+    ASSOCIATIONS_URL,
+    BATCH_COMPANIES_URL,
+    BATCH_CONTACTS_URL,
+    CONTACT_BY_VID_URL,
+    COMPANIES_URL,
+    CONTACTS_URL,
+    MAX_BATCH_BYTES,
+    MAX_BATCH_SIZE,
+    MAX_PAGE_SIZE,
+    PROPERTIES_URL,
+    PROPERTY_GROUPS_URL,
+    RECENT_CONTACTS_URL,
+    SCHEMA_OPERATIONS,
+    HubSpot,
+    RecordChunker,
+    chunk_records,
+    sentinel
+)
+from .cursors import RecentContactsCursor
+from .schema_sync import plan_group_operations, plan_property_operations, schema_phases
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncHubSpot(HubSpot):
+    """
+    An asyncio counterpart to `HubSpot`. The contact and contact property methods are
+    coroutines, so many of them can run concurrently in one event loop.
+
+    Waiting on the rate limiter never blocks the event loop: each call reserves its slot
+    from the limiter and waits for it with `asyncio.sleep`. The HTTP calls themselves go
+    through the same pooled `requests` session as `HubSpot`, run on a thread pool of
+    `max_concurrency` workers, so at most that many requests are in flight at once.
+
+    Use it as an async context manager, or call `close` when you are done with it.
+    """
+
+    def __init__(self, *, max_concurrency=10, **kwargs):
+        kwargs.setdefault('pool_size', max_concurrency)
+        super().__init__(**kwargs)
+        self.max_concurrency = max_concurrency
+        self._executor = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        super().close()
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        return self._executor
+
+    async def _run_blocking(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(),
+                                          functools.partial(func, *args, **kwargs))
+
+    async def _call_store(self, store, func, *args):
+        """
+        Call `func`, which uses `store`, on the thread pool, since stores may be backed by
+        SQLite or a network cache. Without a store there is nothing to wait for.
+        """
+        if store is None:
+            return func(*args)
+        return await self._run_blocking(func, *args)
+
+    async def _wait_for_rate_limit(self):
+        if self.rate_limiter.blocking:
+            time_to_wait = await self._run_blocking(self.rate_limiter.reserve)
+        else:
+            time_to_wait = self.rate_limiter.reserve()
+        if time_to_wait:
+            logger.info('[HUBSPOT] waiting for {} seconds '.format(time_to_wait) +
+                        'to avoid exceeding rate limits')
+            if self.metrics is not None:
+                self.metrics.rate_limit_wait(time_to_wait)
+            await asyncio.sleep(time_to_wait)
+
+    async def request(self, method, url, params={}, idempotent=None, **kwargs):
+        """
+        Make a request without violating HubSpot's rate limit, waiting without blocking
+        the event loop when the limit is reached. Retries work as in `HubSpot.request`.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        self._encode_json(kwargs)
+        idempotent = self._is_idempotent(method, idempotent)
+        attempt = 0
+        while True:
+            await self._wait_for_rate_limit()
+            started = time.perf_counter()
+            response = await self._run_blocking(self.client.request, method, url,
+                                                params=params, **kwargs)
+            if self.metrics is not None:
+                self._record_request(method, url, response, time.perf_counter() - started)
+            if self.rate_limiter.blocking:
+                retry_delay = await self._run_blocking(self._retry_delay, response, attempt,
+                                                       idempotent)
+            else:
+                retry_delay = self._retry_delay(response, attempt, idempotent)
+            if retry_delay is None:
+                return self._decode_once(response)
+            if self.metrics is not None:
+                self._record_retry(method, url, response, retry_delay)
+            if retry_delay:
+                await asyncio.sleep(retry_delay)
+            attempt += 1
+
+    # sync user methods
+    async def _contact_records(self, users, run, slice_size, shared_only=False):
+        """
+        An async generator over the `(user, record)` pairs of `HubSpot._contact_records`.
+        Each slice of users is read and built on the thread pool.
+        """
+        users = iter(users)
+        while True:
+            pairs = await self._run_blocking(self._contact_slice, users, run, slice_size,
+                                             shared_only)
+            if not pairs:
+                return
+            for pair in pairs:
+                yield pair
+
+    async def sync_user(self, user):
+        """
+        The async version of `HubSpot.sync_user`. The payload is built on the thread pool,
+        so properties that query a database or call out over the network neither block the
+        event loop nor run in an async context.
+        """
+        data = await self._run_blocking(self._sync_data, user)
+        if data is None:
+            return None
+        response, body = await self._upsert_contact(user.email, data)
+        if response is not None and self._is_success(response):
+            await self._call_store(self.sent_state_store, self._remember_sent, user.email,
+                                   data['properties'])
+        return body
+
+    async def sync_users(self, users, *, batch_size=MAX_BATCH_SIZE,
+                         max_batch_bytes=MAX_BATCH_BYTES):
+        """
+        The async version of `HubSpot.sync_users`. Each batch is sent as soon as its
+        payloads are built, so building later batches overlaps with sending earlier ones.
+        At most `max_concurrency` batches are in flight; building waits for one of them to
+        finish before starting another. If a batch fails, the others are cancelled and the
+        error is raised.
+        """
+        results = []
+        positions = []
+        run = {}
+        in_flight = set()
+
+        async def send(chunk, chunk_positions):
+            chunk_results = await self.batch_create_or_update_contacts(chunk)
+            await self._call_store(self.sent_state_store, self._remember_batch, chunk,
+                                   chunk_results)
+            for position, result in zip(chunk_positions, chunk_results):
+                results[position] = result
+
+        async def start(chunk, chunk_positions):
+            while len(in_flight) >= self.max_concurrency:
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                in_flight.difference_update(done)
+                for task in done:
+                    # raises the error of a failed batch
+                    task.result()
+            in_flight.add(asyncio.ensure_future(send(chunk, chunk_positions)))
+
+        chunker = RecordChunker(max_count=batch_size, max_bytes=max_batch_bytes,
+                                dumps=self.codec.dumps)
+        sent = 0
+        try:
+            async for user, record in self._contact_records(users, run, batch_size):
+                if record is None:
+                    results.append(self._batch_result({'email': user.email}, None,
+                                                      skipped=True))
+                    continue
+                chunk = chunker.add(record)
+                if chunk:
+                    await start(chunk, positions[sent:sent + len(chunk)])
+                    sent += len(chunk)
+                positions.append(len(results))
+                results.append(None)
+            chunk = chunker.flush()
+            if chunk:
+                await start(chunk, positions[sent:])
+            await asyncio.gather(*in_flight)
+        except BaseException:
+            for task in in_flight:
+                task.cancel()
+            await asyncio.gather(*in_flight, return_exceptions=True)
+            raise
+        return results
+
+    async def sync_stream(self, users, *, batch_size=MAX_BATCH_SIZE,
+                          max_batch_bytes=MAX_BATCH_BYTES, max_pending=2):
+        """
+        The async version of `HubSpot.sync_stream`, as an async generator. Up to
+        `max_pending` batches are sent concurrently while the next one is built; once that
+        many are in flight, building waits for the oldest to finish.
+        """
+        run = {}
+        chunker = RecordChunker(max_count=batch_size, max_bytes=max_batch_bytes,
+                                dumps=self.codec.dumps)
+        chunk_sequences = []
+        ready = {}
+        max_ready = batch_size * (max_pending + 2)
+        in_flight = collections.deque()
+
+        async def send(sequences, chunk):
+            results = await self.batch_create_or_update_contacts(chunk)
+            await self._call_store(self.sent_state_store, self._remember_batch, chunk, results)
+            ready.update(zip(sequences, results))
+
+        async def contact_records():
+            async for pair in self._contact_records(users, run, batch_size, shared_only=True):
+                yield pair
+            yield sentinel, None
+
+        sequence = 0
+        next_sequence = 0
+        try:
+            async for user, record in contact_records():
+                if user is sentinel:
+                    chunk = chunker.flush()
+                else:
+                    chunk = None
+                    if record is None:
+                        ready[sequence] = self._batch_result({'email': user.email}, None,
+                                                             skipped=True)
+                    else:
+                        chunk = chunker.add(record)
+                if chunk:
+                    in_flight.append(asyncio.ensure_future(
+                        send(chunk_sequences[:len(chunk)], chunk)))
+                    del chunk_sequences[:len(chunk)]
+                    # give the new task a chance to start while we build the next chunk
+                    await asyncio.sleep(0)
+                if user is not sentinel and record is not None:
+                    chunk_sequences.append(sequence)
+                if not in_flight and chunk_sequences and len(ready) >= max_ready:
+                    # results are piling up behind a chunk that is slow to fill, e.g. when
+                    # most users are unchanged; send it as it is
+                    in_flight.append(asyncio.ensure_future(
+                        send(chunk_sequences[:], chunker.flush())))
+                    del chunk_sequences[:]
+
+                # wait for the oldest batch when too many are in flight or results are
+                # piling up behind it, and for every batch at the very end
+                while in_flight and (in_flight[0].done() or len(in_flight) > max_pending or
+                                     len(ready) >= max_ready or user is sentinel):
+                    await in_flight.popleft()
+                while next_sequence in ready:
+                    yield ready.pop(next_sequence)
+                    next_sequence += 1
+                sequence += 1
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    async def enqueue_user(self, user):
+        """
+        The async version of `HubSpot.enqueue_user`. The payload is built and queued on
+        the thread pool.
+        """
+        await self._run_blocking(super().enqueue_user, user)
+
+    async def drain_outbox(self, *, batch_size=MAX_BATCH_SIZE, max_batches=None, lease=300,
+                           retry_delay=60):
+        """
+        The async version of `HubSpot.drain_outbox`. The batches claimed in one go are
+        sent one after another, and the outbox is used from the thread pool.
+        """
+        if self.outbox is None:
+            raise ValueError('HubSpot needs an outbox to drain')
+
+        def settle(entries, chunk, chunk_results):
+            for entry, record, result in zip(entries, chunk, chunk_results):
+                self._settle_outbox_entry(entry, record, result, retry_delay)
+
+        results = []
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            entries = await self._run_blocking(self.outbox.claim, limit=batch_size, lease=lease)
+            if not entries:
+                break
+            batches += 1
+            to_send = await self._run_blocking(self._outbox_changes, entries, results)
+            records = [{'email': entry.email, 'properties': properties}
+                       for entry, properties in to_send]
+            sent = 0
+            for chunk in chunk_records(records, max_count=batch_size, dumps=self.codec.dumps):
+                chunk_results = await self.batch_create_or_update_contacts(chunk)
+                await self._run_blocking(settle, [entry for entry, _ in to_send[sent:]], chunk,
+                                         chunk_results)
+                sent += len(chunk)
+                results.extend(chunk_results)
+        return results
+
+    # contact methods
+    async def create_or_update_user(self, user, user_data):
+        vid = getattr(user, 'crm_unique_id', None)
+        if not vid:
+            # by indexed vid when we have one, falling back to email if it went stale
+            response, response_data = await self._upsert_contact(user.email, user_data)
+            if response is not None:
+                if hasattr(user, 'crm_unique_id') and self._is_success(response):
+                    user.crm_unique_id = response_data['vid']
+                    await self._run_blocking(user.save)
+                return response_data
+        else:
+            response = await self.request(
+                'post',
+                CONTACT_BY_VID_URL.format(vid),
+                data=self.codec.dumps(user_data),
+                idempotent=True
+            )
+            return response
+
+    async def create_or_update_contact(self, email, user_data):
+        return (await self._upsert_contact(email, user_data))[1]
+
+    async def _upsert_contact(self, email, data):
+        vid = await self._call_store(self.vid_index, self._indexed_vid, email)
+        if vid is not None:
+            response = await self.request('post', CONTACT_BY_VID_URL.format(vid), json=data,
+                                          idempotent=True)
+            if not await self._call_store(self.vid_index, self._stale_vid, email, response):
+                return response, self._vid_body(vid, response)
+        url = "{}/createOrUpdate/email/{}".format(CONTACTS_URL, email)
+        response = await self.request('post', url, json=data, idempotent=True)
+        return response, await self._call_store(self.vid_index, self._upsert_body, email,
+                                                response)
+
+    async def batch_create_or_update_contacts(self, contacts):
+        results = [None] * len(contacts)
+        addressed = await self._call_store(self.vid_index, self._address_by_vid, contacts)
+        pending = list(range(len(contacts)))
+        while pending:
+            response = await self.request('post', BATCH_CONTACTS_URL,
+                                          json=[addressed[i] for i in pending], idempotent=True)
+            pending = self._apply_batch_response(contacts, pending, results, response)
+        if addressed is not contacts:
+            await self._call_store(self.vid_index, self._forget_failed_vids, addressed, results)
+        return results
+
+    # reading contacts
+    async def iter_contacts(self, properties=None, *, page_size=MAX_PAGE_SIZE, prefetch=False):
+        """
+        An async generator over every contact, as in `HubSpot.iter_contacts`. With
+        `prefetch`, the request for the next page is already running while the caller
+        works through the current one.
+        """
+        async for page in self.iter_contact_pages(properties, page_size=page_size,
+                                                  prefetch=prefetch):
+            for contact in page:
+                yield contact
+
+    async def iter_contact_pages(self, properties=None, *, page_size=MAX_PAGE_SIZE,
+                                 prefetch=False):
+        pages = self._contact_pages(ALL_CONTACTS_URL, self._contact_params(properties, page_size))
+        if not prefetch:
+            try:
+                async for page in pages:
+                    yield page
+            finally:
+                await pages.aclose()
+            return
+        next_page = asyncio.ensure_future(pages.__anext__())
+        try:
+            while True:
+                try:
+                    page = await next_page
+                except StopAsyncIteration:
+                    return
+                next_page = asyncio.ensure_future(pages.__anext__())
+                yield page
+        finally:
+            next_page.cancel()
+            # the generator can only be closed once the fetch running in it has unwound
+            await asyncio.wait([next_page])
+            if not next_page.cancelled():
+                next_page.exception()
+            await pages.aclose()
+
+    async def iter_recent_contacts(self, properties=None, *, cursor_store=None,
+                                   page_size=MAX_PAGE_SIZE, overlap=60):
+        cursor_store = self._cursor_store(cursor_store)
+        cursor = RecentContactsCursor(await self._run_blocking(cursor_store.get),
+                                      overlap=overlap)
+        params = self._contact_params(self._with_timestamp(properties), page_size)
+        async for page in self._contact_pages(RECENT_CONTACTS_URL, params):
+            for contact in cursor.take(page):
+                yield contact
+            if cursor.reached_end:
+                break
+        await self._run_blocking(self._save_cursor, cursor_store, cursor)
+
+    async def _contact_pages(self, url, params):
+        offsets = {}
+        while True:
+            response = await self.request('get', url, params=dict(params, **offsets))
+            response.raise_for_status()
+            # a full page takes long enough to parse to hold up the event loop
+            body = await self._run_blocking(response.json)
+            await self._call_store(self.vid_index, self._index_contacts, body)
+            contacts, offsets = self._contact_page(body)
+            yield contacts
+            if offsets is None:
+                return
+
+    # company methods
+    async def sync_company(self, company):
+        data = await self._run_blocking(self._company_manager().generate_sync_data, company)
+        company_id = getattr(company, 'crm_unique_id', None)
+        if company_id:
+            response = await self.request('put', '{}/{}'.format(COMPANIES_URL, company_id),
+                                          json=data)
+            return response.json()
+        response = await self.request('post', COMPANIES_URL, json=data)
+        if self._is_success(response):
+            await self._run_blocking(self._remember_company_id, company, response)
+        return response.json()
+
+    async def sync_companies(self, companies, *, batch_size=MAX_BATCH_SIZE,
+                             max_batch_bytes=MAX_BATCH_BYTES):
+        companies, payloads = await self._run_blocking(self._company_payloads, companies)
+        results = [None] * len(companies)
+        positions = []
+        records = []
+        creates = []
+        for position, (company, payload) in enumerate(zip(companies, payloads)):
+            company_id = getattr(company, 'crm_unique_id', None)
+            if company_id:
+                positions.append(position)
+                records.append({'objectId': company_id, 'properties': payload['properties']})
+            else:
+                creates.append((position, company, payload))
+
+        async def create(position, company, payload):
+            response = await self.request('post', COMPANIES_URL, json=payload)
+            company_id = None
+            if self._is_success(response):
+                company_id = await self._run_blocking(self._remember_company_id, company,
+                                                      response)
+            results[position] = self._company_result(company_id, response)
+
+        async def update(chunk, chunk_positions):
+            response = await self.request('post', BATCH_COMPANIES_URL, json=chunk,
+                                          idempotent=True)
+            for position, record in zip(chunk_positions, chunk):
+                results[position] = self._company_result(record['objectId'], response)
+
+        tasks = [create(*c) for c in creates]
+        sent = 0
+        for chunk in chunk_records(records, max_count=batch_size, max_bytes=max_batch_bytes,
+                                   dumps=self.codec.dumps):
+            tasks.append(update(chunk, positions[sent:sent + len(chunk)]))
+            sent += len(chunk)
+        await asyncio.gather(*tasks)
+        return results
+
+    async def associate_contact_with_company(self, contact_id, company_id):
+        url = '{}/{}/contacts/{}'.format(COMPANIES_URL, company_id, contact_id)
+        return await self.request('put', url)
+
+    async def associate_contacts_with_companies(self, pairs, *, batch_size=MAX_BATCH_SIZE):
+        chunks = list(self._association_chunks(pairs, batch_size))
+        responses = await asyncio.gather(*[
+            self.request('put', ASSOCIATIONS_URL + '/create-batch', json=chunk)
+            for chunk in chunks])
+        results = []
+        for chunk, response in zip(chunks, responses):
+            results.extend(self._association_results(chunk, response))
+        return results
+
+    # contact properties
+    async def plan_contact_property_groups_sync(self):
+        response = await self.request('get', PROPERTY_GROUPS_URL)
+        return plan_group_operations(self.user_property_manager.groups, response.json())
+
+    async def plan_contact_properties_sync(self):
+        response = await self.request('get', PROPERTIES_URL)
+        return plan_property_operations(
+            [p.get_dict() for p in self.user_property_manager.custom_user_properties],
+            response.json(),
+            [g['name'] for g in self.user_property_manager.groups])
+
+    async def sync_contact_property_groups(self, dry_run=False, max_workers=4):
+        operations = await self.plan_contact_property_groups_sync()
+        return await self.apply_schema_operations(operations, dry_run=dry_run,
+                                                  max_workers=max_workers)
+
+    async def sync_contact_properties(self, dry_run=False, max_workers=4):
+        operations = await self.plan_contact_properties_sync()
+        return await self.apply_schema_operations(operations, dry_run=dry_run,
+                                                  max_workers=max_workers)
+
+    async def sync_schema(self, dry_run=False, max_workers=4):
+        groups, properties = await asyncio.gather(self.plan_contact_property_groups_sync(),
+                                                  self.plan_contact_properties_sync())
+        return await self.apply_schema_operations(groups + properties, dry_run=dry_run,
+                                                  max_workers=max_workers)
+
+    async def apply_schema_operations(self, operations, dry_run=False, max_workers=4):
+        if dry_run:
+            return super().apply_schema_operations(operations, dry_run=True)
+
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def apply(operation):
+            async with semaphore:
+                loop = asyncio.get_running_loop()
+                started = loop.time()
+                try:
+                    response = await self.apply_schema_operation(operation)
+                except Exception as err:
+                    logger.exception('[HUBSPOT][SYNC] %s of %s failed', operation.action,
+                                     operation.name)
+                    return self._schema_report(operation, False, None, str(err),
+                                               loop.time() - started)
+                return self._schema_response_report(operation, response,
+                                                    loop.time() - started)
+
+        results = {}
+        for phase in schema_phases(operations):
+            results.update(zip(map(id, phase), await asyncio.gather(*[apply(o) for o in phase])))
+        return [results[id(operation)] for operation in operations]
+
+    async def apply_schema_operation(self, operation):
+        method, url, message = SCHEMA_OPERATIONS[operation.action]
+        logger.info('[HUBSPOT][SYNC] ' + message, operation.name)
+        kwargs = {}
+        if operation.data is not None:
+            kwargs['data'] = self.codec.dumps(operation.data)
+        return await self.request(method, url.format(operation.name), **kwargs)
@@ -0,0 +1,18 @@
+from .contact_properties import UserPropertyManager
+
+
+class CompanyPropertyManager(UserPropertyManager):
+    """
+    Holds the properties we sync to HubSpot companies and builds the payload for each
+    company. It takes the same `AccessorProperty`, `FunctionProperty` and
+    `ConstantProperty` instances as `UserPropertyManager`, evaluated against a company
+    object instead of a user, e.g. `AccessorProperty(accessor='plan.name', ...)`.
+
+    Company-level data belongs here rather than on every contact through
+    `AccessorProperty(accessor='company.…')`: it is then computed and sent once per
+    company instead of once per employee.
+
+    HubSpot's company API names each property with `name` rather than `property`, so
+    payloads look like `{'properties': [{'name': 'numberofemployees', 'value': 12}]}`.
+    """
+    property_key = 'name'
@@ -1,8 +1,12 @@
 import copy
 import functools
 import logging
+import operator
 import time
-from datetime import datetime, date
+from .encoders import default_registry
+from .profiling import PropertyProfile, format_profile_report, rank_profiles
+from .sent_state import digest_value
+from .storage import LRUCache
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +22,37 @@ PROPERTY_GROUPS = [
 sentinel = object()
 
 
+def user_identity(user):
+    """
+    The key we cache per-user values under: the user's primary key when it has one,
+    otherwise their email.
+    """
+    pk = getattr(user, 'pk', None)
+    if pk is not None:
+        return pk
+    return getattr(user, 'email', None) or id(user)
+
+
+class TTLCache:
+    """
+    A thread-safe mapping that holds at most `max_size` entries, each for at most `ttl`
+    seconds. The least recently used entries are evicted first.
+    """
+
+    def __init__(self, *, ttl, max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = LRUCache(max_size=max_size,
+                                 expired=lambda entry: entry[0] < time.monotonic())
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        return default if entry is None else entry[1]
+
+    def set(self, key, value):
+        self._entries.set(key, (time.monotonic() + self.ttl, value))
+
+
 def rgetattr(obj, attr, default=sentinel):
     if default is sentinel:
         _getattr = getattr
@@ -96,6 +131,8 @@ class BaseUserProperty:
       - `number`
       - `varchar`
       - `textarea`
+      Other native types need a HubSpot type registered along with their encoder, see
+      `encoders.EncoderRegistry`.
     - `label`: a human readable label for the field in HubSpot. This is what users of HubSpot
       will see when they are looking at contact records.
 
@@ -107,6 +144,11 @@ class BaseUserProperty:
       list of these properties can be found
       [here](https://knowledge.hubspot.com/articles/kcs_article/contacts/list-of-hubspot-s-default-contact-properties)
     - `description`: a description of the property that HubSpot users will see in the CRM
+    - `io_bound`: set this to true if getting the value waits on the network or the database.
+      When the manager has an `executor`, such properties are evaluated concurrently.
+    - `encoder`: a function turning the property's values (never `None`) into what HubSpot
+      expects. By default it is looked up by `native_type` in `encoders`, an
+      `EncoderRegistry` that defaults to `encoders.default_registry`.
 
     """
     name = None
@@ -116,11 +158,13 @@ class BaseUserProperty:
     hs_type = None
     fieldType = None
     built_in = False
+    io_bound = False
 
-    def _get_hs_type(self, native_type, options=None):
+    def _get_hs_type(self, native_type, options=None, encoders=default_registry):
         """
         string, number, date, datetime, or enumeration
         """
+        hs_type = encoders.hs_type(native_type)
         type_mappings = {
             'date': 'date',
             'datetime': 'datetime',
@@ -132,9 +176,17 @@ class BaseUserProperty:
         if native_type == 'enumeration':
             assert type(options) == list
             self.options = options
-        return type_mappings[native_type]
-
-    def _get_field_type(self, native_type):
+        if hs_type is None:
+            hs_type = type_mappings.get(native_type)
+        if hs_type is None:
+            raise KeyError('No HubSpot type for native_type {!r}; register one with its '
+                           'encoder'.format(native_type))
+        return hs_type
+
+    def _get_field_type(self, native_type, encoders=default_registry):
+        field_type = encoders.field_type(native_type)
+        if field_type is not None:
+            return field_type
         field_type_mappings = {
             'bool': 'booleancheckbox',
             'date': 'date',
@@ -144,7 +196,17 @@ class BaseUserProperty:
             'number': 'number',
             'enumeration': ''
         }
-        return field_type_mappings.get(native_type, None)
+        if native_type in field_type_mappings:
+            return field_type_mappings[native_type]
+        # a registered native type is shown the way HubSpot shows its hs_type by default
+        hs_field_type_mappings = {
+            'string': 'text',
+            'number': 'number',
+            'date': 'date',
+            'datetime': 'date',
+            'enumeration': ''
+        }
+        return hs_field_type_mappings.get(encoders.hs_type(native_type))
 
     def _handle_bool(self):
         self.hs_type = 'enumeration'
@@ -163,22 +225,30 @@ class BaseUserProperty:
         self.options = [trueOption, falseOption]
 
     def __init__(self, *, name, native_type, label=None, description=None,
-                 group_name=None, options=None, built_in=False):
+                 group_name=None, options=None, built_in=False, io_bound=False,
+                 encoder=None, encoders=None):
         self.name = name
         self.label = label
         self.description = description
         self.native_type = native_type
         self.group_name = group_name
         self.built_in = built_in
+        self.io_bound = io_bound
+        encoders = encoders or default_registry
         if native_type == 'enumeration':
-            assert type(options) == list
-            self.options = options
+            self.hs_type = self._get_hs_type(native_type, options, encoders)
         elif native_type == 'bool':
             self._handle_bool()
         else:
             self.options = options
-            self.hs_type = self._get_hs_type(native_type, options)
-        self.field_type = self._get_field_type(native_type)
+            self.hs_type = self._get_hs_type(native_type, options, encoders)
+        self.field_type = self._get_field_type(native_type, encoders)
+        if encoder is None:
+            self.encoder = encoders.encoder(native_type)
+            self._column_encoder = encoders.column_encoder(native_type)
+        else:
+            self.encoder = encoder
+            self._column_encoder = None
 
     def get_dict(self):
         """
@@ -206,25 +276,70 @@ class BaseUserProperty:
         value = self._get_value(user)
 
         if value is not None:
-            if self.native_type == 'bool':
-                return 'true' if value else 'false'
-            if self.native_type == 'datetime':
-                return self._datetime_to_unix(value)
-            if self.native_type == 'date' and type(value) is date:
-                return self._date_to_unix(value)
-            if self.native_type == 'date' and type(value) is datetime:
-                return self._date_to_unix(value.date())
-            return value
+            return self.encoder(value)
 
     def _get_value(self, user):
         raise NotImplementedError('Subclasses of BaseUserProperty should provide should '
                                   'implement the _get_value method')
 
-    def _datetime_to_unix(self, timestamp):
-        return int(time.mktime(timestamp.timetuple()) * 1e3 + timestamp.microsecond / 1e3)
+    def _compile(self):
+        """
+        Return a function of a user that gives the same result as `get_formatted_value`,
+        with the decisions that only depend on the property made once, up front. This is
+        what `UserPropertyManager` calls when it builds its sync plan.
+        """
+        if type(self).get_formatted_value is not BaseUserProperty.get_formatted_value:
+            return self.get_formatted_value
+
+        get_value = self._compile_getter()
+        encode = self._compile_encoder()
 
-    def _date_to_unix(self, thisdate):
-        return int(time.mktime(thisdate.timetuple()) * 1000)
+        def formatted_value(user):
+            value = get_value(user)
+            if value is not None:
+                return encode(value)
+
+        return formatted_value
+
+    def _compile_getter(self):
+        """
+        Return a function of a user that gives the same result as `_get_value`. Subclasses
+        may return something faster than the bound method.
+        """
+        return self._get_value
+
+    def _compile_accessor(self):
+        """
+        Return an `(accessor, encoder)` pair when the property's raw value is simply the
+        object found at a dotted accessor path on the user. The manager then resolves the
+        path through its shared `AccessorTree`. Returns `None` for every other property.
+        """
+        return None
+
+    def _compile_run_key(self):
+        """
+        Return a function of a user giving the key under which the property's value may be
+        reused for the rest of a sync run, or `None` when the value must be computed on
+        every call.
+        """
+        return None
+
+    def _compile_encoder(self):
+        """
+        Return a function that turns a value that is not `None` into the form HubSpot
+        expects for this property.
+        """
+        return self.encoder
+
+    def _compile_column_encoder(self):
+        """
+        Return a function that encodes a whole list of raw values (which may include
+        `None`) at once, as `UserPropertyManager.generate_bulk_sync_data` does.
+        """
+        if self._column_encoder is not None:
+            return self._column_encoder
+        encode = self._compile_encoder()
+        return lambda values: [encode(v) if v is not None else None for v in values]
 
 
 class AccessorProperty(BaseUserProperty):
@@ -248,24 +363,94 @@ class AccessorProperty(BaseUserProperty):
                     user.email,
                     err))
 
+    def _compile_getter(self):
+        if type(self)._get_value is not AccessorProperty._get_value:
+            return self._get_value
+
+        accessor = self.accessor
+        # attrgetter resolves the dotted path just like rgetattr, without re-splitting it
+        getter = operator.attrgetter(accessor)
+
+        def get_value(user):
+            try:
+                return getter(user)
+            except Exception as err:
+                logger.debug(
+                    '[HUBSPOT] Could not get {} property on user with email{}, error: {}'.format(
+                        accessor,
+                        user.email,
+                        err))
+
+        return get_value
+
+    def _compile_accessor(self):
+        if (type(self)._get_value is not AccessorProperty._get_value or
+                type(self).get_formatted_value is not BaseUserProperty.get_formatted_value):
+            return None
+        return self.accessor, self._compile_encoder()
+
 
 class FunctionProperty(BaseUserProperty):
     """
     A property whose value depends on calling a function at the time we ask for the value.
     Usefull for saving the last synced time. If your function takes a user as an argument,
     then set `send_user` to `True`.
+
+    `scope` says how long a computed value may be reused:
+    - `call` (the default): the function is called every time a value is needed.
+    - `run`: the value is computed once per sync run, e.g. one `sync_users` call, and once
+      per user within the run when `send_user` is `True`.
+    - `ttl`: values are cached for `ttl` seconds across runs, per user when `send_user` is
+      `True`. At most `max_size` values are kept; the least recently used go first.
+
+    Per-user values are keyed by `key(user)`, which defaults to `user_identity`.
     """
 
-    def __init__(self, *, func, send_user=False, **kwargs):
+    SCOPES = ('call', 'run', 'ttl')
+
+    def __init__(self, *, func, send_user=False, scope='call', ttl=None, max_size=1000,
+                 key=None, **kwargs):
+        if scope not in self.SCOPES:
+            raise ValueError('scope must be one of {}'.format(', '.join(self.SCOPES)))
+        if scope == 'ttl' and not ttl:
+            raise ValueError('A ttl is required for properties with the ttl scope')
         self.func = func
         self.send_user = send_user
+        self.scope = scope
+        self.key = key or user_identity
+        self._cache = TTLCache(ttl=ttl, max_size=max_size) if scope == 'ttl' else None
         super().__init__(**kwargs)
 
-    def _get_value(self, user):
+    def _call_func(self, user):
         if self.send_user:
             return self.func(user)
         return self.func()
 
+    def _get_value(self, user):
+        if self._cache is None:
+            return self._call_func(user)
+        cache_key = self.key(user) if self.send_user else None
+        value = self._cache.get(cache_key, sentinel)
+        if value is sentinel:
+            value = self._call_func(user)
+            self._cache.set(cache_key, value)
+        return value
+
+    def _compile_getter(self):
+        if type(self)._get_value is not FunctionProperty._get_value or self._cache is not None:
+            return self._get_value
+        if self.send_user:
+            return self.func
+        func = self.func
+        return lambda user: func()
+
+    def _compile_run_key(self):
+        if self.scope != 'run':
+            return None
+        if self.send_user:
+            return self.key
+        return lambda user: None
+
 
 class ConstantProperty(BaseUserProperty):
     """
@@ -280,15 +465,113 @@ class ConstantProperty(BaseUserProperty):
     def _get_value(self, user):
         return self.value
 
+    def _compile(self):
+        if (type(self)._get_value is not ConstantProperty._get_value or
+                type(self).get_formatted_value is not BaseUserProperty.get_formatted_value):
+            return super()._compile()
+        # the value never changes, so encode it once
+        formatted_value = self.get_formatted_value(None)
+        return lambda user: formatted_value
+
+
+class AccessorTree:
+    """
+    A prefix tree of dotted accessor paths, such as `company.stripe_customer.plan_id` and
+    `company.stripe_customer.current_subscription.status`. Resolving the tree against a
+    user looks up each shared prefix (`company`, then `company.stripe_customer`) only once,
+    which matters when those lookups are Django related-object descriptors that hit the
+    database.
+
+    When a lookup raises, every path below it is skipped together and logged once. When a
+    prefix is `None`, such as a user without a company, every path below it is `None`.
+    """
+
+    def __init__(self, accessors=()):
+        # attribute name -> [child nodes, the accessor ending at this node or None]
+        self._root = {}
+        for accessor in accessors:
+            self.add(accessor)
+
+    def __bool__(self):
+        return bool(self._root)
+
+    def add(self, accessor):
+        node = self._root
+        names = accessor.split('.')
+        for name in names[:-1]:
+            node = node.setdefault(name, [{}, None])[0]
+        node.setdefault(names[-1], [{}, None])[1] = accessor
+
+    def resolve(self, obj):
+        """
+        Return a dict mapping each accessor in the tree to the value found on `obj`.
+        Accessors whose lookup failed are left out.
+        """
+        values = {}
+        self._resolve(obj, self._root, values, obj, ())
+        return values
+
+    def _resolve(self, obj, node, values, root, path):
+        for name, (children, accessor) in node.items():
+            try:
+                value = getattr(obj, name)
+            except Exception as err:
+                logger.debug(
+                    '[HUBSPOT] Could not get {} on user with email {}, skipping {}, '
+                    'error: {}'.format(
+                        '.'.join(path + (name,)),
+                        getattr(root, 'email', None),
+                        ', '.join(self._accessors_under(children, accessor)),
+                        err))
+                continue
+            if value is None:
+                values.update(dict.fromkeys(self._accessors_under(children, accessor)))
+                continue
+            if accessor is not None:
+                values[accessor] = value
+            if children:
+                self._resolve(value, children, values, root, path + (name,))
+
+    def _accessors_under(self, node, accessor=None):
+        accessors = [accessor] if accessor is not None else []
+        for children, child_accessor in node.values():
+            accessors.extend(self._accessors_under(children, child_accessor))
+        return accessors
+
 
 class UserPropertyManager:
+    """
+    Holds the properties we sync to HubSpot and builds the payload for each user.
+
+    The first time a payload is generated, the registered properties are compiled into a
+    flat sync plan: one prebuilt function per property that fetches and encodes its value.
+    The accessor paths of all `AccessorProperty`s are merged into one `AccessorTree`, so
+    shared prefixes are looked up once per user. Adding a property throws the plan away,
+    and it is rebuilt on the next sync.
+
+    Give the manager an `executor`, such as a `concurrent.futures.ThreadPoolExecutor`, to
+    evaluate properties marked `io_bound` concurrently: across properties for a single
+    user, and across users too in `generate_bulk_sync_data`. Payloads keep their order,
+    and an exception raised by a property is raised just as it would be without the
+    executor.
+
+    Pass `profile=True`, or call `enable_profiling`, to time every property while payloads
+    are built. `profile_report` then ranks the properties by their total cost. Profiling
+    evaluates each `AccessorProperty` on its own rather than through the shared
+    `AccessorTree`, so that every lookup is charged to the property that made it.
+    """
 
     _user_properties = []
     _groups = []
+    # the key naming the property in each entry of a payload's properties list
+    property_key = 'property'
 
-    def __init__(self, *, groups):
+    def __init__(self, *, groups, executor=None, profile=False):
         self._user_properties = []
         self._groups = groups
+        self._sync_plan = None
+        self.executor = executor
+        self._profiles = {} if profile else None
 
     def add_prop(self, prop):
 
@@ -296,6 +579,7 @@ class UserPropertyManager:
             raise ValueError('Manager already contains a property with this name')
         else:
             self._user_properties.append(prop)
+            self._sync_plan = None
 
     @property
     def groups(self):
@@ -309,18 +593,221 @@ class UserPropertyManager:
         """
         return [p for p in self._user_properties if not p.built_in]
 
-    def generate_sync_data(self, user):
+    @property
+    def sync_plan(self):
+        """
+        A list of `(property name, accessor, function, run key, io bound)` steps, in the
+        order the properties were added, and the `AccessorTree` of the plan's accessors.
+
+        When `accessor` is `None`, `function` takes the user and returns the formatted
+        value. Otherwise the raw value is looked up in the resolved tree and `function`
+        encodes it. `run key` is `None`, or a function of the user giving the key under
+        which the value is reused for the rest of a run. `io bound` steps are the ones
+        handed to the executor.
+        """
+        sync_plan = self._sync_plan
+        if sync_plan is None:
+            steps = []
+            tree = AccessorTree()
+            for prop in self._user_properties:
+                if self._profiles is not None:
+                    steps.append((prop.name, None, self._compile_profiled(prop),
+                                  prop._compile_run_key(), prop.io_bound))
+                    continue
+                # io bound accessors are fetched on their own, so they can run in the executor
+                compiled_accessor = None if prop.io_bound else prop._compile_accessor()
+                if compiled_accessor is None:
+                    steps.append((prop.name, None, prop._compile(), prop._compile_run_key(),
+                                  prop.io_bound))
+                else:
+                    accessor, encode = compiled_accessor
+                    tree.add(accessor)
+                    steps.append((prop.name, accessor, encode, None, False))
+            sync_plan = self._sync_plan = (steps, tree)
+        return sync_plan
+
+    def _compile_profiled(self, prop):
+        profile = self._profiles.get(prop.name)
+        if profile is None:
+            profile = self._profiles[prop.name] = PropertyProfile(prop.name,
+                                                                  type(prop).__name__)
+        if type(prop).get_formatted_value is not BaseUserProperty.get_formatted_value:
+            return profile.wrap(prop.get_formatted_value)
+        return profile.wrap(prop._compile_getter(), prop._compile_encoder())
+
+    def enable_profiling(self):
+        """
+        Start timing each property. Timings gathered earlier are kept.
+        """
+        if self._profiles is None:
+            self._profiles = {}
+            self._sync_plan = None
 
-        properties = []
+    def disable_profiling(self):
+        """
+        Stop timing properties and go back to the regular sync plan. The timings gathered
+        so far are dropped.
+        """
+        if self._profiles is not None:
+            self._profiles = None
+            self._sync_plan = None
+
+    def reset_profile(self):
+        for profile in (self._profiles or {}).values():
+            profile.reset()
+
+    def profile_report(self, limit=None, text=False):
+        """
+        The properties ranked by the total time spent getting and encoding their values
+        since profiling was enabled, most expensive first. Each entry is a dict with the
+        property's `name`, `kind`, `calls`, `total_seconds` (split into `get_seconds` and
+        `encode_seconds`), `share` of the total, `mean_us`, `max_us`, `errors`, `nones` and
+        `none_rate`. Pass `text=True` for a printable table instead.
+
+        An `AccessorProperty` whose lookup fails logs it and gives `None`, so such failures
+        show up in `nones` rather than `errors`.
+        """
+        if self._profiles is None:
+            raise ValueError('Profiling is not enabled on this manager')
+        report = rank_profiles(self._profiles.values(), limit)
+        return format_profile_report(report) if text else report
+
+    @staticmethod
+    def _run_cache_key(name, run_key, user, run):
+        if run is not None and run_key is not None:
+            return (name, run_key(user))
+        return None
+
+    def _submit_io_bound(self, steps, users, run):
+        """
+        Start evaluating the io bound steps for `users` in the executor. Returns a dict
+        mapping `(step index, user index)` to a future. Users that share a run key share a
+        future.
+        """
+        futures = {}
+        if self.executor is None:
+            return futures
+        shared = {}
+        for index, (name, accessor, func, run_key, io_bound) in enumerate(steps):
+            if not io_bound:
+                continue
+            for user_index, user in enumerate(users):
+                cache_key = self._run_cache_key(name, run_key, user, run)
+                if cache_key is not None:
+                    if cache_key in run:
+                        continue
+                    if cache_key not in shared:
+                        shared[cache_key] = self.executor.submit(func, user)
+                    futures[index, user_index] = shared[cache_key]
+                else:
+                    futures[index, user_index] = self.executor.submit(func, user)
+        return futures
+
+    @staticmethod
+    def _evaluate(step, user, run, future=None):
+        """
+        The formatted value of a step that is not resolved through the accessor tree.
+        """
+        name, accessor, func, run_key, io_bound = step
+        cache_key = UserPropertyManager._run_cache_key(name, run_key, user, run)
+        if cache_key is not None:
+            value = run.get(cache_key, sentinel)
+            if value is not sentinel:
+                return value
+        value = future.result() if future is not None else func(user)
+        if cache_key is not None:
+            run[cache_key] = value
+        return value
+
+    def _changed_properties(self, properties, sent_state):
+        key = self.property_key
+        return [p for p in properties
+                if sent_state.get(p[key]) != digest_value(p['value'])]
+
+    def generate_sync_data(self, user, sent_state=None, run=None):
+        """
+        Build the payload for `user`. When `sent_state` is given, a dict mapping property
+        names to the digest of the value last sent to HubSpot (see
+        `hubbypy.sent_state.SentStateStore`), only the properties whose value has changed
+        are included.
+
+        `run` is a dict shared by every call in one sync run. Properties with the `run`
+        scope keep their values there. Without it they are computed on every call.
+        """
+
+        steps, tree = self.sync_plan
+        futures = self._submit_io_bound(steps, [user], run)
+        resolved = tree.resolve(user) if tree else {}
+        key = self.property_key
 
-        for prop in self._user_properties:
+        properties = []
+        for index, step in enumerate(steps):
+            name, accessor, func = step[:3]
+            if accessor is not None:
+                value = resolved.get(accessor)
+                if value is not None:
+                    value = func(value)
+            else:
+                value = self._evaluate(step, user, run, futures.get((index, 0)))
             properties.append(
                 {
-                    'property': prop.name,
-                    'value': prop.get_formatted_value(user)
+                    key: name,
+                    'value': value
                 }
             )
 
+        if sent_state is not None:
+            properties = self._changed_properties(properties, sent_state)
+
         return {
             'properties': properties
         }
+
+    def generate_bulk_sync_data(self, users, run=None, sent_states=None):
+        """
+        Build the payloads for a list of users at once. The result is exactly what calling
+        `generate_sync_data(user, sent_state, run=run)` for each user would give, but the
+        work is done a property at a time across all the users, which lets `date` and
+        `datetime` values be encoded a whole column at a time. `sent_states`, when given,
+        holds one sent state per user.
+        """
+        users = list(users)
+        steps, tree = self.sync_plan
+        futures = self._submit_io_bound(steps, users, run)
+        resolved = [tree.resolve(user) for user in users] if tree else None
+        key = self.property_key
+
+        names = []
+        columns = []
+        for index, (prop, step) in enumerate(zip(self._user_properties, steps)):
+            name, accessor = step[:2]
+            names.append(name)
+            if accessor is not None:
+                encode_column = prop._compile_column_encoder()
+                columns.append(encode_column([values.get(accessor) for values in resolved]))
+            else:
+                columns.append([
+                    self._evaluate(step, user, run, futures.get((index, user_index)))
+                    for user_index, user in enumerate(users)
+                ])
+
+        payloads = [
+            {
+                'properties': [
+                    {
+                        key: name,
+                        'value': value
+                    }
+                    for name, value in zip(names, row)
+                ]
+            }
+            for row in zip(*columns)
+        ] if columns else [{'properties': []} for _ in users]
+
+        if sent_states is not None:
+            for payload, sent_state in zip(payloads, sent_states):
+                if sent_state is not None:
+                    payload['properties'] = self._changed_properties(payload['properties'],
+                                                                     sent_state)
+
+        return payloads
@@ -0,0 +1,175 @@
+from datetime import date, datetime, timedelta, timezone
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover - numpy is optional
+    numpy = None
+
+EPOCH = datetime(1970, 1, 1)
+UTC_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+EPOCH_ORDINAL = EPOCH.toordinal()
+MILLISECOND = timedelta(milliseconds=1)
+MILLISECONDS_PER_DAY = 86400 * 1000
+
+
+def identity(value):
+    return value
+
+
+def encode_bool(value):
+    return 'true' if value else 'false'
+
+
+def datetime_to_unix(timestamp):
+    """
+    Milliseconds since the epoch for `timestamp`. Aware datetimes are converted through
+    UTC and naive ones are read as UTC, so the result never depends on the host's
+    timezone. Plain dates give midnight UTC on that day.
+    """
+    try:
+        tzinfo = timestamp.tzinfo
+    except AttributeError:
+        return date_to_unix(timestamp)
+    return (timestamp - (EPOCH if tzinfo is None else UTC_EPOCH)) // MILLISECOND
+
+
+def date_to_unix(thisdate):
+    """
+    Milliseconds since the epoch for midnight UTC on `thisdate`, which is what HubSpot
+    expects for `date` properties.
+    """
+    return (thisdate.toordinal() - EPOCH_ORDINAL) * MILLISECONDS_PER_DAY
+
+
+def encode_date(value):
+    """
+    Encode a `date` property value. Datetimes are reduced to their date and values of
+    other types are passed through.
+    """
+    if type(value) is datetime:
+        value = value.date()
+    elif type(value) is not date:
+        return value
+    return date_to_unix(value)
+
+
+def encode_datetime_column(values, encode=datetime_to_unix):
+    """
+    Encode a list of `datetime` property values at once, giving exactly what calling
+    `encode` on each value would. `None` stays `None`.
+
+    The common case, naive datetimes, is converted with a single subtraction each.
+    """
+    if encode is not datetime_to_unix:
+        return [encode(v) if v is not None else None for v in values]
+    encoded = []
+    for value in values:
+        if value is None:
+            encoded.append(None)
+        elif type(value) is datetime and value.tzinfo is None:
+            encoded.append((value - EPOCH) // MILLISECOND)
+        else:
+            encoded.append(datetime_to_unix(value))
+    return encoded
+
+
+def encode_date_column(values, encode=date_to_unix):
+    """
+    Encode a list of `date` property values at once, giving exactly what `encode_date`
+    would for each value, with `encode` turning each date into milliseconds. `None` stays
+    `None`.
+
+    With the default `encode` and NumPy installed, the dates are converted in one go.
+    Otherwise many users share the same dates, so each distinct date is only converted once.
+    """
+    encoded = []
+    date_positions = []
+    for value in values:
+        if type(value) is datetime:
+            value = value.date()
+        elif type(value) is not date:
+            encoded.append(value)
+            continue
+        date_positions.append(len(encoded))
+        encoded.append(value)
+    if numpy is not None and encode is date_to_unix and date_positions:
+        ordinals = numpy.fromiter((encoded[i].toordinal() for i in date_positions),
+                                  dtype=numpy.int64, count=len(date_positions))
+        millis = (ordinals - EPOCH_ORDINAL) * MILLISECONDS_PER_DAY
+        for position, unix in zip(date_positions, millis.tolist()):
+            encoded[position] = unix
+        return encoded
+    converted = {}
+    for position in date_positions:
+        value = encoded[position]
+        unix = converted.get(value)
+        if unix is None:
+            unix = converted[value] = encode(value)
+        encoded[position] = unix
+    return encoded
+
+
+def _map_column(encode):
+    def encode_column(values):
+        return [encode(v) if v is not None else None for v in values]
+    return encode_column
+
+
+class EncoderRegistry:
+    """
+    Maps a property's `native_type` to the function that turns its values into what
+    HubSpot expects. Properties look their encoder up once, when they are constructed, so
+    register encoders before defining the properties that use them.
+
+    An encoder is only ever called with values that are not `None`. A `column` encoder
+    may be registered alongside it to encode a whole list of values (which may include
+    `None`) at once, for `UserPropertyManager.generate_bulk_sync_data`. Without one, the
+    encoder is simply called on each value.
+
+    Native types without an encoder send their values as they are.
+
+    A native type that the properties don't know, e.g. `money`, is registered with the
+    `hs_type` HubSpot should store it as (`string`, `number`, `date`, `datetime` or
+    `enumeration`), and optionally the `field_type` HubSpot should show it with. For the
+    native types properties know, these override the usual mapping.
+    """
+
+    def __init__(self, encoders=None, types=None):
+        self._encoders = dict(encoders or {})
+        self._types = dict(types or {})
+
+    def register(self, native_type, encode, *, column=None, hs_type=None, field_type=None):
+        self._encoders[native_type] = (encode, column or _map_column(encode))
+        if hs_type is not None or field_type is not None:
+            self._types[native_type] = (hs_type, field_type)
+
+    def encoder(self, native_type):
+        return self._encoders.get(native_type, (identity, None))[0]
+
+    def column_encoder(self, native_type):
+        encode, column = self._encoders.get(native_type, (identity, None))
+        return column or _map_column(encode)
+
+    def hs_type(self, native_type):
+        return self._types.get(native_type, (None, None))[0]
+
+    def field_type(self, native_type):
+        return self._types.get(native_type, (None, None))[1]
+
+    def copy(self):
+        return EncoderRegistry(self._encoders, self._types)
+
+
+default_registry = EncoderRegistry()
+default_registry.register('bool', encode_bool)
+default_registry.register('date', encode_date, column=encode_date_column)
+default_registry.register('datetime', datetime_to_unix, column=encode_datetime_column)
+
+
+def register_encoder(native_type, encode, *, column=None, hs_type=None, field_type=None):
+    """
+    Register `encode` for `native_type` in the default registry, which every property
+    uses unless it is given its own `encoders`.
+    """
+    default_registry.register(native_type, encode, column=column, hs_type=hs_type,
+                              field_type=field_type)
@@ -1,144 +1,1270 @@
+import itertools
 import json
 import logging
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import body_size, endpoint_name
+from .contact_properties import user_identity
+from .cursors import CacheCursorStore, RecentContactsCursor
+from .json_codec import default_codec
+from .rate_limit import (CacheRateLimiter, TokenBucket, backoff_delay, parse_rate_limit_headers,
+                         parse_retry_after)
+from .schema_sync import plan_group_operations, plan_property_operations, schema_phases
+from .sent_state import digest_properties
+from .vid_index import contact_email
 
 logger = logging.getLogger(__name__)
 
+sentinel = object()
+
 BASE_URL = "https://api.hubapi.com"
 
 CONTACTS_URL = BASE_URL + "/contacts/v1/contact"
+BATCH_CONTACTS_URL = CONTACTS_URL + "/batch/"
+CONTACT_BY_VID_URL = CONTACTS_URL + "/vid/{}/profile"
+ALL_CONTACTS_URL = BASE_URL + "/contacts/v1/lists/all/contacts/all"
+RECENT_CONTACTS_URL = BASE_URL + "/contacts/v1/lists/recently_updated/contacts/recent"
+# How far back HubSpot's recently updated contacts feed goes
+RECENT_CONTACTS_DAYS = 30
+PROPERTY_GROUPS_URL = BASE_URL + "/properties/v1/contacts/groups"
+PROPERTIES_URL = BASE_URL + "/properties/v1/contacts/properties"
+
+# The request and log message for each kind of `SchemaOperation`
+SCHEMA_OPERATIONS = {
+    'create_group': ('post', PROPERTY_GROUPS_URL,
+                     'Creating new contact property group %s'),
+    'update_group': ('put', PROPERTY_GROUPS_URL + '/named/{}',
+                     'Updating existing contact property group %s'),
+    'create_property': ('post', PROPERTIES_URL,
+                        'Creating contact property %s'),
+    'update_property': ('put', PROPERTIES_URL + '/named/{}',
+                        'Updating existing contact property %s'),
+    'delete_property': ('delete', PROPERTIES_URL + '/named/{}',
+                        'Deleting unused contact property %s'),
+}
 COMPANIES_URL = BASE_URL + "/companies/v2/companies"
+BATCH_COMPANIES_URL = BASE_URL + "/companies/v1/batch-async/update"
+ASSOCIATIONS_URL = BASE_URL + "/crm-associations/v1/associations"
+# HubSpot's id for the association of a contact with the company it belongs to
+CONTACT_TO_COMPANY_DEFINITION = 1
+
+# HubSpot accepts at most 100 contacts per batch call. The payload size cap is our own,
+# to keep individual requests well clear of the API's request body limit.
+MAX_BATCH_SIZE = 100
+MAX_BATCH_BYTES = 1000000
+# The most contacts HubSpot returns per page when listing contacts
+MAX_PAGE_SIZE = 100
+
+# Responses worth retrying: we were throttled, or HubSpot had a transient problem
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+# Methods that are safe to send again after a 5xx, when HubSpot may already have acted on
+# the first attempt. Other requests say so with `idempotent=True`.
+IDEMPOTENT_METHODS = frozenset(['get', 'head', 'options', 'put', 'delete'])
+
+
+class RecordChunker:
+    """
+    Collects JSON-serializable records into chunks that hold no more than `max_count`
+    records and serialize to no more than `max_bytes`. A single record that is larger than
+    `max_bytes` on its own gets a chunk to itself.
+
+    `add` returns the previous chunk when the new record does not fit in it, and `flush`
+    returns whatever is left at the end. Records are measured with `dumps`, which should
+    be the function that will encode them for the request, e.g. `HubSpot.codec.dumps`.
+    """
+
+    def __init__(self, *, max_count=MAX_BATCH_SIZE, max_bytes=MAX_BATCH_BYTES,
+                 dumps=json.dumps):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.dumps = dumps
+        self._chunk = []
+        self._chunk_bytes = 2  # the enclosing brackets
+
+    def add(self, record):
+        full_chunk = None
+        # ", " separates records in the serialized list, or just "," when compact
+        record_bytes = len(self.dumps(record)) + (2 if self._chunk else 0)
+        if self._chunk and (len(self._chunk) >= self.max_count or
+                            self._chunk_bytes + record_bytes > self.max_bytes):
+            full_chunk = self.flush()
+            record_bytes -= 2
+        if self._chunk_bytes + record_bytes > self.max_bytes:
+            logger.warning('[HUBSPOT] batch record of %s bytes exceeds max_bytes of %s',
+                           record_bytes, self.max_bytes)
+        self._chunk.append(record)
+        self._chunk_bytes += record_bytes
+        return full_chunk
+
+    def flush(self):
+        chunk = self._chunk or None
+        self._chunk = []
+        self._chunk_bytes = 2
+        return chunk
+
+
+def chunk_records(records, *, max_count=MAX_BATCH_SIZE, max_bytes=MAX_BATCH_BYTES,
+                  dumps=json.dumps):
+    """
+    Split an iterable of JSON-serializable records into lists as described in
+    `RecordChunker`. Records are consumed lazily, so this works on generators of any length.
+    """
+    chunker = RecordChunker(max_count=max_count, max_bytes=max_bytes, dumps=dumps)
+    for record in records:
+        chunk = chunker.add(record)
+        if chunk:
+            yield chunk
+    chunk = chunker.flush()
+    if chunk:
+        yield chunk
+
+
+def read_ahead(iterable, depth=1):
+    """
+    Iterate over `iterable` in a background thread, keeping up to `depth` items ready
+    ahead of the caller. The thread only reads an item once there is room for it, so
+    together with the item the caller is working on, at most `depth + 1` are held at a
+    time. Exceptions are raised in the caller when it reaches them. If the caller stops
+    early, the thread stops before reading another item.
+    """
+    items = queue.Queue()
+    slots = threading.Semaphore(depth)
+    stop = threading.Event()
+
+    def wait_for_slot():
+        while not stop.is_set():
+            if slots.acquire(timeout=0.1):
+                return True
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            while wait_for_slot():
+                item = next(iterator, sentinel)
+                items.put((item, None))
+                if item is sentinel:
+                    return
+        except Exception as e:
+            items.put((sentinel, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is sentinel:
+                if error is not None:
+                    raise error
+                return
+            # the caller holds this item now, so the thread may read the next one
+            slots.release()
+            yield item
+    finally:
+        stop.set()
 
 
 class HubSpot:
 
     api_key = None
 
-    cache_key = 'hub_api_calls'
-
     user_property_manager = None
 
-    def __init__(self, *, api_key, user_property_manager, cache_backend):
+    cache_key = 'hub_api_calls'
+
+    def __init__(self, *, api_key, user_property_manager, cache_backend=None,
+                 rate_limiter=None, pool_size=10, timeout=(5, 30), max_retries=3,
+                 backoff_base=0.5, backoff_cap=30, sent_state_store=None, metrics=None,
+                 outbox=None, company_property_manager=None, vid_index=None, codec=None):
+        """
+        - `cache_backend`: a Django style cache. When it supports atomic `add` and `incr`,
+          and `touch`, and no `rate_limiter` is given, the rate limit is kept there under
+          `cache_key`, shared by every process using the cache. It also stores recent
+          contacts cursors.
+        - `rate_limiter`: a `hubbypy.rate_limit.RateLimiter`. Defaults to a
+          `CacheRateLimiter` on `cache_backend`, or else an in-process `TokenBucket`; use a
+          `SQLiteTokenBucket` when several processes on one host share an API key.
+        - `pool_size`: the number of keep-alive connections the shared session keeps open to
+          HubSpot. Raise it if you call the client from more threads than that.
+        - `timeout`: the default `requests` timeout, either a number of seconds or a
+          `(connect, read)` tuple. It can be overridden per call by passing `timeout`
+          to `request`.
+        - `max_retries`: how many times to retry a request that was throttled (429) or hit a
+          5xx error. Retries wait as long as HubSpot's `Retry-After` asks, or back off
+          exponentially from `backoff_base` seconds up to `backoff_cap` seconds, with jitter.
+        - `sent_state_store`: a `hubbypy.sent_state.SentStateStore`. When given, syncing a
+          user only sends the properties that changed since they were last pushed
+          successfully, and makes no call at all when nothing changed.
+        - `metrics`: a `hubbypy.metrics.Metrics`, told about every HTTP attempt, retry and
+          rate limiter wait, and about the time spent building contact payloads. Use a
+          `MetricsCollector` to aggregate them in process.
+        - `outbox`: a `hubbypy.outbox.Outbox`. `enqueue_user` queues users there, and
+          `drain_outbox` sends what is queued in batches.
+        - `company_property_manager`: a `hubbypy.company_properties.CompanyPropertyManager`,
+          needed to sync companies.
+        - `vid_index`: a `hubbypy.vid_index.VidIndex`, filled with the vids HubSpot returns
+          when contacts are created or exported. Contacts it knows are then written by vid,
+          individually and in batches, instead of by email.
+        - `codec`: a `hubbypy.json_codec.JSONCodec` that encodes request payloads to bytes
+          and parses response bodies. Defaults to the fastest one installed, see
+          `default_codec`.
+        """
         self.api_key = api_key
         self.cache_backend = cache_backend
         self.user_property_manager = user_property_manager
+        self.rate_limiter = rate_limiter or self._default_rate_limiter(cache_backend)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.daily_remaining = None
+        self.sent_state_store = sent_state_store
+        self.metrics = metrics
+        self.outbox = outbox
+        self.company_property_manager = company_property_manager
+        self.vid_index = vid_index
+        self.codec = codec or default_codec()
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def _default_rate_limiter(self, cache_backend):
+        if cache_backend is None:
+            return TokenBucket()
+        if all(hasattr(cache_backend, name) for name in ('add', 'incr', 'touch')):
+            return CacheRateLimiter(cache_backend, key=self.cache_key)
+        logger.warning('[HUBSPOT] cache_backend has no atomic add and incr, or no touch, so '
+                       'calls are only rate limited within this process. Pass a rate_limiter '
+                       'to share the limit between processes.')
+        return TokenBucket()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _build_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({'content-type': 'application/json',
+                                'connection': 'keep-alive'})
+        session.params.update({'hapikey': self.api_key})
+        return session
 
     @property
     def client(self):
-        client = requests.Session()
-        client.headers.update({'content-type': 'application/json'})
-        client.params.update({'hapikey': self.api_key})
-        return client
+        """
+        A single `requests.Session` shared by every call made through this instance, so
+        that connections to HubSpot are pooled and kept alive rather than re-established
+        on every request. The session is created lazily and is safe to share between threads.
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._build_session()
+        return self._session
 
-    def request(self, method, url, params={}, **kwargs):
+    def close(self):
+        """
+        Close the pooled connections. The next request will open a fresh session.
+        """
+        with self._session_lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
+
+    def request(self, method, url, params={}, idempotent=None, **kwargs):
         """
         Make a request without violating HubSpot's rate limit of 10 requests per second.
 
-        We err on the safe side and sleep when there are 8 within the last 10 seconds.
+        The limiter follows the rate limit headers on each response, and requests that are
+        throttled are retried up to `max_retries` times. Requests that fail with a 5xx are
+        retried too when they are `idempotent`, which by default only GET, PUT and DELETE
+        requests are: a POST that creates something may have gone through before the
+        error, and sending it again would create a duplicate.
+
+        A `json` payload is encoded with `codec`, and `response.json()` parses the body
+        with it once and then returns the same object on later calls.
         """
-        now = time.time()
-        recent_calls = self.cache_backend.get(self.cache_key)
-        if recent_calls:
-            recent_calls = [t for t in recent_calls if now - t <= 10]
-            if len(recent_calls) >= 8:
-                time_to_sleep = min([abs(10.1 - (now - recent_calls[0])), 10])
+        kwargs.setdefault('timeout', self.timeout)
+        self._encode_json(kwargs)
+        idempotent = self._is_idempotent(method, idempotent)
+        metrics = self.metrics
+        attempt = 0
+        while True:
+            time_to_sleep = self.rate_limiter.reserve()
+            if time_to_sleep:
                 logger.info('[HUBSPOT] sleeping for {} seconds '.format(time_to_sleep) +
                             'to avoid exceeding rate limits')
+                if metrics is not None:
+                    metrics.rate_limit_wait(time_to_sleep)
                 time.sleep(time_to_sleep)
-        if not recent_calls:
-            recent_calls = []
-        recent_calls.append(time.time())
-        self.cache_backend.set(self.cache_key, recent_calls)
-        return self.client.request(method, url, params=params, **kwargs)
+            started = time.perf_counter()
+            response = self.client.request(method, url, params=params, **kwargs)
+            if metrics is not None:
+                self._record_request(method, url, response, time.perf_counter() - started)
+            retry_delay = self._retry_delay(response, attempt, idempotent)
+            if retry_delay is None:
+                return self._decode_once(response)
+            if metrics is not None:
+                self._record_retry(method, url, response, retry_delay)
+            if retry_delay:
+                time.sleep(retry_delay)
+            attempt += 1
+
+    @staticmethod
+    def _is_idempotent(method, idempotent):
+        if idempotent is None:
+            return method.lower() in IDEMPOTENT_METHODS
+        return idempotent
+
+    def _encode_json(self, kwargs):
+        payload = kwargs.pop('json', None)
+        if payload is not None:
+            kwargs['data'] = self.codec.dumps(payload)
+
+    def _decode_once(self, response):
+        """
+        Make `response.json()` parse the body with our codec, and only the first time it is
+        called. The parsed body is shared between callers, so treat it as read-only. A body
+        that is not JSON raises `requests.exceptions.JSONDecodeError`, whichever codec
+        failed to parse it, just as `requests` does.
+        """
+        if not isinstance(response, requests.Response):
+            return response
+        loads = self.codec.loads
+        parsed = []
+
+        def parse_json(**kwargs):
+            if not parsed:
+                try:
+                    parsed.append(loads(response.content))
+                except ValueError as err:
+                    raise requests.exceptions.JSONDecodeError(
+                        str(err), response.text, getattr(err, 'pos', 0)) from err
+            return parsed[0]
+
+        response.json = parse_json
+        return response
+
+    def _record_request(self, method, url, response, duration):
+        request = getattr(response, 'request', None)
+        self.metrics.http_request(
+            method=method,
+            endpoint=endpoint_name(url),
+            status_code=getattr(response, 'status_code', None),
+            duration=duration,
+            bytes_sent=body_size(getattr(request, 'body', None)),
+            bytes_received=body_size(getattr(response, 'content', None)),
+        )
+
+    def _record_retry(self, method, url, response, delay):
+        self.metrics.retry(method=method, endpoint=endpoint_name(url),
+                           status_code=getattr(response, 'status_code', None), delay=delay)
+
+    def _retry_delay(self, response, attempt, idempotent=True):
+        """
+        Update the rate limiter from `response`'s headers, then decide whether to retry.
+        Only 429s are retried when the request is not `idempotent`.
+        Returns `None` when the response should be returned to the caller, otherwise the
+        number of seconds to sleep before trying again.
+        """
+        headers = getattr(response, 'headers', None)
+        if headers is not None:
+            limits = parse_rate_limit_headers(headers)
+            if limits['daily_remaining'] is not None:
+                self.daily_remaining = limits['daily_remaining']
+                if not self.daily_remaining:
+                    logger.warning('[HUBSPOT] the daily API call limit has been reached')
+            if limits['max_calls'] or limits['period'] or limits['remaining'] is not None:
+                self.rate_limiter.update(max_calls=limits['max_calls'],
+                                         period=limits['period'],
+                                         remaining=limits['remaining'])
+
+        status_code = getattr(response, 'status_code', None)
+        if status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+            return None
+        if status_code != 429 and not idempotent:
+            logger.warning('[HUBSPOT] got a %s response, not retrying a request that may '
+                           'already have been applied', status_code)
+            return None
+
+        delay = backoff_delay(attempt, base=self.backoff_base, cap=self.backoff_cap,
+                              retry_after=parse_retry_after(headers) if headers else None)
+        logger.warning('[HUBSPOT] got a %s response, retrying in %.2f seconds',
+                       status_code, delay)
+        if status_code == 429:
+            # hold back every caller sharing the limiter; our retry waits in line with them
+            self.rate_limiter.pause(delay)
+            return 0
+        return delay
 
     # sync user methods
     def sync_user(self, user):
+        """
+        Create or update `user`'s contact in HubSpot and return the parsed response. Returns
+        `None` without calling HubSpot when a `sent_state_store` shows nothing has changed.
+        """
+        data = self._sync_data(user)
+        if data is None:
+            return None
+        response, body = self._upsert_contact(user.email, data)
+        if response is not None and self._is_success(response):
+            self._remember_sent(user.email, data['properties'])
+        return body
+
+    def sync_users(self, users, *, batch_size=MAX_BATCH_SIZE, max_batch_bytes=MAX_BATCH_BYTES):
+        """
+        Sync many users through HubSpot's batch contact endpoint. Payloads are built
+        `batch_size` users at a time with the user property manager's
+        `generate_bulk_sync_data`, and sent in chunks limited by both `batch_size` and
+        `max_batch_bytes`.
+
+        Returns a list with one result dict per user, in the order the users were given.
+        See `batch_create_or_update_contacts` for the shape of each result. Users that a
+        `sent_state_store` shows to be unchanged are not sent, and their result has
+        `skipped` set.
+
+        The whole call is one sync run, so `FunctionProperty`s with the `run` scope are
+        evaluated once per run (or once per user) rather than for every payload.
+        """
+        results = []
+        # the index in `results` of each record we send, in the order they are sent
+        positions = []
+        run = {}
+
+        def records():
+            for user, record in self._contact_records(users, run, batch_size):
+                if record is None:
+                    results.append(self._batch_result({'email': user.email}, None,
+                                                      skipped=True))
+                else:
+                    positions.append(len(results))
+                    results.append(None)
+                    yield record
+
+        sent = 0
+        for chunk in chunk_records(records(), max_count=batch_size, max_bytes=max_batch_bytes,
+                                   dumps=self.codec.dumps):
+            chunk_results = self.batch_create_or_update_contacts(chunk)
+            self._remember_batch(chunk, chunk_results)
+            for result in chunk_results:
+                results[positions[sent]] = result
+                sent += 1
+        return results
+
+    def sync_stream(self, users, *, batch_size=MAX_BATCH_SIZE, max_batch_bytes=MAX_BATCH_BYTES,
+                    max_pending=2):
+        """
+        Sync any number of users, e.g. from a Django `QuerySet.iterator()`, in bounded
+        memory. This is a generator that yields the same result dicts as `sync_users`, one
+        per user and in the same order, as soon as they are known.
+
+        Payloads are built in the calling thread, so ORM access stays where the caller
+        expects it, while a background thread sends finished batches through the rate
+        limiter. At most `max_pending` batches wait to be sent; once that many are queued,
+        building pauses until the sender catches up. Memory use therefore depends on the
+        batch size, not on the number of users. For the same reason, `run` scoped values
+        kept per user are only reused within the batch they were built for.
+        """
+        run = {}
+        chunker = RecordChunker(max_count=batch_size, max_bytes=max_batch_bytes,
+                                dumps=self.codec.dumps)
+        # sequence numbers of the records in the chunk being built
+        chunk_sequences = []
+        # results that are ready but cannot be yielded until earlier ones are
+        ready = {}
+        max_ready = batch_size * (max_pending + 2)
+
+        send_queue = queue.Queue(maxsize=max_pending)
+        result_queue = queue.Queue()
+        stop = threading.Event()
+        sender = threading.Thread(target=self._send_stream,
+                                  args=(send_queue, result_queue, stop), daemon=True)
+        sender.start()
+
+        next_sequence = 0
+        in_flight = 0
+        try:
+            contact_records = itertools.chain(self._contact_records(users, run, batch_size,
+                                                                    shared_only=True),
+                                              [(sentinel, None)])
+            for sequence, (user, record) in enumerate(contact_records):
+                if user is sentinel:
+                    chunk = chunker.flush()
+                else:
+                    chunk = None
+                    if record is None:
+                        ready[sequence] = self._batch_result({'email': user.email}, None,
+                                                             skipped=True)
+                    else:
+                        chunk = chunker.add(record)
+                if chunk:
+                    # blocks while max_pending chunks are waiting for the sender
+                    send_queue.put((chunk_sequences[:len(chunk)], chunk))
+                    del chunk_sequences[:len(chunk)]
+                    in_flight += 1
+                if user is not sentinel and record is not None:
+                    chunk_sequences.append(sequence)
+                if not in_flight and chunk_sequences and len(ready) >= max_ready:
+                    # results are piling up behind a chunk that is slow to fill, e.g. when
+                    # most users are unchanged; send it as it is
+                    send_queue.put((chunk_sequences[:], chunker.flush()))
+                    del chunk_sequences[:]
+                    in_flight += 1
+
+                # wait for the sender when results are piling up behind a slow batch, and
+                # at the very end
+                block = user is sentinel or len(ready) >= max_ready
+                while in_flight:
+                    try:
+                        self._collect_stream_results(result_queue, ready, block=block)
+                    except queue.Empty:
+                        break
+                    in_flight -= 1
+                    block = user is sentinel
+                while next_sequence in ready:
+                    yield ready.pop(next_sequence)
+                    next_sequence += 1
+        finally:
+            stop.set()
+            try:
+                send_queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+    @staticmethod
+    def _collect_stream_results(result_queue, ready, block):
+        chunk_sequences, results = result_queue.get(block=block)
+        if isinstance(results, Exception):
+            raise results
+        ready.update(zip(chunk_sequences, results))
+
+    def _send_stream(self, send_queue, result_queue, stop):
+        while not stop.is_set():
+            item = send_queue.get()
+            if item is None:
+                break
+            chunk_sequences, chunk = item
+            try:
+                results = self.batch_create_or_update_contacts(chunk)
+                self._remember_batch(chunk, results)
+            except Exception as err:
+                results = err
+            result_queue.put((chunk_sequences, results))
+
+    def enqueue_user(self, user):
+        """
+        Queue `user`'s current payload in the outbox instead of sending it. Repeated calls
+        for the same contact are coalesced, so only the latest value of each property is
+        sent when the outbox is drained. Cheap enough to call from a model's save signal.
+        """
+        if self.outbox is None:
+            raise ValueError('HubSpot needs an outbox to enqueue users')
         data = self.user_property_manager.generate_sync_data(user)
-        resp = self.create_or_update_contact(user.email, data)
-        return resp
+        self.outbox.enqueue(user.email, data['properties'])
+
+    def drain_outbox(self, *, batch_size=MAX_BATCH_SIZE, max_batches=None, lease=300,
+                     retry_delay=60):
+        """
+        Send what is queued in the outbox through the batch contact endpoint, claiming up
+        to `batch_size` contacts at a time, until it is empty or `max_batches` batches
+        have been claimed. Entries that fail are released, to be tried again after
+        `retry_delay` seconds by a later drain. With a `sent_state_store`, only the
+        properties that changed are sent.
+
+        Returns one result dict per contact, as `batch_create_or_update_contacts` does.
+        """
+        if self.outbox is None:
+            raise ValueError('HubSpot needs an outbox to drain')
+        results = []
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            entries = self.outbox.claim(limit=batch_size, lease=lease)
+            if not entries:
+                break
+            batches += 1
+            to_send = self._outbox_changes(entries, results)
+            records = [{'email': entry.email, 'properties': properties}
+                       for entry, properties in to_send]
+            sent = 0
+            for chunk in chunk_records(records, max_count=batch_size, dumps=self.codec.dumps):
+                for record, result in zip(chunk, self.batch_create_or_update_contacts(chunk)):
+                    self._settle_outbox_entry(to_send[sent][0], record, result, retry_delay)
+                    sent += 1
+                    results.append(result)
+        return results
+
+    def _outbox_changes(self, entries, results):
+        """
+        `(entry, properties to send)` for each claimed entry that has something to send.
+        Entries a `sent_state_store` shows to be unchanged are acked, and their skipped
+        result added to `results`.
+        """
+        to_send = []
+        for entry in entries:
+            properties = entry.properties
+            if self.sent_state_store is not None:
+                properties = self.user_property_manager._changed_properties(
+                    properties, self.sent_state_store.get(entry.email) or {})
+            if properties:
+                to_send.append((entry, properties))
+            else:
+                self.outbox.ack(entry)
+                results.append(self._batch_result({'email': entry.email}, None,
+                                                  skipped=True))
+        return to_send
+
+    def _settle_outbox_entry(self, entry, record, result, retry_delay):
+        if result['success']:
+            self._remember_sent(record['email'], record['properties'])
+            self.outbox.ack(entry)
+        else:
+            logger.warning('[HUBSPOT][OUTBOX] sending %s failed: %s',
+                           entry.email, result['error'])
+            self.outbox.release(entry, result['error'], delay=retry_delay)
+
+    def _sync_data(self, user, run=None):
+        """
+        The payload for `user`, or `None` when a `sent_state_store` shows it is unchanged.
+        """
+        sent_state = None
+        if self.sent_state_store is not None:
+            sent_state = self.sent_state_store.get(user.email) or {}
+        started = time.perf_counter()
+        data = self.user_property_manager.generate_sync_data(user, sent_state=sent_state,
+                                                             run=run)
+        if self.metrics is not None:
+            self.metrics.payloads_built(1, time.perf_counter() - started)
+        if sent_state is not None and not data['properties']:
+            logger.debug('[HUBSPOT] skipping sync of unchanged contact %s', user.email)
+            return None
+        return data
+
+    def _contact_records(self, users, run, slice_size, shared_only=False):
+        """
+        Yield a `(user, record)` pair for each of `users`, where `record` is the batch
+        payload for the user or `None` when a `sent_state_store` shows it is unchanged.
+        Payloads are built `slice_size` users at a time with `generate_bulk_sync_data`.
+
+        With `shared_only`, the values `run` keeps per user are dropped after each slice,
+        so it only grows with the values shared by the whole run.
+        """
+        users = iter(users)
+        while True:
+            pairs = self._contact_slice(users, run, slice_size, shared_only)
+            if not pairs:
+                return
+            yield from pairs
+
+    def _contact_slice(self, users, run, slice_size, shared_only=False):
+        """
+        The `(user, record)` pairs for the next `slice_size` users taken from the iterator
+        `users`, as yielded by `_contact_records`. Empty once `users` is exhausted.
+        """
+        user_slice = list(itertools.islice(users, slice_size))
+        if not user_slice:
+            return []
+        sent_states = None
+        if self.sent_state_store is not None:
+            sent_states = [self.sent_state_store.get(user.email) or {} for user in user_slice]
+        started = time.perf_counter()
+        payloads = self.user_property_manager.generate_bulk_sync_data(
+            user_slice, run=run, sent_states=sent_states)
+        if self.metrics is not None:
+            self.metrics.payloads_built(len(user_slice), time.perf_counter() - started)
+        if shared_only:
+            self._drop_per_user_values(run)
+        pairs = []
+        for user, record in zip(user_slice, payloads):
+            if sent_states is not None and not record['properties']:
+                logger.debug('[HUBSPOT] skipping sync of unchanged contact %s', user.email)
+                pairs.append((user, None))
+            else:
+                record['email'] = user.email
+                pairs.append((user, record))
+        return pairs
+
+    @staticmethod
+    def _drop_per_user_values(run):
+        """
+        Remove the values `run` holds under a user's run key, keeping the ones shared by
+        every user (run key `None`).
+        """
+        for cache_key in [k for k in run if k[1] is not None]:
+            del run[cache_key]
+
+    def _remember_sent(self, key, properties):
+        if self.sent_state_store is not None and properties:
+            self.sent_state_store.update(key, digest_properties(properties))
+
+    def _remember_batch(self, records, results):
+        """
+        Remember what was sent for each of the batch `records` whose result succeeded.
+        """
+        for record, result in zip(records, results):
+            if result['success']:
+                self._remember_sent(record['email'], record['properties'])
+
+    @staticmethod
+    def _is_success(response):
+        status_code = getattr(response, 'status_code', None)
+        return status_code is not None and 200 <= status_code < 300
 
     # contact methods
     def create_or_update_user(self, user, user_data):
-        if not user.crm_unique_id:
-            url = "{}/createOrUpdate/email/{}".format(CONTACTS_URL, user.email)
-            response = self.request('post', url, json=user_data)
+        vid = getattr(user, 'crm_unique_id', None)
+        if not vid:
+            # by indexed vid when we have one, falling back to email if it went stale
+            response, body = self._upsert_contact(user.email, user_data)
             if response is not None:
-                if hasattr(user, 'crm_unique_id'):
-                    user.crm_unique_id = response.json()['vid']
+                if hasattr(user, 'crm_unique_id') and self._is_success(response):
+                    user.crm_unique_id = body['vid']
                     user.save()
-                return response.json()
+                return body
         else:
             response = self.request(
                 'post',
-                BASE_URL + '/contacts/v1/contact/vid/%s/profile' % user.crm_unique_id,
-                data=json.dump(user_data)
+                CONTACT_BY_VID_URL.format(vid),
+                data=self.codec.dumps(user_data),
+                idempotent=True
             )
             return response
 
     # contact methods
     def create_or_update_contact(self, email, user_data):
+        return self._upsert_contact(email, user_data)[1]
+
+    def _upsert_contact(self, email, data):
+        """
+        Create or update the contact with `email`, by vid when the `vid_index` knows it.
+        Returns the response and its parsed body. Updates by vid get no body from HubSpot,
+        so theirs is made to look like the email endpoint's, `{'vid': 51, 'isNew': False}`.
+        """
+        vid = self._indexed_vid(email)
+        if vid is not None:
+            response = self.request('post', CONTACT_BY_VID_URL.format(vid), json=data,
+                                    idempotent=True)
+            if not self._stale_vid(email, response):
+                return response, self._vid_body(vid, response)
         url = "{}/createOrUpdate/email/{}".format(CONTACTS_URL, email)
-        response = self.request('post', url, json=user_data)
-        if response is not None:
-            return response.json()
+        response = self.request('post', url, json=data, idempotent=True)
+        return response, self._upsert_body(email, response)
+
+    def _indexed_vid(self, email):
+        if self.vid_index is None or not email:
+            return None
+        return self.vid_index.get(email)
+
+    def _stale_vid(self, email, response):
+        """
+        Forget `email`'s vid when HubSpot no longer has a contact with it, e.g. after a
+        merge, so that we go back to the email endpoint.
+        """
+        if getattr(response, 'status_code', None) != 404:
+            return False
+        logger.info('[HUBSPOT] contact vid for %s no longer exists, updating by email', email)
+        self.vid_index.delete(email)
+        return True
+
+    def _upsert_body(self, email, response):
+        if response is None:
+            return None
+        body = response.json()
+        if self.vid_index is not None and self._is_success(response):
+            self.vid_index.set(email, body['vid'])
+        return body
+
+    def _vid_body(self, vid, response):
+        if response is None:
+            return None
+        if self._is_success(response):
+            return {'vid': vid, 'isNew': False}
+        return response.json()
+
+    def _index_contacts(self, body):
+        """
+        Remember the vid of every contact in a page from a contact list endpoint.
+        """
+        if self.vid_index is None:
+            return
+        pairs = []
+        for contact in body.get('contacts') or []:
+            email = contact_email(contact)
+            if email:
+                pairs.append((email, contact['vid']))
+        self.vid_index.set_many(pairs)
+
+    def _address_by_vid(self, contacts):
+        """
+        The batch payload for `contacts`, each addressed by vid when the `vid_index` knows
+        it, and by email otherwise.
+        """
+        if self.vid_index is None:
+            return contacts
+        addressed = []
+        for contact in contacts:
+            vid = self._indexed_vid(contact.get('email'))
+            addressed.append(contact if vid is None else
+                             {'vid': vid, 'properties': contact['properties']})
+        return addressed
+
+    def _forget_failed_vids(self, addressed, results):
+        """
+        Forget the vids of contacts that failed when sent by vid, so the next attempt goes
+        by email.
+        """
+        for record, result in zip(addressed, results):
+            if 'vid' in record and not result['success'] and result['email']:
+                self.vid_index.delete(result['email'])
+
+    def batch_create_or_update_contacts(self, contacts):
+        """
+        Create or update up to 100 contacts in one call. Each item of `contacts` is a dict
+        with an `email` and a `properties` list, as built by `generate_sync_data`. Contacts
+        whose vid is in the `vid_index` are sent by vid instead.
+
+        HubSpot rejects the whole batch when any contact in it is invalid, but tells us
+        which ones were at fault. Those are reported as failures and the rest of the batch
+        is sent again. Returns one dict per contact, in order, with the keys `email`,
+        `success`, `status_code`, `error` and `skipped`.
+        """
+        results = [None] * len(contacts)
+        addressed = self._address_by_vid(contacts)
+        pending = list(range(len(contacts)))
+        while pending:
+            response = self.request('post', BATCH_CONTACTS_URL,
+                                    json=[addressed[i] for i in pending], idempotent=True)
+            pending = self._apply_batch_response(contacts, pending, results, response)
+        if addressed is not contacts:
+            self._forget_failed_vids(addressed, results)
+        return results
+
+    def _apply_batch_response(self, contacts, pending, results, response):
+        """
+        Record the outcome of sending the `pending` indexes of `contacts` in `results` and
+        return the indexes that should be sent again.
+        """
+        status_code = getattr(response, 'status_code', None)
+        if self._is_success(response):
+            for i in pending:
+                results[i] = self._batch_result(contacts[i], status_code)
+            return []
+        errors = self._batch_errors([contacts[i] for i in pending], response)
+        for position, i in enumerate(pending):
+            if position in errors:
+                results[i] = self._batch_result(contacts[i], status_code, errors[position])
+        if not errors or len(errors) == len(pending):
+            error = self._response_message(response)
+            for i in pending:
+                if results[i] is None:
+                    results[i] = self._batch_result(contacts[i], status_code, error)
+            return []
+        return [i for position, i in enumerate(pending) if position not in errors]
+
+    @staticmethod
+    def _batch_result(contact, status_code, error=None, skipped=False):
+        return {
+            'email': contact.get('email'),
+            'success': error is None,
+            'status_code': status_code,
+            'error': error,
+            'skipped': skipped,
+        }
+
+    @staticmethod
+    def _response_message(response, default='HubSpot rejected the batch'):
+        try:
+            return response.json().get('message') or default
+        except Exception:
+            return default
+
+    @staticmethod
+    def _batch_errors(batch, response):
+        """
+        Map positions within `batch` to the error HubSpot reported for that contact.
+        """
+        try:
+            body = response.json()
+        except Exception:
+            return {}
+        if not isinstance(body, dict):
+            return {}
+        errors = {}
+        for failure in body.get('failureMessages') or []:
+            index = failure.get('index')
+            if isinstance(index, int) and 0 <= index < len(batch):
+                errors[index] = (failure.get('error') or {}).get('message') or str(failure)
+        invalid_emails = set(body.get('invalidEmails') or [])
+        for index, contact in enumerate(batch):
+            if index not in errors and contact.get('email') in invalid_emails:
+                errors[index] = 'Invalid email address'
+        return errors
+
+    # reading contacts
+    def iter_contacts(self, properties=None, *, page_size=MAX_PAGE_SIZE, prefetch=False):
+        """
+        Yield every contact in the portal, one page of `page_size` at a time, as dicts like
+        `{'vid': 51, 'properties': {'email': 'jane@example.com', 'firstname': 'Jane'}}`.
+
+        Pass the names of the `properties` you need: HubSpot then only sends those, which
+        keeps pages small. Without them it sends its default handful of properties.
+
+        With `prefetch`, the next page is fetched in a background thread while the caller
+        works through the current one. Only one page is read ahead, so at most two pages
+        are held in memory, against one without `prefetch`.
+        """
+        for page in self.iter_contact_pages(properties, page_size=page_size,
+                                            prefetch=prefetch):
+            yield from page
+
+    def iter_contact_pages(self, properties=None, *, page_size=MAX_PAGE_SIZE, prefetch=False):
+        """
+        Like `iter_contacts`, but yields a list of contacts per page.
+        """
+        pages = self._contact_pages(ALL_CONTACTS_URL, self._contact_params(properties, page_size))
+        return read_ahead(pages) if prefetch else pages
+
+    def iter_recent_contacts(self, properties=None, *, cursor_store=None,
+                             page_size=MAX_PAGE_SIZE, overlap=60):
+        """
+        Yield the contacts modified since the last run, newest first, from HubSpot's
+        recently updated contacts feed. Contacts look like those from `iter_contacts`, and
+        always include `lastmodifieddate`.
+
+        The cursor is kept in `cursor_store`, a `hubbypy.cursors.CursorStore`, or by
+        default in `cache_backend`. It is only saved once every contact has been yielded,
+        so a run that fails or is stopped early is read again in full next time. See
+        `RecentContactsCursor` for how `overlap` avoids gaps and duplicates.
+
+        The first run yields everything in the feed. HubSpot only keeps the last 30 days
+        there, so take a full export with `iter_contacts` when starting out or after a
+        long break.
+        """
+        cursor_store = self._cursor_store(cursor_store)
+        cursor = RecentContactsCursor(cursor_store.get(), overlap=overlap)
+        params = self._contact_params(self._with_timestamp(properties), page_size)
+        for page in self._contact_pages(RECENT_CONTACTS_URL, params):
+            yield from cursor.take(page)
+            if cursor.reached_end:
+                break
+        self._save_cursor(cursor_store, cursor)
+
+    def _cursor_store(self, cursor_store):
+        if cursor_store is not None:
+            return cursor_store
+        if self.cache_backend is None:
+            raise ValueError('Reading recent contacts needs a cursor_store or a cache_backend')
+        return CacheCursorStore(self.cache_backend)
+
+    @staticmethod
+    def _with_timestamp(properties):
+        if properties is None or 'lastmodifieddate' in properties:
+            return properties
+        return list(properties) + ['lastmodifieddate']
+
+    @staticmethod
+    def _save_cursor(cursor_store, cursor):
+        if (cursor.timestamp is not None and not cursor.reached_end and
+                cursor.timestamp < (time.time() - RECENT_CONTACTS_DAYS * 86400) * 1000):
+            logger.warning('[HUBSPOT] the recently updated contacts feed ended before the '
+                           'last run\'s cursor, so some changes may have been missed')
+        state = cursor.state()
+        if state is not None:
+            cursor_store.set(state)
+
+    def _contact_pages(self, url, params):
+        """
+        Follow HubSpot's offset cursor through the pages of `url`. A failed page raises
+        `requests.HTTPError` rather than silently ending the export early.
+        """
+        offsets = {}
+        while True:
+            response = self.request('get', url, params=dict(params, **offsets))
+            response.raise_for_status()
+            body = response.json()
+            self._index_contacts(body)
+            contacts, offsets = self._contact_page(body)
+            yield contacts
+            if offsets is None:
+                return
+
+    @staticmethod
+    def _contact_params(properties, page_size):
+        params = {'count': min(page_size, MAX_PAGE_SIZE), 'propertyMode': 'value_only',
+                  'formSubmissionMode': 'none', 'showListMemberships': 'false'}
+        if properties is not None:
+            params['property'] = list(properties)
+        return params
+
+    @staticmethod
+    def _contact_page(body):
+        """
+        The simplified contacts in a page of results, and the offsets to request the next
+        page with, or `None` for the last page.
+        """
+        contacts = [
+            {'vid': contact['vid'],
+             'properties': {name: prop.get('value')
+                            for name, prop in (contact.get('properties') or {}).items()}}
+            for contact in body.get('contacts') or []
+        ]
+        if not body.get('has-more') or not contacts:
+            return contacts, None
+        offsets = {'vidOffset': body['vid-offset']}
+        if 'time-offset' in body:
+            offsets['timeOffset'] = body['time-offset']
+        return contacts, offsets
+
+    # company methods
+    def sync_company(self, company):
+        """
+        Create `company` in HubSpot, or update it when it already has a `crm_unique_id`,
+        and return the parsed response. The id of a newly created company is saved on it,
+        as `create_or_update_user` does for users.
+        """
+        data = self._company_manager().generate_sync_data(company)
+        company_id = getattr(company, 'crm_unique_id', None)
+        if company_id:
+            return self.request('put', '{}/{}'.format(COMPANIES_URL, company_id),
+                                json=data).json()
+        response = self.request('post', COMPANIES_URL, json=data)
+        if self._is_success(response):
+            self._remember_company_id(company, response)
+        return response.json()
+
+    def sync_companies(self, companies, *, batch_size=MAX_BATCH_SIZE,
+                       max_batch_bytes=MAX_BATCH_BYTES):
+        """
+        Sync many companies, e.g. the companies of a list of users. Each distinct company
+        (by primary key, or identity) is evaluated and sent once, however many times it
+        appears. Companies that already have a `crm_unique_id` are updated through
+        HubSpot's batch endpoint; new ones have to be created one at a time.
+
+        Returns one dict per distinct company, in the order they first appear, with the
+        keys `company_id`, `success`, `status_code` and `error`.
+        """
+        companies, payloads = self._company_payloads(companies)
+        results = [None] * len(companies)
+        positions = []
+        records = []
+        for position, (company, payload) in enumerate(zip(companies, payloads)):
+            company_id = getattr(company, 'crm_unique_id', None)
+            if company_id:
+                positions.append(position)
+                records.append({'objectId': company_id, 'properties': payload['properties']})
+                continue
+            response = self.request('post', COMPANIES_URL, json=payload)
+            if self._is_success(response):
+                company_id = self._remember_company_id(company, response)
+            results[position] = self._company_result(company_id, response)
+
+        sent = 0
+        for chunk in chunk_records(records, max_count=batch_size, max_bytes=max_batch_bytes,
+                                   dumps=self.codec.dumps):
+            response = self.request('post', BATCH_COMPANIES_URL, json=chunk,
+                                    idempotent=True)
+            for record in chunk:
+                results[positions[sent]] = self._company_result(record['objectId'], response)
+                sent += 1
+        return results
+
+    def associate_contact_with_company(self, contact_id, company_id):
+        """
+        Make the contact with the vid `contact_id` a member of the company `company_id`.
+        """
+        url = '{}/{}/contacts/{}'.format(COMPANIES_URL, company_id, contact_id)
+        return self.request('put', url)
+
+    def associate_contacts_with_companies(self, pairs, *, batch_size=MAX_BATCH_SIZE):
+        """
+        Associate contacts with companies in batches. `pairs` holds `(contact vid,
+        company id)` tuples. Returns one dict per pair, in order, with the keys
+        `contact_id`, `company_id`, `success`, `status_code` and `error`.
+        """
+        results = []
+        for chunk in self._association_chunks(pairs, batch_size):
+            response = self.request('put', ASSOCIATIONS_URL + '/create-batch', json=chunk)
+            results.extend(self._association_results(chunk, response))
+        return results
+
+    def _company_manager(self):
+        if self.company_property_manager is None:
+            raise ValueError('HubSpot needs a company_property_manager to sync companies')
+        return self.company_property_manager
+
+    def _company_payloads(self, companies):
+        unique = {}
+        for company in companies:
+            unique.setdefault(user_identity(company), company)
+        companies = list(unique.values())
+        return companies, self._company_manager().generate_bulk_sync_data(companies, run={})
+
+    @staticmethod
+    def _remember_company_id(company, response):
+        company_id = response.json()['companyId']
+        if hasattr(company, 'crm_unique_id'):
+            company.crm_unique_id = company_id
+            if hasattr(company, 'save'):
+                company.save()
+        return company_id
+
+    def _company_result(self, company_id, response):
+        success = self._is_success(response)
+        return {
+            'company_id': company_id,
+            'success': success,
+            'status_code': getattr(response, 'status_code', None),
+            'error': None if success else self._response_message(
+                response, 'HubSpot rejected the company'),
+        }
+
+    @staticmethod
+    def _association_chunks(pairs, batch_size):
+        pairs = list(pairs)
+        for start in range(0, len(pairs), batch_size):
+            yield [
+                {
+                    'fromObjectId': contact_id,
+                    'toObjectId': company_id,
+                    'category': 'HUBSPOT_DEFINED',
+                    'definitionId': CONTACT_TO_COMPANY_DEFINITION,
+                }
+                for contact_id, company_id in pairs[start:start + batch_size]
+            ]
+
+    def _association_results(self, chunk, response):
+        success = self._is_success(response)
+        error = None if success else self._response_message(
+            response, 'HubSpot rejected the associations')
+        return [
+            {
+                'contact_id': association['fromObjectId'],
+                'company_id': association['toObjectId'],
+                'success': success,
+                'status_code': getattr(response, 'status_code', None),
+                'error': error,
+            }
+            for association in chunk
+        ]
 
     # contact properties
-    def sync_contact_property_groups(self):
-
-        # get groups first
-        response = self.request('get', BASE_URL + '/properties/v1/contacts/groups')
-        existing_group_names = [g['name'] for g in response.json()]
-
-        for group in self.user_property_manager.groups:
-            if group['name'] not in existing_group_names:
-                logger.info('[HUBSPOT][SYNC] Creating new contact property group %s',
-                            group['name'])
-                self.request('post', BASE_URL + '/properties/v1/contacts/groups',
-                             data=json.dumps(group))
-            else:
-                logger.info('[HUBSPOT][SYNC] Updating existing contact property group %s',
-                            group['name'])
-                self.request('put',
-                             BASE_URL +
-                             '/properties/v1/contacts/groups/named/%s' % group.pop('name'),
-                             data=json.dumps(group))
+    def plan_contact_property_groups_sync(self):
+        """
+        Compare our property groups with HubSpot's and return the `SchemaOperation`s needed
+        to bring HubSpot up to date, without changing anything.
+        """
+        response = self.request('get', PROPERTY_GROUPS_URL)
+        return plan_group_operations(self.user_property_manager.groups, response.json())
+
+    def plan_contact_properties_sync(self):
+        """
+        Compare our custom properties with HubSpot's and return the `SchemaOperation`s
+        needed to bring HubSpot up to date, without changing anything. Properties in our
+        groups that we no longer define are deleted.
+        """
+        response = self.request('get', PROPERTIES_URL)
+        return plan_property_operations(
+            [p.get_dict() for p in self.user_property_manager.custom_user_properties],
+            response.json(),
+            [g['name'] for g in self.user_property_manager.groups])
+
+    def sync_contact_property_groups(self, dry_run=False, max_workers=4):
+        """
+        Create or update our contact property groups, sending only what has changed.
+        See `apply_schema_operations` for the arguments and the report that is returned.
+        """
+        operations = self.plan_contact_property_groups_sync()
+        return self.apply_schema_operations(operations, dry_run=dry_run,
+                                            max_workers=max_workers)
+
+    def sync_contact_properties(self, dry_run=False, max_workers=4):
+        """
+        Create, update and delete our custom contact properties, sending only what has
+        changed. See `apply_schema_operations` for the arguments and the report that is
+        returned.
+        """
+        operations = self.plan_contact_properties_sync()
+        return self.apply_schema_operations(operations, dry_run=dry_run,
+                                            max_workers=max_workers)
+
+    def sync_schema(self, dry_run=False, max_workers=4):
+        """
+        Sync our contact property groups and custom contact properties together, so new
+        groups and their properties go out in one concurrent run.
+        """
+        operations = self.plan_contact_property_groups_sync()
+        operations += self.plan_contact_properties_sync()
+        return self.apply_schema_operations(operations, dry_run=dry_run,
+                                            max_workers=max_workers)
+
+    def apply_schema_operations(self, operations, dry_run=False, max_workers=4):
+        """
+        Apply `SchemaOperation`s on a pool of `max_workers` threads. Every call goes
+        through this client's rate limiter. Groups are created before their properties,
+        and deletes run after all creates and updates (see `schema_phases`).
 
-    def sync_contact_properties(self):
+        Returns a report with one dict per operation, in the order given, with the keys
+        `operation`, `success`, `status_code`, `error` and `duration` (in seconds). With
+        `dry_run` nothing is sent and `success` is `None`.
+        """
+        if dry_run:
+            report = []
+            for operation in operations:
+                logger.info('[HUBSPOT][SYNC][DRY RUN] ' + SCHEMA_OPERATIONS[operation.action][2],
+                            operation.name)
+                report.append(self._schema_report(operation, None, None, None, 0))
+            return report
 
-        response = self.request('get', BASE_URL + '/properties/v1/contacts/properties')
-        existing_prop_names = [p['name'] for p in response.json()]
+        results = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for phase in schema_phases(operations):
+                done = executor.map(self._timed_schema_operation, phase)
+                results.update(zip(map(id, phase), done))
+        return [results[id(operation)] for operation in operations]
 
-        # Create / update propertiest from CONTACT_PROPERTIES
-        for prop in self.user_property_manager.custom_user_properties:
+    def _timed_schema_operation(self, operation):
+        started = time.monotonic()
+        try:
+            response = self.apply_schema_operation(operation)
+        except Exception as err:
+            logger.exception('[HUBSPOT][SYNC] %s of %s failed', operation.action,
+                             operation.name)
+            return self._schema_report(operation, False, None, str(err),
+                                       time.monotonic() - started)
+        return self._schema_response_report(operation, response, time.monotonic() - started)
 
-            prop_dict = prop.get_dict()
+    def _schema_response_report(self, operation, response, duration):
+        status_code = getattr(response, 'status_code', None)
+        if self._is_success(response):
+            return self._schema_report(operation, True, status_code, None, duration)
+        error = self._response_message(response, 'HubSpot rejected the change')
+        logger.error('[HUBSPOT][SYNC] %s of %s failed with %s: %s', operation.action,
+                     operation.name, status_code, error)
+        return self._schema_report(operation, False, status_code, error, duration)
 
-            if prop_dict['name'] not in existing_prop_names:
-                logger.info('[HUBSPOT][SYNC] Creating contact property %s', prop_dict['name'])
-                self.request(
-                    'post',
-                    BASE_URL + '/properties/v1/contacts/properties', data=json.dumps(prop_dict))
-            else:
-                logger.info(
-                    '[HUBSPOT][SYNC] Updating existing contact property %s', prop_dict['name'])
-                self.request(
-                    'put',
-                    BASE_URL + '/properties/v1/contacts/properties/named/{}'.format(
-                        prop_dict.pop('name')),
-                    data=json.dumps(prop_dict))
-
-        # Delete old properties from our group
-        cf_group_names = [g['name'] for g in self.user_property_manager.groups]
-        cf_prop_names = [p.name for p in self.user_property_manager.custom_user_properties]
-        prop_names_to_delete = [p['name'] for p in response.json() if
-                                p['groupName'] in cf_group_names and
-                                p['name'] not in cf_prop_names]
-
-        for prop_name in prop_names_to_delete:
-            logger.info('[HUBSPOT][SYNC] Deleting unused contact property %s', prop_name)
-            resp = self.request('delete',
-                                BASE_URL + '/properties/v1/contacts/properties/named/' +
-                                prop_name)
-            assert resp.status_code == 204
+    @staticmethod
+    def _schema_report(operation, success, status_code, error, duration):
+        return {
+            'operation': operation,
+            'success': success,
+            'status_code': status_code,
+            'error': error,
+            'duration': duration,
+        }
+
+    def apply_schema_operation(self, operation):
+        method, url, message = SCHEMA_OPERATIONS[operation.action]
+        logger.info('[HUBSPOT][SYNC] ' + message, operation.name)
+        kwargs = {}
+        if operation.data is not None:
+            kwargs['data'] = self.codec.dumps(operation.data)
+        return self.request(method, url.format(operation.name), **kwargs)
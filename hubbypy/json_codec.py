@@ -0,0 +1,64 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class JSONCodec:
+    """
+    Turns request payloads into JSON bytes and parses response bodies. This one uses the
+    standard library `json` module; `default_codec` picks a faster one when it is
+    installed. Subclass it to plug in another library; `loads` should raise a `ValueError`
+    for a body that is not JSON.
+    """
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    """
+    Uses `orjson`, which encodes straight to bytes. Needs `pip install orjson`.
+    """
+    name = 'orjson'
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class UjsonCodec(JSONCodec):
+    """
+    Uses `ujson`. Needs `pip install ujson`.
+    """
+    name = 'ujson'
+
+    def dumps(self, obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+def default_codec():
+    """
+    The fastest codec available: `orjson`, then `ujson`, then the standard library.
+    """
+    if orjson is not None:
+        return OrjsonCodec()
+    if ujson is not None:
+        return UjsonCodec()
+    return JSONCodec()
@@ -0,0 +1,270 @@
+import bisect
+import re
+import socket
+import threading
+from urllib.parse import urlsplit
+
+# path segments that follow these ones hold an id rather than part of the endpoint
+ID_SEGMENTS = {'email': '{email}', 'vid': '{vid}', 'named': '{name}'}
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def endpoint_name(url):
+    """
+    A low cardinality name for the endpoint `url` points at, with emails, vids and
+    property names replaced by placeholders, e.g.
+    `/contacts/v1/contact/createOrUpdate/email/{email}`.
+    """
+    segments = urlsplit(url).path.rstrip('/').split('/')
+    for index in range(1, len(segments)):
+        placeholder = ID_SEGMENTS.get(segments[index - 1])
+        if placeholder:
+            segments[index] = placeholder
+        elif segments[index].isdigit():
+            segments[index] = '{id}'
+    return '/'.join(segments)
+
+
+def body_size(body):
+    """
+    The size in bytes of a request or response body, or 0 when it is unknown.
+    """
+    if isinstance(body, bytes):
+        return len(body)
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    return 0
+
+
+class Metrics:
+    """
+    The interface `HubSpot` reports to when it is given `metrics`. Every method is a no-op
+    here, so subclasses only implement the events they care about. They are called from
+    whichever thread made the request, so implementations must be thread-safe.
+
+    - `http_request` is called once for every HTTP attempt, retries included. `duration`
+      only covers the call to HubSpot, not time waiting for the rate limiter.
+    - `retry` is called when an attempt is about to be retried, with the delay before it.
+      After a 429 the delay is spent waiting in the rate limiter instead.
+    - `rate_limit_wait` is called with the number of seconds a request is held back by the
+      rate limiter.
+    - `payloads_built` is called with the number of contact payloads built and how long
+      building them took.
+    """
+
+    def http_request(self, *, method, endpoint, status_code, duration, bytes_sent,
+                     bytes_received):
+        pass
+
+    def retry(self, *, method, endpoint, status_code, delay):
+        pass
+
+    def rate_limit_wait(self, seconds):
+        pass
+
+    def payloads_built(self, count, duration):
+        pass
+
+
+class MetricsCollector(Metrics):
+    """
+    Aggregates the events in memory: request counts by endpoint and status code, request
+    latency histograms, retries, bytes sent and received, rate limiter waits and payload
+    building time. `snapshot` returns everything as a dict, and `prometheus` renders it
+    in Prometheus' text exposition format, ready to be served from a `/metrics` view.
+    """
+
+    def __init__(self, *, buckets=DEFAULT_BUCKETS, namespace='hubbypy'):
+        self.buckets = tuple(sorted(buckets))
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+            self.latency = {}
+            self.retries = {}
+            self.bytes_sent = {}
+            self.bytes_received = {}
+            self.rate_limit_waits = 0
+            self.rate_limit_wait_seconds = 0.0
+            self.payloads = 0
+            self.payload_seconds = 0.0
+
+    def http_request(self, *, method, endpoint, status_code, duration, bytes_sent,
+                     bytes_received):
+        key = (method.upper(), endpoint)
+        with self._lock:
+            status_key = key + (str(status_code),)
+            self.requests[status_key] = self.requests.get(status_key, 0) + 1
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = {
+                    'buckets': [0] * (len(self.buckets) + 1), 'count': 0, 'sum': 0.0}
+            histogram['buckets'][bisect.bisect_left(self.buckets, duration)] += 1
+            histogram['count'] += 1
+            histogram['sum'] += duration
+            self.bytes_sent[key] = self.bytes_sent.get(key, 0) + bytes_sent
+            self.bytes_received[key] = self.bytes_received.get(key, 0) + bytes_received
+
+    def retry(self, *, method, endpoint, status_code, delay):
+        key = (method.upper(), endpoint, str(status_code))
+        with self._lock:
+            self.retries[key] = self.retries.get(key, 0) + 1
+
+    def rate_limit_wait(self, seconds):
+        with self._lock:
+            self.rate_limit_waits += 1
+            self.rate_limit_wait_seconds += seconds
+
+    def payloads_built(self, count, duration):
+        with self._lock:
+            self.payloads += count
+            self.payload_seconds += duration
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': [
+                    {'method': m, 'endpoint': e, 'status_code': s, 'count': c}
+                    for (m, e, s), c in sorted(self.requests.items())
+                ],
+                'latency': [
+                    {'method': m, 'endpoint': e, 'count': h['count'], 'sum': h['sum'],
+                     'buckets': dict(zip(self.buckets + (float('inf'),),
+                                         _cumulative(h['buckets'])))}
+                    for (m, e), h in sorted(self.latency.items())
+                ],
+                'retries': [
+                    {'method': m, 'endpoint': e, 'status_code': s, 'count': c}
+                    for (m, e, s), c in sorted(self.retries.items())
+                ],
+                'bytes_sent': sum(self.bytes_sent.values()),
+                'bytes_received': sum(self.bytes_received.values()),
+                'rate_limit_waits': self.rate_limit_waits,
+                'rate_limit_wait_seconds': self.rate_limit_wait_seconds,
+                'payloads': self.payloads,
+                'payload_seconds': self.payload_seconds,
+            }
+
+    def prometheus(self):
+        """
+        The metrics in Prometheus' text exposition format.
+        """
+        ns = self.namespace
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP {}_{} {}'.format(ns, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(ns, name, kind))
+            for suffix, labels, value in samples:
+                lines.append('{}_{}{}{} {}'.format(ns, name, suffix, _labels(labels),
+                                                   _number(value)))
+
+        with self._lock:
+            metric('requests_total', 'counter', 'HTTP requests made to HubSpot',
+                   [('', {'method': m, 'endpoint': e, 'status': s}, c)
+                    for (m, e, s), c in sorted(self.requests.items())])
+            samples = []
+            for (m, e), h in sorted(self.latency.items()):
+                labels = {'method': m, 'endpoint': e}
+                for bound, count in zip(self.buckets + (float('inf'),),
+                                        _cumulative(h['buckets'])):
+                    samples.append(('_bucket', dict(labels, le=_number(bound)), count))
+                samples.append(('_sum', labels, h['sum']))
+                samples.append(('_count', labels, h['count']))
+            metric('request_duration_seconds', 'histogram',
+                   'Time taken by HubSpot to answer each request', samples)
+            metric('retries_total', 'counter', 'Requests retried after a 429 or 5xx',
+                   [('', {'method': m, 'endpoint': e, 'status': s}, c)
+                    for (m, e, s), c in sorted(self.retries.items())])
+            metric('request_bytes_total', 'counter', 'Request body bytes sent',
+                   [('', {'method': m, 'endpoint': e}, c)
+                    for (m, e), c in sorted(self.bytes_sent.items())])
+            metric('response_bytes_total', 'counter', 'Response body bytes received',
+                   [('', {'method': m, 'endpoint': e}, c)
+                    for (m, e), c in sorted(self.bytes_received.items())])
+            metric('rate_limit_wait_seconds_total', 'counter',
+                   'Time requests spent held back by the rate limiter',
+                   [('', {}, self.rate_limit_wait_seconds)])
+            metric('rate_limit_waits_total', 'counter',
+                   'Requests held back by the rate limiter',
+                   [('', {}, self.rate_limit_waits)])
+            metric('payload_build_seconds_total', 'counter',
+                   'Time spent building contact payloads', [('', {}, self.payload_seconds)])
+            metric('payloads_built_total', 'counter', 'Contact payloads built',
+                   [('', {}, self.payloads)])
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdMetrics(Metrics):
+    """
+    Sends each event to a StatsD server over UDP as it happens, with metric names under
+    `prefix`. Endpoints are turned into metric name segments, e.g.
+    `hubbypy.request.contacts.v1.contact.batch.202:1|c`. Sending never raises.
+    """
+
+    def __init__(self, *, host='127.0.0.1', port=8125, prefix='hubbypy'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, *lines):
+        try:
+            self._socket.sendto('\n'.join(lines).encode('utf-8'), self.address)
+        except OSError:
+            pass
+
+    def _name(self, *parts):
+        return '.'.join((self.prefix,) + tuple(_statsd_segment(p) for p in parts if p))
+
+    def http_request(self, *, method, endpoint, status_code, duration, bytes_sent,
+                     bytes_received):
+        name = self._name(method, endpoint)
+        self._send('{}.{}:1|c'.format(self._name('request', method, endpoint), status_code),
+                   '{}.duration:{:.3f}|ms'.format(name, duration * 1e3),
+                   '{}.bytes_sent:{}|c'.format(name, bytes_sent),
+                   '{}.bytes_received:{}|c'.format(name, bytes_received))
+
+    def retry(self, *, method, endpoint, status_code, delay):
+        self._send('{}.{}:1|c'.format(self._name('retry', method, endpoint), status_code))
+
+    def rate_limit_wait(self, seconds):
+        self._send('{}:{:.3f}|ms'.format(self._name('rate_limit_wait'), seconds * 1e3))
+
+    def payloads_built(self, count, duration):
+        self._send('{}:{}|c'.format(self._name('payloads_built'), count),
+                   '{}:{:.3f}|ms'.format(self._name('payload_build'), duration * 1e3))
+
+    def close(self):
+        self._socket.close()
+
+
+def _cumulative(counts):
+    total = 0
+    cumulative = []
+    for count in counts:
+        total += count
+        cumulative.append(total)
+    return cumulative
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels.items()) + '}'
+
+
+def _statsd_segment(part):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', str(part).lower().strip('/').replace('/', '.'))
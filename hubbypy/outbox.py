@@ -0,0 +1,163 @@
+import collections
+import inspect
+import json
+import logging
+import threading
+import time
+
+from .storage import SQLiteDatabase
+
+logger = logging.getLogger(__name__)
+
+
+# A contact claimed from an outbox. `version` goes up every time the contact is enqueued,
+# so a worker only removes the entry if nothing newer arrived while it was being sent.
+OutboxEntry = collections.namedtuple('OutboxEntry', ['email', 'properties', 'version',
+                                                     'attempts'])
+
+
+class Outbox:
+    """
+    A queue of contact updates waiting to be sent to HubSpot, coalesced by email: each
+    contact has at most one entry, holding the latest value of every property enqueued for
+    it since it was last sent.
+
+    `enqueue` merges a properties list (as built by `generate_sync_data`) into the
+    contact's entry. `claim` hands out up to `limit` entries to one worker, hiding them
+    from other workers for `lease` seconds. The worker then calls `ack` for the entries
+    it sent, and `release` for the ones that failed so that they are tried again once
+    `delay` seconds have passed.
+    """
+
+    def enqueue(self, email, properties):
+        raise NotImplementedError('Subclasses of Outbox should implement the enqueue method')
+
+    def claim(self, limit=100, lease=300):
+        raise NotImplementedError('Subclasses of Outbox should implement the claim method')
+
+    def ack(self, entry):
+        raise NotImplementedError('Subclasses of Outbox should implement the ack method')
+
+    def release(self, entry, error=None, delay=0):
+        raise NotImplementedError('Subclasses of Outbox should implement the release method')
+
+    def __len__(self):
+        raise NotImplementedError('Subclasses of Outbox should implement the __len__ method')
+
+
+class SQLiteOutbox(Outbox):
+    """
+    An outbox kept in a SQLite database at `path`, so queued updates survive restarts and
+    can be shared between the web processes that enqueue and the workers that drain.
+
+    Entries that have failed `max_attempts` times are no longer claimed; `failed` lists
+    them, and enqueueing the contact again gives it a fresh set of attempts. Call `close`
+    when you are done with it.
+    """
+
+    def __init__(self, *, path, max_attempts=5, timeout=30):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self._db = SQLiteDatabase(path, timeout=timeout)
+        self._db.connection().execute(
+            'CREATE TABLE IF NOT EXISTS outbox '
+            '(email TEXT PRIMARY KEY, properties TEXT, version INTEGER, enqueued REAL, '
+            'claimed_until REAL, attempts INTEGER, last_error TEXT)')
+
+    def enqueue(self, email, properties):
+        def enqueue(connection):
+            row = connection.execute('SELECT properties, version FROM outbox WHERE email = ?',
+                                     (email,)).fetchone()
+            merged = {}
+            version = 1
+            if row is not None:
+                merged = {p['property']: p['value'] for p in json.loads(row[0])}
+                version = row[1] + 1
+            for prop in properties:
+                # a later value replaces an earlier one, but keeps its place
+                merged[prop['property']] = prop['value']
+            payload = json.dumps([{'property': name, 'value': value}
+                                  for name, value in merged.items()])
+            if row is None:
+                connection.execute(
+                    'INSERT INTO outbox (email, properties, version, enqueued, claimed_until, '
+                    'attempts, last_error) VALUES (?, ?, ?, ?, NULL, 0, NULL)',
+                    (email, payload, version, time.time()))
+            else:
+                connection.execute(
+                    'UPDATE outbox SET properties = ?, version = ?, attempts = 0 '
+                    'WHERE email = ?', (payload, version, email))
+
+        self._db.transaction(enqueue)
+
+    def claim(self, limit=100, lease=300):
+        def claim(connection):
+            now = time.time()
+            rows = connection.execute(
+                'SELECT email, properties, version, attempts FROM outbox '
+                'WHERE (claimed_until IS NULL OR claimed_until < ?) AND attempts < ? '
+                'ORDER BY enqueued LIMIT ?', (now, self.max_attempts, limit)).fetchall()
+            connection.executemany('UPDATE outbox SET claimed_until = ? WHERE email = ?',
+                                   [(now + lease, row[0]) for row in rows])
+            return [OutboxEntry(email, json.loads(properties), version, attempts)
+                    for email, properties, version, attempts in rows]
+
+        return self._db.transaction(claim)
+
+    def ack(self, entry):
+        def ack(connection):
+            deleted = connection.execute('DELETE FROM outbox WHERE email = ? AND version = ?',
+                                         (entry.email, entry.version)).rowcount
+            if not deleted:
+                # enqueued again while it was being sent, so the newer state still has to go
+                connection.execute('UPDATE outbox SET claimed_until = NULL WHERE email = ?',
+                                   (entry.email,))
+
+        self._db.transaction(ack)
+
+    def release(self, entry, error=None, delay=0):
+        def release(connection):
+            connection.execute(
+                'UPDATE outbox SET claimed_until = ?, last_error = ?, '
+                'attempts = CASE WHEN version = ? THEN attempts + 1 ELSE attempts END '
+                'WHERE email = ?',
+                (time.time() + delay if delay else None, error, entry.version, entry.email))
+
+        self._db.transaction(release)
+
+    def failed(self):
+        """
+        `(email, attempts, last_error)` for each entry that has used up its attempts.
+        """
+        return self._db.connection().execute(
+            'SELECT email, attempts, last_error FROM outbox WHERE attempts >= ? '
+            'ORDER BY enqueued', (self.max_attempts,)).fetchall()
+
+    def __len__(self):
+        return self._db.connection().execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+def run_outbox_worker(hubspot, *, batch_size=100, poll_interval=5, stop=None):
+    """
+    Drain `hubspot.outbox` until `stop`, a `threading.Event`, is set: whenever the outbox
+    is empty, wait `poll_interval` seconds before looking again. This is the entry point
+    for a worker process, e.g. from a management command. It needs a blocking `HubSpot`;
+    with an `AsyncHubSpot`, await its `drain_outbox` in a loop of your own.
+    """
+    if inspect.iscoroutinefunction(hubspot.drain_outbox):
+        raise TypeError('run_outbox_worker needs a HubSpot, not an AsyncHubSpot')
+    stop = stop or threading.Event()
+    logger.info('[HUBSPOT][OUTBOX] worker started')
+    while not stop.is_set():
+        try:
+            results = hubspot.drain_outbox(batch_size=batch_size, max_batches=1)
+        except Exception:
+            logger.exception('[HUBSPOT][OUTBOX] draining the outbox failed')
+            results = []
+        if not results:
+            stop.wait(poll_interval)
+    logger.info('[HUBSPOT][OUTBOX] worker stopped')
@@ -0,0 +1,112 @@
+import threading
+import time
+
+
+class PropertyProfile:
+    """
+    Timings for one property, gathered while its manager is profiling: the number of
+    calls, the time spent getting raw values and encoding them, the slowest call, and how
+    many calls raised or gave `None`. Safe to update from several threads, as happens when
+    `io_bound` properties run in an executor.
+    """
+
+    def __init__(self, name, kind=None):
+        self.name = name
+        self.kind = kind
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.get_seconds = 0.0
+            self.encode_seconds = 0.0
+            self.max_seconds = 0.0
+            self.errors = 0
+            self.nones = 0
+
+    def _record(self, get_seconds, encode_seconds, error=False, none=False):
+        with self._lock:
+            self.calls += 1
+            self.get_seconds += get_seconds
+            self.encode_seconds += encode_seconds
+            self.max_seconds = max(self.max_seconds, get_seconds + encode_seconds)
+            self.errors += error
+            self.nones += none
+
+    def wrap(self, get_value, encode=None):
+        """
+        Return a function of a user that gets the value with `get_value`, encodes it with
+        `encode` unless it is `None`, and records how long each step took. Exceptions are
+        counted and raised again.
+        """
+        perf_counter = time.perf_counter
+        record = self._record
+
+        def profiled(user):
+            started = perf_counter()
+            try:
+                value = get_value(user)
+            except Exception:
+                record(perf_counter() - started, 0.0, error=True)
+                raise
+            got = perf_counter()
+            if value is None or encode is None:
+                record(got - started, 0.0, none=value is None)
+                return value
+            try:
+                value = encode(value)
+            except Exception:
+                record(got - started, perf_counter() - got, error=True)
+                raise
+            record(got - started, perf_counter() - got)
+            return value
+
+        return profiled
+
+    def as_dict(self):
+        with self._lock:
+            total = self.get_seconds + self.encode_seconds
+            return {
+                'name': self.name,
+                'kind': self.kind,
+                'calls': self.calls,
+                'total_seconds': total,
+                'get_seconds': self.get_seconds,
+                'encode_seconds': self.encode_seconds,
+                'mean_us': total / self.calls * 1e6 if self.calls else 0.0,
+                'max_us': self.max_seconds * 1e6,
+                'errors': self.errors,
+                'nones': self.nones,
+                'none_rate': self.nones / self.calls if self.calls else 0.0,
+            }
+
+
+def rank_profiles(profiles, limit=None):
+    """
+    The `as_dict` of each `PropertyProfile`, most expensive first, with each property's
+    `share` of the total time.
+    """
+    report = sorted((p.as_dict() for p in profiles), key=lambda r: r['total_seconds'],
+                    reverse=True)
+    total = sum(r['total_seconds'] for r in report)
+    for row in report:
+        row['share'] = row['total_seconds'] / total if total else 0.0
+    return report[:limit] if limit is not None else report
+
+
+def format_profile_report(report):
+    """
+    Render a `rank_profiles` report as a plain text table.
+    """
+    header = '{:<40} {:<18} {:>8} {:>10} {:>7} {:>10} {:>10} {:>7} {:>7}'.format(
+        'property', 'kind', 'calls', 'total ms', 'share', 'mean us', 'max us', 'errors',
+        'none %')
+    lines = [header, '-' * len(header)]
+    for row in report:
+        lines.append('{:<40} {:<18} {:>8} {:>10.2f} {:>6.1f}% {:>10.1f} {:>10.1f} {:>7} '
+                     '{:>6.1f}%'.format(row['name'][:40], (row['kind'] or '')[:18],
+                                        row['calls'], row['total_seconds'] * 1e3,
+                                        row['share'] * 100, row['mean_us'], row['max_us'],
+                                        row['errors'], row['none_rate'] * 100))
+    return '\n'.join(lines)
@@ -0,0 +1,396 @@
+import math
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from .storage import SQLiteDatabase
+
+
+def _header_number(headers, name):
+    try:
+        return float(headers.get(name))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def parse_rate_limit_headers(headers):
+    """
+    Read the rate limit headers HubSpot sends with every response into a dict with the keys
+    `max_calls`, `period` (in seconds), `remaining` and `daily_remaining`. Missing or
+    unreadable headers come back as `None`.
+    """
+    interval = _header_number(headers, 'X-HubSpot-RateLimit-Interval-Milliseconds')
+    max_calls = _header_number(headers, 'X-HubSpot-RateLimit-Max')
+    remaining = _header_number(headers, 'X-HubSpot-RateLimit-Remaining')
+    daily_remaining = _header_number(headers, 'X-HubSpot-RateLimit-Daily-Remaining')
+    return {
+        'max_calls': int(max_calls) if max_calls else None,
+        'period': interval / 1000 if interval else None,
+        'remaining': int(remaining) if remaining is not None else None,
+        'daily_remaining': int(daily_remaining) if daily_remaining is not None else None,
+    }
+
+
+def parse_retry_after(headers):
+    """
+    The number of seconds a `Retry-After` header asks us to wait, or `None`. The header may
+    hold either a number of seconds or an HTTP date.
+    """
+    seconds = _header_number(headers, 'Retry-After')
+    if seconds is not None:
+        return max(seconds, 0)
+    try:
+        retry_at = parsedate_to_datetime(headers.get('Retry-After'))
+    except (AttributeError, TypeError, ValueError, IndexError):
+        return None
+    if retry_at is None:
+        return None
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+def backoff_delay(attempt, *, base=0.5, cap=30, retry_after=None):
+    """
+    Exponential backoff with full jitter for the given zero-based retry `attempt`. When the
+    server sent a `Retry-After` we wait at least that long, plus a little jitter so that
+    workers that were throttled together do not all retry at the same moment.
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimiter:
+    """
+    The interface `HubSpot` uses to stay within the API's rate limit.
+
+    `reserve` claims the right to make `tokens` calls and returns the number of seconds the
+    caller has to wait before making them. It never sleeps itself, which lets the same
+    limiter serve blocking callers (`time.sleep`) and asyncio callers (`asyncio.sleep`).
+
+    `update` and `pause` let the client adjust the limiter to what HubSpot reports in its
+    responses. Limiters that cannot adapt may leave them as no-ops.
+
+    Set `blocking` to `True` on limiters whose `reserve` does I/O, so that async callers
+    know to run it off the event loop.
+    """
+    blocking = False
+
+    def reserve(self, tokens=1):
+        raise NotImplementedError('Subclasses of RateLimiter should implement the '
+                                  'reserve method')
+
+    def update(self, *, max_calls=None, period=None, remaining=None):
+        """
+        Adopt the budget HubSpot reports: `max_calls` every `period` seconds, of which
+        `remaining` are left in the current interval.
+        """
+
+    def pause(self, seconds):
+        """
+        Hold back all callers for at least `seconds`, e.g. after a 429.
+        """
+
+
+class TokenBucket(RateLimiter):
+    """
+    An in-process token bucket allowing `max_calls` calls every `period` seconds, which
+    HubSpot counts in windows. The bucket holds up to `burst` tokens and refills just
+    slowly enough that a full bucket plus what it refills in `period` seconds never come to
+    more than `max_calls`, so no window sees more than that. By default there is no burst
+    and calls are spaced evenly: 8 calls every 10 seconds is one every 1.25 seconds. A
+    bigger `burst` lets the odd call through without waiting but slows the refill, and so
+    the sustained rate, to `max_calls - burst + 1` calls every `period`.
+
+    The bucket's state is two numbers, so each reservation is O(1). A caller that finds the
+    bucket empty still takes its token, driving the level negative, and is told to wait
+    until the bucket has refilled to cover it. Concurrent callers are therefore queued
+    fairly rather than all waking up at once.
+
+    One instance is safe to share between threads. Use `SQLiteTokenBucket` to share a
+    budget between processes.
+    """
+
+    def __init__(self, *, max_calls=8, period=10, burst=1):
+        self.max_calls = max_calls
+        self.period = period
+        self.burst = burst
+        self._level = self.capacity
+        self._updated = None
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        return max(min(self.burst, self.max_calls), 1)
+
+    @property
+    def rate(self):
+        return (self.max_calls - self.capacity + 1) / self.period
+
+    def _now(self):
+        return time.monotonic()
+
+    def _take(self, level, updated, now, tokens):
+        """
+        Return the new `(level, updated)` state of the bucket after taking `tokens` at
+        `now`, and the number of seconds to wait before the tokens may be used.
+        """
+        if updated is not None:
+            level = min(self.capacity, level + max(now - updated, 0) * self.rate)
+        level -= tokens
+        wait = -level / self.rate if level < 0 else 0
+        return level, now, wait
+
+    def _adjust(self, level, updated, now, max_calls=None, period=None, remaining=None,
+                pause=None):
+        """
+        Return the new `(level, updated)` state of the bucket after applying what we have
+        learned from HubSpot at `now`.
+        """
+        if updated is not None:
+            level = min(self.capacity, level + max(now - updated, 0) * self.rate)
+        if max_calls:
+            self.max_calls = max_calls
+        if period:
+            self.period = period
+        level = min(level, self.capacity)
+        if remaining is not None:
+            level = min(level, remaining)
+        if pause:
+            # leave the bucket short enough that the next token is `pause` seconds away
+            level = min(level, 1 - pause * self.rate)
+        return level, now
+
+    def reserve(self, tokens=1):
+        with self._lock:
+            self._level, self._updated, wait = self._take(
+                self._level, self._updated, self._now(), tokens)
+        return wait
+
+    def update(self, *, max_calls=None, period=None, remaining=None):
+        with self._lock:
+            self._level, self._updated = self._adjust(
+                self._level, self._updated, self._now(), max_calls=max_calls, period=period,
+                remaining=remaining)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._level, self._updated = self._adjust(
+                self._level, self._updated, self._now(), pause=seconds)
+
+
+class SQLiteTokenBucket(TokenBucket):
+    """
+    A token bucket whose state lives in a SQLite database at `path`, so that every process
+    on a host that points at the same file shares one budget. Use a distinct `name` for
+    each API key that shares the database.
+
+    Each reservation is a single `BEGIN IMMEDIATE` transaction, which holds SQLite's write
+    lock while the bucket is read and updated. Concurrent workers are serialized by that
+    lock, so together they can never take more tokens than the bucket holds.
+
+    The budget is stored alongside the level, so once any process adopts the limits
+    HubSpot reports, every process sharing the bucket uses them. `max_calls` and `period`
+    only set the budget of a bucket that does not exist yet.
+
+    Call `close` when you are done with it.
+    """
+    blocking = True
+
+    def __init__(self, *, path, name='hubspot', max_calls=8, period=10, burst=1, timeout=30):
+        super().__init__(max_calls=max_calls, period=period, burst=burst)
+        self.path = path
+        self.name = name
+        self.timeout = timeout
+        self._db = SQLiteDatabase(path, timeout=timeout)
+        self._db.transaction(self._create_table)
+
+    @staticmethod
+    def _create_table(connection):
+        connection.execute('CREATE TABLE IF NOT EXISTS token_buckets '
+                           '(name TEXT PRIMARY KEY, level REAL, updated REAL, '
+                           'max_calls REAL, period REAL)')
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(token_buckets)')]
+        for column in ('max_calls', 'period'):
+            if column not in columns:
+                # created by an older version, before the budget was shared
+                connection.execute('ALTER TABLE token_buckets ADD COLUMN %s REAL' % column)
+
+    def _now(self):
+        # the clock has to be shared between processes, so a monotonic one won't do
+        return time.time()
+
+    def _transaction(self, func):
+        """
+        Apply `func(level, updated, now)` to the stored bucket inside one write transaction.
+        `func` returns the new level and updated time, optionally followed by a result.
+        """
+        def apply(connection):
+            row = connection.execute(
+                'SELECT level, updated, max_calls, period FROM token_buckets WHERE name = ?',
+                (self.name,)).fetchone()
+            if row:
+                level, updated, max_calls, period = row
+                # take on the budget another process may have adopted
+                self.max_calls = max_calls or self.max_calls
+                self.period = period or self.period
+            else:
+                level, updated = self.capacity, None
+            level, updated, *result = func(level, updated, self._now())
+            connection.execute(
+                'INSERT OR REPLACE INTO token_buckets (name, level, updated, max_calls, period) '
+                'VALUES (?, ?, ?, ?, ?)', (self.name, level, updated, self.max_calls, self.period))
+            return result[0] if result else None
+
+        return self._db.transaction(apply)
+
+    def reserve(self, tokens=1):
+        return self._transaction(
+            lambda level, updated, now: self._take(level, updated, now, tokens))
+
+    def update(self, *, max_calls=None, period=None, remaining=None):
+        self._transaction(
+            lambda level, updated, now: self._adjust(
+                level, updated, now, max_calls=max_calls, period=period, remaining=remaining))
+
+    def pause(self, seconds):
+        self._transaction(
+            lambda level, updated, now: self._adjust(level, updated, now, pause=seconds))
+
+    def close(self):
+        self._db.close()
+
+
+class CacheRateLimiter(RateLimiter):
+    """
+    Shares a budget of `max_calls` calls every `period` seconds between every process that
+    uses the same `cache`, e.g. Django's cache backed by Redis or Memcached. The cache must
+    support atomic `add` and `incr`, and `touch`, as Django's does.
+
+    Calls are spaced `period / max_calls` seconds apart, so no stretch of `period` seconds
+    holds more than `max_calls` of them, however the calls fall across windows. The cache
+    holds one counter under `key + ':next_slot'`: the time, in milliseconds, at which the
+    next free slot starts. A reservation moves it on with a single `incr` and waits for the
+    slot it got, so it costs the same however long the queue, and since every caller
+    increments before it knows its slot, no two workers can ever get the same one. The
+    counter is kept apart from `key` itself, where older versions kept a list of call
+    times, so that the two can run side by side during an upgrade. The counter expires soon
+    after its last slot has passed, so time spent idle does not add up to a burst. Its
+    expiry is only moved on once the slots handed out come close to it, so most
+    reservations cost one round trip to the cache.
+
+    The budget is kept in the cache too, under `key + ':budget'`, so once any process adopts
+    the limits HubSpot reports, every process sharing the cache uses them. A process reads
+    it before its first reservation and then follows the limits HubSpot reports to it.
+    `max_calls` and `period` only set the budget until one has been adopted.
+
+    The spacing already keeps us within the budget, so the calls HubSpot reports as
+    remaining only matter once they run out, e.g. because another client on the same key
+    spends them too. When fewer than `min_remaining` are left, every caller is held back
+    until HubSpot's window resets. We take a window to have started when a response shows
+    more calls remaining than the one before; until we have seen that happen, or when it
+    was more than a `period` ago, the hold lasts a full `period`.
+    """
+    blocking = True
+
+    def __init__(self, cache, *, key='hub_api_calls', max_calls=8, period=10,
+                 min_remaining=1):
+        self.cache = cache
+        self.key = key
+        self._slot_key = key + ':next_slot'
+        self.max_calls = max_calls
+        self.period = period
+        self.min_remaining = min_remaining
+        self._remaining = None
+        self._window_start = None
+        self._budget_loaded = False
+        # when the counter expires, as far as we know
+        self._expires = 0
+
+    def _now(self):
+        return time.time()
+
+    def _step(self, tokens):
+        # round up, so the slots never add up to more than the budget
+        return math.ceil(tokens * self.period * 1000 / self.max_calls)
+
+    @staticmethod
+    def _timeout(slot, now_ms):
+        # counted from the end of the last slot rather than from now, so the counter is
+        # kept for as long as the queue behind it, plus a little for slow callers
+        return max(slot - now_ms, 0) // 1000 + 3
+
+    def _advance(self, delta, now_ms):
+        """
+        Move the counter on by `delta` milliseconds and return where it ends up. A counter
+        that does not exist yet starts at `now_ms`.
+        """
+        try:
+            slot = self.cache.incr(self._slot_key, delta)
+        except ValueError:
+            # no counter yet or it expired; if another worker starts one first, we go
+            # after them
+            timeout = self._timeout(now_ms, now_ms)
+            self.cache.add(self._slot_key, now_ms, timeout)
+            self._expires = now_ms + timeout * 1000
+            slot = self.cache.incr(self._slot_key, delta)
+        if slot + 1000 > self._expires:
+            # incr leaves the expiry alone, so move it along with the counter
+            timeout = self._timeout(slot, now_ms)
+            self.cache.touch(self._slot_key, timeout)
+            self._expires = now_ms + timeout * 1000
+        return slot
+
+    def _load_budget(self):
+        # take on the budget another process may have adopted
+        budget = self.cache.get(self.key + ':budget')
+        if budget:
+            self.max_calls, self.period = budget
+        self._budget_loaded = True
+
+    def _hold_until(self, until, now_ms):
+        """
+        Make sure no slot starts before `until` milliseconds.
+        """
+        slot = self.cache.get(self._slot_key) or now_ms
+        if slot < until:
+            # if other workers move the counter meanwhile, we only hold back a bit longer
+            self._advance(until - slot, now_ms)
+
+    def reserve(self, tokens=1):
+        if not self._budget_loaded:
+            self._load_budget()
+        now_ms = int(self._now() * 1000)
+        step = self._step(tokens)
+        start = self._advance(step, now_ms) - step
+        if start < now_ms:
+            # the counter fell behind the clock while we were idle; catch it up so the
+            # slots nobody used are not handed out in a burst
+            self._advance(now_ms - start, now_ms)
+            start = now_ms
+        return (start - now_ms) / 1000
+
+    def update(self, *, max_calls=None, period=None, remaining=None):
+        budget = (max_calls or self.max_calls, period or self.period)
+        if budget != (self.max_calls, self.period):
+            self.max_calls, self.period = budget
+            self.cache.set(self.key + ':budget', budget, None)
+        if remaining is not None:
+            self._watch_window(remaining)
+
+    def _watch_window(self, remaining):
+        now = self._now()
+        if self._remaining is not None and remaining > self._remaining:
+            # HubSpot started a new window no later than now
+            self._window_start = now
+        self._remaining = remaining
+        if remaining < self.min_remaining:
+            reset = now + self.period
+            if self._window_start is not None and now < self._window_start + self.period:
+                reset = self._window_start + self.period
+            now_ms = int(now * 1000)
+            self._hold_until(int(reset * 1000), now_ms)
+
+    def pause(self, seconds):
+        now_ms = int(self._now() * 1000)
+        self._hold_until(now_ms + int(seconds * 1000), now_ms)
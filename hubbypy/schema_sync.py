@@ -0,0 +1,99 @@
+import collections
+
+
+# One change to make to HubSpot's contact property schema:
+# - `action`: one of `create_group`, `update_group`, `create_property`, `update_property`
+#   and `delete_property`
+# - `name`: the name of the group or property
+# - `data`: the JSON body to send, or `None` for deletes
+SchemaOperation = collections.namedtuple('SchemaOperation', ['action', 'name', 'data'])
+
+
+def matches(local, remote):
+    """
+    Whether the `remote` definition HubSpot returned already has every value set in our
+    `local` definition. HubSpot adds many fields of its own, so only the keys we send are
+    compared. Enumeration options are matched up by their `value`.
+    """
+    if isinstance(local, dict):
+        if not isinstance(remote, dict):
+            return False
+        return all(key in remote and matches(value, remote[key])
+                   for key, value in local.items())
+    if isinstance(local, list):
+        if not isinstance(remote, list) or len(local) != len(remote):
+            return False
+        if all(isinstance(o, dict) and 'value' in o for o in local + remote):
+            remote_by_value = {o['value']: o for o in remote}
+            return all(o['value'] in remote_by_value and matches(o, remote_by_value[o['value']])
+                       for o in local)
+        return all(matches(item, remote_item) for item, remote_item in zip(local, remote))
+    if local is None:
+        # HubSpot hands back empty strings for the optional fields we leave unset
+        return remote in (None, '')
+    return local == remote
+
+
+def plan_group_operations(local_groups, remote_groups):
+    """
+    The operations that make HubSpot's property groups match `local_groups`. Groups that
+    only exist in HubSpot are left alone.
+    """
+    remote_by_name = {g['name']: g for g in remote_groups}
+    operations = []
+    for group in local_groups:
+        group = dict(group)
+        remote = remote_by_name.get(group['name'])
+        if remote is None:
+            operations.append(SchemaOperation('create_group', group['name'], group))
+        elif not matches(group, remote):
+            name = group.pop('name')
+            operations.append(SchemaOperation('update_group', name, group))
+    return operations
+
+
+def plan_property_operations(local_properties, remote_properties, group_names):
+    """
+    The operations that make HubSpot's contact properties match `local_properties`, a list
+    of `get_dict()` results. Properties in one of `group_names` that we no longer define
+    are deleted.
+    """
+    remote_by_name = {p['name']: p for p in remote_properties}
+    local_names = set()
+    operations = []
+    for prop_dict in local_properties:
+        prop_dict = dict(prop_dict)
+        local_names.add(prop_dict['name'])
+        remote = remote_by_name.get(prop_dict['name'])
+        if remote is None:
+            operations.append(SchemaOperation('create_property', prop_dict['name'], prop_dict))
+        elif not matches(prop_dict, remote):
+            name = prop_dict.pop('name')
+            operations.append(SchemaOperation('update_property', name, prop_dict))
+
+    group_names = set(group_names)
+    for remote in remote_properties:
+        if remote.get('groupName') in group_names and remote['name'] not in local_names:
+            operations.append(SchemaOperation('delete_property', remote['name'], None))
+    return operations
+
+
+def schema_phases(operations):
+    """
+    Split `operations` into phases that must run one after the other; the operations
+    within a phase are independent of each other and may run concurrently.
+
+    Properties are only created or updated once the groups they belong to have been
+    created, and properties are only deleted after every create and update is done.
+    """
+    new_groups = {o.name for o in operations if o.action == 'create_group'}
+    first, second, deletes = [], [], []
+    for operation in operations:
+        if operation.action == 'delete_property':
+            deletes.append(operation)
+        elif (operation.action in ('create_property', 'update_property') and
+                (operation.data or {}).get('groupName') in new_groups):
+            second.append(operation)
+        else:
+            first.append(operation)
+    return [phase for phase in (first, second, deletes) if phase]
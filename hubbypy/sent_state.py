@@ -0,0 +1,95 @@
+import hashlib
+import json
+
+from .storage import LRUCache, SQLiteDatabase
+
+
+def digest_value(value):
+    """
+    A short, stable digest of a formatted property value, used to tell whether the value
+    has changed since we last sent it.
+    """
+    encoded = json.dumps(value, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.blake2b(encoded, digest_size=8).hexdigest()
+
+
+def digest_properties(properties):
+    """
+    Map each property in a `generate_sync_data` properties list to the digest of its value.
+    """
+    return {p['property']: digest_value(p['value']) for p in properties}
+
+
+class SentStateStore:
+    """
+    Remembers a digest of the last value we successfully pushed to HubSpot for each
+    property of each contact, keyed by the contact's email (or vid).
+
+    `get` returns a dict mapping property names to digests, or `None` when nothing is
+    known about the contact. `update` merges new digests into what is stored, and `delete`
+    forgets the contact so that its next sync sends every property.
+    """
+
+    def get(self, key):
+        raise NotImplementedError('Subclasses of SentStateStore should implement the '
+                                  'get method')
+
+    def update(self, key, digests):
+        raise NotImplementedError('Subclasses of SentStateStore should implement the '
+                                  'update method')
+
+    def delete(self, key):
+        raise NotImplementedError('Subclasses of SentStateStore should implement the '
+                                  'delete method')
+
+
+class MemorySentStateStore(SentStateStore):
+    """
+    An in-memory store holding the sent state of up to `max_size` contacts. The least
+    recently used contacts are evicted first. One instance is safe to share between threads.
+    """
+
+    def __init__(self, *, max_size=100000):
+        self.max_size = max_size
+        self._states = LRUCache(max_size=max_size)
+
+    def get(self, key):
+        state = self._states.get(key)
+        return dict(state) if state is not None else None
+
+    def update(self, key, digests):
+        self._states.update_value(key, lambda state: {**(state or {}), **digests})
+
+    def delete(self, key):
+        self._states.pop(key)
+
+
+class SQLiteSentStateStore(SentStateStore):
+    """
+    A store kept in a SQLite database at `path`, so that the sent state survives restarts
+    and is shared by every process on the host. Call `close` when you are done with it.
+    """
+
+    def __init__(self, *, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._db = SQLiteDatabase(path, timeout=timeout)
+        self._db.connection().execute(
+            'CREATE TABLE IF NOT EXISTS sent_state '
+            '(key TEXT, property TEXT, digest TEXT, PRIMARY KEY (key, property))')
+
+    def get(self, key):
+        rows = self._db.connection().execute(
+            'SELECT property, digest FROM sent_state WHERE key = ?', (key,)).fetchall()
+        return dict(rows) if rows else None
+
+    def update(self, key, digests):
+        self._db.transaction(lambda connection: connection.executemany(
+            'INSERT OR REPLACE INTO sent_state (key, property, digest) VALUES (?, ?, ?)',
+            [(key, name, digest) for name, digest in digests.items()]))
+
+    def delete(self, key):
+        self._db.connection().execute('DELETE FROM sent_state WHERE key = ?', (key,))
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,116 @@
+import collections
+import sqlite3
+import threading
+
+_missing = object()
+
+
+class SQLiteDatabase:
+    """
+    Connections to the SQLite database at `path`, one per thread, as the SQLite backed
+    stores use them. `close` closes every connection opened so far; a thread that uses
+    the database again afterwards opens a new one.
+    """
+
+    def __init__(self, path, *, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def connection(self):
+        """
+        The calling thread's connection, in autocommit mode. Statements outside a
+        `transaction` are committed as soon as they run.
+        """
+        thread_id = threading.get_ident()
+        connection = self._connections.get(thread_id)
+        if connection is None:
+            # opened by one thread and only used by it, but closed by whichever calls close
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                         check_same_thread=False)
+            with self._lock:
+                self._connections[thread_id] = connection
+        return connection
+
+    def transaction(self, func):
+        """
+        Call `func(connection)` inside one `BEGIN IMMEDIATE` transaction, which holds
+        SQLite's write lock from the start, and return what it returns. The transaction
+        is rolled back if `func` raises.
+        """
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(connection)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return result
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for connection in connections.values():
+            connection.close()
+
+
+class LRUCache:
+    """
+    A thread-safe mapping that holds at most `max_size` entries, evicting the least
+    recently used first. When `expired(value)` is given, entries it is true for are
+    dropped as they are read.
+    """
+
+    def __init__(self, *, max_size, expired=None):
+        self.max_size = max_size
+        self.expired = expired
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        value = self._entries.get(key, _missing)
+        if value is _missing:
+            return _missing
+        if self.expired is not None and self.expired(value):
+            del self._entries[key]
+            return _missing
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._get(key)
+        return default if value is _missing else value
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def set_many(self, items):
+        with self._lock:
+            for key, value in items:
+                self._set(key, value)
+
+    def update_value(self, key, func):
+        """
+        Replace the value under `key` with `func(value)`, where `value` is `None` when
+        there is none, without another thread changing it in between.
+        """
+        with self._lock:
+            value = self._get(key)
+            self._set(key, func(None if value is _missing else value))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def __len__(self):
+        return len(self._entries)
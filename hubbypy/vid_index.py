@@ -0,0 +1,131 @@
+import time
+
+from .storage import LRUCache, SQLiteDatabase
+
+
+def normalize_email(email):
+    """
+    HubSpot matches emails without regard to case or surrounding whitespace, so we index
+    them the same way.
+    """
+    return email.strip().lower()
+
+
+def contact_email(contact):
+    """
+    The primary email of a contact as HubSpot returns it from its list endpoints: from its
+    identity profiles, or else from its `email` property. `None` when it has neither.
+    """
+    for profile in contact.get('identity-profiles') or []:
+        for identity in profile.get('identities') or []:
+            if identity.get('type') == 'EMAIL' and identity.get('is-primary', True):
+                return identity.get('value')
+    email = (contact.get('properties') or {}).get('email')
+    if isinstance(email, dict):
+        email = email.get('value')
+    return email or None
+
+
+class VidIndex:
+    """
+    Maps contact emails to HubSpot vids, so that contacts can be written by vid without
+    looking them up or storing the vid on the model.
+
+    `get` returns the vid for an email, or `None` when it is unknown or has expired.
+    `set_many` records `(email, vid)` pairs, and `delete` forgets an email, e.g. once
+    HubSpot says its vid no longer exists.
+    """
+
+    def get(self, email):
+        raise NotImplementedError('Subclasses of VidIndex should implement the get method')
+
+    def set_many(self, pairs):
+        raise NotImplementedError('Subclasses of VidIndex should implement the set_many method')
+
+    def delete(self, email):
+        raise NotImplementedError('Subclasses of VidIndex should implement the delete method')
+
+    def set(self, email, vid):
+        self.set_many([(email, vid)])
+
+
+class MemoryVidIndex(VidIndex):
+    """
+    An in-memory index of up to `max_size` emails, evicting the least recently used first.
+    Entries older than `ttl` seconds are ignored, so vids of merged or deleted contacts do
+    not linger forever; `None` keeps them until they are evicted. One instance is safe to
+    share between threads.
+    """
+
+    def __init__(self, *, max_size=100000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._vids = LRUCache(max_size=max_size, expired=lambda entry: self._expired(entry[1]))
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and stored_at < time.time() - self.ttl
+
+    def get(self, email):
+        entry = self._vids.get(normalize_email(email))
+        return entry[0] if entry is not None else None
+
+    def _remember(self, pairs):
+        self._vids.set_many((email, (vid, stored_at)) for email, vid, stored_at in pairs)
+
+    def set_many(self, pairs):
+        now = time.time()
+        self._remember([(normalize_email(email), vid, now) for email, vid in pairs])
+
+    def delete(self, email):
+        self._vids.pop(normalize_email(email))
+
+    def __len__(self):
+        return len(self._vids)
+
+
+class SQLiteVidIndex(MemoryVidIndex):
+    """
+    A `MemoryVidIndex` backed by a SQLite database at `path`, so the index survives
+    restarts and is shared by every process on the host. Lookups that miss the in-memory
+    LRU fall through to SQLite, and entries older than `ttl` seconds are ignored in both.
+    Call `close` when you are done with it.
+    """
+
+    def __init__(self, *, path, max_size=100000, ttl=None, timeout=30):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.path = path
+        self.timeout = timeout
+        self._db = SQLiteDatabase(path, timeout=timeout)
+        self._db.connection().execute(
+            'CREATE TABLE IF NOT EXISTS vid_index (email TEXT PRIMARY KEY, vid INTEGER, '
+            'stored_at REAL)')
+
+    def get(self, email):
+        vid = super().get(email)
+        if vid is not None:
+            return vid
+        email = normalize_email(email)
+        row = self._db.connection().execute(
+            'SELECT vid, stored_at FROM vid_index WHERE email = ?', (email,)).fetchone()
+        if row is None or self._expired(row[1]):
+            return None
+        self._remember([(email, row[0], row[1])])
+        return row[0]
+
+    def set_many(self, pairs):
+        now = time.time()
+        rows = [(normalize_email(email), vid, now) for email, vid in pairs]
+        self._remember(rows)
+        self._db.transaction(lambda connection: connection.executemany(
+            'INSERT OR REPLACE INTO vid_index (email, vid, stored_at) VALUES (?, ?, ?)', rows))
+
+    def delete(self, email):
+        super().delete(email)
+        self._db.connection().execute('DELETE FROM vid_index WHERE email = ?',
+                                      (normalize_email(email),))
+
+    def __len__(self):
+        return self._db.connection().execute('SELECT COUNT(*) FROM vid_index').fetchone()[0]
+
+    def close(self):
+        self._db.close()
@@ -31,10 +31,26 @@ setuptools.setup(
         'Programming Language :: Python :: 3.5',
     ],
     py_modules=[
+        'hubbypy.async_api',
+        'hubbypy.company_properties',
         'hubbypy.contact_properties',
+        'hubbypy.cursors',
+        'hubbypy.encoders',
         'hubbypy.hub_api',
+        'hubbypy.json_codec',
+        'hubbypy.metrics',
+        'hubbypy.outbox',
+        'hubbypy.profiling',
+        'hubbypy.rate_limit',
+        'hubbypy.schema_sync',
+        'hubbypy.sent_state',
+        'hubbypy.storage',
+        'hubbypy.vid_index',
     ],
     install_requires=[
         'requests',
     ],
+    extras_require={
+        'fast': ['orjson'],
+    },
 )
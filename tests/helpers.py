@@ -0,0 +1,74 @@
+from unittest.mock import Mock
+
+from hubbypy.hubbypy.contact_properties import AccessorProperty, UserPropertyManager
+from hubbypy.hubbypy.hub_api import HubSpot
+from hubbypy.hubbypy.rate_limit import TokenBucket
+from hubbypy.hubbypy.sent_state import digest_properties
+
+
+class SimpleCache:
+
+    def __init__(self):
+        self._cache = {}
+        self.timeouts = {}
+
+    def set(self, key, value, timeout=300):
+        self._cache[key] = value
+        self.timeouts[key] = timeout
+
+    def get(self, key):
+        return self._cache.get(key)
+
+
+def firstname_property():
+    return AccessorProperty(name='firstname', native_type='varchar', accessor='first_name',
+                            built_in=True)
+
+
+def make_manager(*props, groups=()):
+    """
+    A `UserPropertyManager` with the built in email property, followed by `props`.
+    """
+    property_manager = UserPropertyManager(groups=list(groups))
+    property_manager.add_prop(
+        AccessorProperty(name='email', native_type='varchar', accessor='email', built_in=True)
+    )
+    for prop in props:
+        property_manager.add_prop(prop)
+    return property_manager
+
+
+def make_hubspot(cls=HubSpot, **kwargs):
+    """
+    A client with no properties and a rate limit that keeps up with a `FakeHubSpotServer`.
+    """
+    return cls(api_key='testing', user_property_manager=UserPropertyManager(groups=[]),
+               rate_limiter=TokenBucket(max_calls=100, period=1), **kwargs)
+
+
+def fill(server, emails, timestamp=None, **properties):
+    """
+    Create a contact on the fake `server` for each of `emails`, with the given property
+    values, last modified at `timestamp` when one is given.
+    """
+    for email in emails:
+        values = dict(email=email, **properties)
+        server.api.create_or_update_contact(email, body={'properties': [
+            {'property': name, 'value': value} for name, value in values.items()]}, query={})
+        if timestamp is not None:
+            server.api.contacts[email]['properties']['lastmodifieddate'] = str(timestamp)
+
+
+def unchanged_after_first(sent_state_store, pulled, count=2000):
+    """
+    `count` users with an email and a first name: one that was never sent, then a run that
+    `sent_state_store` shows to be unchanged. Each index taken is added to `pulled`.
+    """
+    for i in range(count):
+        pulled.append(i)
+        email = '%s@test.com' % i
+        if i:
+            sent_state_store.update(email, digest_properties([
+                {'property': 'email', 'value': email},
+                {'property': 'firstname', 'value': 'Jane'}]))
+        yield Mock(email=email, first_name='Jane')
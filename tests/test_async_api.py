@@ -0,0 +1,213 @@
+import asyncio
+from unittest.mock import MagicMock, Mock, PropertyMock, patch
+
+import pytest
+
+from hubbypy.hubbypy.async_api import AsyncHubSpot
+from hubbypy.hubbypy.hub_api import CONTACT_BY_VID_URL, CONTACTS_URL
+from hubbypy.hubbypy.schema_sync import SchemaOperation
+from hubbypy.hubbypy.sent_state import MemorySentStateStore
+from hubbypy.hubbypy.vid_index import MemoryVidIndex
+
+from .helpers import SimpleCache, firstname_property, make_manager, unchanged_after_first
+
+
+def test_async_request_waits_without_blocking():
+
+    async def fake_sleep(seconds):
+        waits.append(seconds)
+
+    waits = []
+
+    with patch('hubbypy.hubbypy.async_api.asyncio.sleep', side_effect=fake_sleep), \
+            patch('hubbypy.hubbypy.hub_api.time.sleep') as blocking_sleep, \
+            patch('hubbypy.hubbypy.async_api.AsyncHubSpot.client',
+                  new_callable=PropertyMock) as mock_client:
+
+        client = Mock()
+        client.request = MagicMock(return_value=True)
+        mock_client.return_value = client
+
+        test_hubspot = AsyncHubSpot(
+            api_key='testing',
+            user_property_manager=make_manager(),
+            cache_backend=SimpleCache()
+        )
+
+        async def make_calls():
+            await asyncio.gather(*[test_hubspot.request('get', 'www.test.com')
+                                   for _ in range(12)])
+
+        asyncio.run(make_calls())
+        test_hubspot.close()
+
+    assert client.request.call_count == 12
+    # calls are spaced out, so all but the first wait for their slot
+    assert len(waits) == 11
+    assert not blocking_sleep.called
+
+
+def test_async_sync_users_sends_batches_concurrently():
+
+    users = [Mock(email='%s@test.com' % i) for i in range(250)]
+
+    with patch('hubbypy.hubbypy.async_api.AsyncHubSpot.client',
+               new_callable=PropertyMock) as mock_client:
+
+        client = Mock()
+        client.request = MagicMock(return_value=Mock(status_code=202))
+        mock_client.return_value = client
+
+        test_hubspot = AsyncHubSpot(
+            api_key='testing',
+            user_property_manager=make_manager(),
+            cache_backend=SimpleCache()
+        )
+
+        async def sync():
+            async with test_hubspot:
+                return await test_hubspot.sync_users(users)
+
+        results = asyncio.run(sync())
+
+    assert client.request.call_count == 3
+    assert [r['email'] for r in results] == [u.email for u in users]
+    assert all(r['success'] for r in results)
+
+
+def test_async_sync_users_bounds_batches_and_cancels_on_failure():
+
+    users = [Mock(email='%s@test.com' % i) for i in range(100)]
+    in_flight = []
+    most_in_flight = []
+    cancelled = []
+
+    test_hubspot = AsyncHubSpot(api_key='testing', user_property_manager=make_manager(),
+                                max_concurrency=2)
+
+    async def batch(contacts):
+        in_flight.append(contacts)
+        most_in_flight.append(len(in_flight))
+        try:
+            await asyncio.sleep(0)
+            if contacts[0]['email'] == '20@test.com':
+                raise ValueError('batch failed')
+            if contacts[0]['email'] != '0@test.com':
+                # only ends when it is cancelled
+                await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            cancelled.append(contacts)
+            raise
+        finally:
+            in_flight.remove(contacts)
+        return [test_hubspot._batch_result(c, 202) for c in contacts]
+
+    async def sync():
+        async with test_hubspot:
+            with patch.object(AsyncHubSpot, 'batch_create_or_update_contacts',
+                              side_effect=batch):
+                await test_hubspot.sync_users(users, batch_size=10)
+
+    with pytest.raises(ValueError):
+        asyncio.run(sync())
+
+    assert max(most_in_flight) == 2
+    assert cancelled and not in_flight
+
+
+def test_async_sync_stream_yields_results_in_order():
+
+    users = [Mock(email='%s@test.com' % i) for i in range(250)]
+
+    test_hubspot = AsyncHubSpot(api_key='testing', user_property_manager=make_manager())
+
+    async def batch(contacts):
+        await asyncio.sleep(0.01)
+        return [test_hubspot._batch_result(c, 202) for c in contacts]
+
+    async def stream():
+        async with test_hubspot:
+            return [r async for r in test_hubspot.sync_stream(users, max_pending=3)]
+
+    with patch.object(AsyncHubSpot, 'batch_create_or_update_contacts',
+                      side_effect=batch) as send:
+        results = asyncio.run(stream())
+
+    assert send.call_count == 3
+    assert [r['email'] for r in results] == [u.email for u in users]
+    assert all(r['success'] for r in results)
+
+
+def test_async_sync_stream_sends_a_partial_chunk_behind_unchanged_users():
+
+    sent_state_store = MemorySentStateStore()
+    pulled = []
+    test_hubspot = AsyncHubSpot(api_key='testing',
+                                user_property_manager=make_manager(firstname_property()),
+                                sent_state_store=sent_state_store)
+
+    async def batch(contacts):
+        return [test_hubspot._batch_result(c, 202) for c in contacts]
+
+    async def first_result():
+        async with test_hubspot:
+            stream = test_hubspot.sync_stream(unchanged_after_first(sent_state_store, pulled),
+                                              batch_size=10, max_pending=1)
+            try:
+                return await stream.__anext__()
+            finally:
+                await stream.aclose()
+
+    with patch.object(AsyncHubSpot, 'batch_create_or_update_contacts',
+                      side_effect=batch) as send:
+        first = asyncio.run(first_result())
+
+    assert first['email'] == '0@test.com' and not first['skipped']
+    assert send.call_count == 1
+    assert len(pulled) < 100
+
+
+def test_async_create_or_update_user_falls_back_to_email_when_the_indexed_vid_is_stale():
+
+    vid_index = MemoryVidIndex()
+    vid_index.set('jane@test.com', 51)
+    test_hubspot = AsyncHubSpot(api_key='testing', user_property_manager=make_manager(),
+                                vid_index=vid_index)
+    user = Mock(spec=['email'], email='jane@test.com')
+
+    created = Mock(status_code=200)
+    created.json.return_value = {'vid': 77, 'isNew': False}
+    responses = [Mock(status_code=404), created]
+
+    async def request(method, url, **kwargs):
+        return responses.pop(0)
+
+    with patch.object(AsyncHubSpot, 'request', side_effect=request) as mock_request:
+        body = asyncio.run(test_hubspot.create_or_update_user(user, {'properties': []}))
+
+    assert body == {'vid': 77, 'isNew': False}
+    assert [c[0] for c in mock_request.call_args_list] == [
+        ('post', CONTACT_BY_VID_URL.format(51)),
+        ('post', CONTACTS_URL + '/createOrUpdate/email/jane@test.com')]
+    assert vid_index.get('jane@test.com') == 77
+
+
+def test_async_apply_schema_operations_deletes_last():
+    operations = [
+        SchemaOperation('delete_property', 'old', None),
+        SchemaOperation('update_property', 'a', {'label': 'A'}),
+    ]
+    sent = []
+
+    async def request(method, url, **kwargs):
+        sent.append(method)
+        return Mock(status_code=204 if method == 'delete' else 200)
+
+    test_hubspot = AsyncHubSpot(api_key='testing', user_property_manager=make_manager())
+    with patch.object(AsyncHubSpot, 'request', side_effect=request):
+        report = asyncio.run(test_hubspot.apply_schema_operations(operations))
+    test_hubspot.close()
+
+    assert sent == ['put', 'delete']
+    assert [r['operation'].name for r in report] == ['old', 'a']
+    assert all(r['success'] for r in report)
@@ -0,0 +1,107 @@
+from unittest.mock import MagicMock, Mock, patch
+
+from hubbypy.benchmarks.fake_hubspot import FakeHubSpotServer, point_at
+from hubbypy.hubbypy.company_properties import CompanyPropertyManager
+from hubbypy.hubbypy.contact_properties import (
+    AccessorProperty,
+    FunctionProperty,
+    UserPropertyManager
+)
+from hubbypy.hubbypy.hub_api import BATCH_COMPANIES_URL, COMPANIES_URL, HubSpot
+from hubbypy.hubbypy.rate_limit import TokenBucket
+
+
+class Company:
+
+    def __init__(self, pk, name, seats, crm_unique_id=None):
+        self.pk = pk
+        self.name = name
+        self.seats = seats
+        self.crm_unique_id = crm_unique_id
+        self.saved = 0
+
+    def save(self):
+        self.saved += 1
+
+
+def make_company_manager(seat_count=None):
+    company_manager = CompanyPropertyManager(groups=[])
+    company_manager.add_prop(
+        AccessorProperty(name='name', native_type='varchar', accessor='name', built_in=True)
+    )
+    company_manager.add_prop(
+        FunctionProperty(name='numberofemployees', native_type='number',
+                         func=seat_count or (lambda company: company.seats), send_user=True,
+                         built_in=True)
+    )
+    return company_manager
+
+
+def make_hubspot(company_manager):
+    return HubSpot(api_key='testing', user_property_manager=UserPropertyManager(groups=[]),
+                   company_property_manager=company_manager)
+
+
+def test_company_payloads_name_properties():
+
+    company_manager = make_company_manager()
+    company = Company(1, 'Acme', 12)
+
+    expected = {'properties': [{'name': 'name', 'value': 'Acme'},
+                               {'name': 'numberofemployees', 'value': 12}]}
+    assert company_manager.generate_sync_data(company) == expected
+    assert company_manager.generate_bulk_sync_data([company]) == [expected]
+
+
+def test_sync_companies_evaluates_each_company_once():
+
+    seat_count = MagicMock(side_effect=lambda company: company.seats)
+    test_hubspot = make_hubspot(make_company_manager(seat_count))
+
+    acme = Company(1, 'Acme', 12, crm_unique_id=501)
+    initech = Company(2, 'Initech', 40, crm_unique_id=502)
+    new_co = Company(3, 'New Co', 2)
+    # the companies of five employees
+    companies = [acme, initech, acme, new_co, acme]
+
+    created = Mock(status_code=200)
+    created.json.return_value = {'companyId': 503}
+    accepted = Mock(status_code=202)
+
+    with patch.object(HubSpot, 'request', side_effect=[created, accepted]) as request:
+        results = test_hubspot.sync_companies(companies)
+
+    assert seat_count.call_count == 3
+    assert request.call_args_list[0][0] == ('post', COMPANIES_URL)
+    assert request.call_args_list[1][0] == ('post', BATCH_COMPANIES_URL)
+    assert request.call_args_list[1][1]['json'] == [
+        {'objectId': 501, 'properties': [{'name': 'name', 'value': 'Acme'},
+                                         {'name': 'numberofemployees', 'value': 12}]},
+        {'objectId': 502, 'properties': [{'name': 'name', 'value': 'Initech'},
+                                         {'name': 'numberofemployees', 'value': 40}]},
+    ]
+    assert [(r['company_id'], r['success']) for r in results] == [
+        (501, True), (502, True), (503, True)]
+    assert new_co.crm_unique_id == 503
+    assert new_co.saved == 1
+
+
+def test_companies_and_associations_against_fake_hubspot():
+
+    acme = Company(1, 'Acme', 12)
+    test_hubspot = HubSpot(api_key='testing',
+                           user_property_manager=UserPropertyManager(groups=[]),
+                           company_property_manager=make_company_manager(),
+                           rate_limiter=TokenBucket(max_calls=100, period=1))
+
+    with FakeHubSpotServer(max_calls=100, interval=1) as server, test_hubspot:
+        point_at(test_hubspot, server.url)
+        assert test_hubspot.sync_company(acme) == {'companyId': 1001}
+        acme.seats = 13
+        assert test_hubspot.sync_companies([acme])[0]['success']
+        results = test_hubspot.associate_contacts_with_companies(
+            [(vid, acme.crm_unique_id) for vid in range(1, 151)])
+
+    assert server.api.companies[1001] == {'name': 'Acme', 'numberofemployees': 13}
+    assert len(results) == 150 and all(r['success'] for r in results)
+    assert len(server.api.associations) == 150
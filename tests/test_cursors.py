@@ -0,0 +1,78 @@
+import asyncio
+import os
+import tempfile
+
+from hubbypy.benchmarks.fake_hubspot import FakeHubSpotServer, point_at
+from hubbypy.hubbypy.async_api import AsyncHubSpot
+from hubbypy.hubbypy.cursors import FileCursorStore, RecentContactsCursor
+
+from .helpers import SimpleCache, fill, make_hubspot
+
+
+def contact(vid, timestamp):
+    return {'vid': vid, 'properties': {'lastmodifieddate': str(timestamp)}}
+
+
+def test_cursor_skips_what_it_has_seen_at_the_same_timestamp():
+
+    cursor = RecentContactsCursor(overlap=1)
+    assert cursor.take([contact(1, 5000), contact(2, 5000)]) == [contact(1, 5000),
+                                                                  contact(2, 5000)]
+    state = cursor.state()
+    assert state == {'timestamp': 5000, 'seen': {'1': 5000, '2': 5000}}
+
+    # 3 was modified in the same millisecond but only showed up after the last run, and 1
+    # changed again
+    cursor = RecentContactsCursor(state, overlap=1)
+    page = [contact(1, 5500), contact(3, 5000), contact(2, 5000), contact(4, 3900)]
+    assert cursor.take(page) == [contact(1, 5500), contact(3, 5000)]
+    assert cursor.reached_end
+    assert cursor.state() == {'timestamp': 5500, 'seen': {'1': 5500, '2': 5000, '3': 5000}}
+
+
+def test_iter_recent_contacts_reads_only_changes():
+
+    with tempfile.TemporaryDirectory() as directory, \
+            FakeHubSpotServer(max_calls=100, interval=1) as server, \
+            make_hubspot() as hubspot:
+        point_at(hubspot, server.url)
+        cursor_store = FileCursorStore(path=os.path.join(directory, 'cursor.json'))
+        # every contact shares a timestamp, across several pages
+        fill(server, ['%s@test.com' % i for i in range(250)], timestamp=1000)
+
+        first = list(hubspot.iter_recent_contacts(['email'], cursor_store=cursor_store))
+        requests = server.api.stats['requests']
+        second = list(hubspot.iter_recent_contacts(['email'], cursor_store=cursor_store))
+        second_requests = server.api.stats['requests'] - requests
+
+        fill(server, ['3@test.com', 'new@test.com'], timestamp=1000)
+        fill(server, ['7@test.com'], timestamp=2000)
+        third = list(hubspot.iter_recent_contacts(['email'], cursor_store=cursor_store))
+
+    assert len({c['vid'] for c in first}) == len(first) == 250
+    assert first[0]['properties'] == {'email': '249@test.com', 'lastmodifieddate': '1000'}
+    assert second == []
+    # every contact is within the overlap, so each page is read again but none is repeated
+    assert second_requests == 3
+    assert [c['properties']['email'] for c in third] == ['7@test.com', 'new@test.com']
+
+
+def test_async_iter_recent_contacts_uses_the_cache_backend():
+
+    async def changes(hubspot):
+        return [c['vid'] async for c in hubspot.iter_recent_contacts(['email'])]
+
+    with FakeHubSpotServer(max_calls=100, interval=1) as server:
+        hubspot = make_hubspot(AsyncHubSpot, cache_backend=SimpleCache())
+        point_at(hubspot, server.url)
+        fill(server, ['a@test.com', 'b@test.com'])
+        first = asyncio.run(changes(hubspot))
+        fill(server, ['c@test.com'])
+        second = asyncio.run(changes(hubspot))
+        hubspot.close()
+
+    assert sorted(first) == [1, 2]
+    assert second == [3]
+    assert hubspot.cache_backend.get('hubspot_recent_contacts_cursor')['timestamp']
+    # never expired, even by a cache whose default timeout is shorter than the time between runs
+    assert hubspot.cache_backend.timeouts['hubspot_recent_contacts_cursor'] is None
@@ -0,0 +1,188 @@
+import calendar
+import os
+import random
+import time
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from unittest.mock import patch
+
+import pytest
+
+from hubbypy.benchmarks.fake_hubspot import FakeHubSpotServer, point_at
+from hubbypy.hubbypy import encoders
+from hubbypy.hubbypy.contact_properties import AccessorProperty, UserPropertyManager
+from hubbypy.hubbypy.hub_api import HubSpot
+from hubbypy.hubbypy.encoders import (
+    EncoderRegistry,
+    date_to_unix,
+    datetime_to_unix,
+    default_registry,
+    encode_date_column,
+    encode_datetime_column
+)
+
+from . import helpers
+
+
+@pytest.fixture(params=['UTC', 'America/New_York', 'Australia/Lord_Howe'])
+def local_timezone(request):
+    original = os.environ.get('TZ')
+    os.environ['TZ'] = request.param
+    time.tzset()
+    yield request.param
+    if original is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = original
+    time.tzset()
+
+
+@pytest.fixture(params=[True, False], ids=['numpy', 'python'])
+def use_numpy(request):
+    numpy = encoders.numpy if request.param else None
+    if request.param and numpy is None:
+        pytest.skip('numpy is not installed')
+    with patch.object(encoders, 'numpy', numpy):
+        yield request.param
+
+
+def random_datetimes(count):
+    rng = random.Random(1)
+    start = datetime(1965, 1, 1)
+    return [start + timedelta(seconds=rng.randrange(0, 80 * 365 * 86400),
+                              microseconds=rng.randrange(0, 1000000))
+            for _ in range(count)]
+
+
+def test_datetime_to_unix_reads_naive_values_as_utc(local_timezone):
+
+    for value in random_datetimes(500) + [datetime(2018, 3, 11, 2, 30),
+                                          datetime(2018, 11, 4, 1, 30, 0, 999)]:
+        assert datetime_to_unix(value) == \
+            calendar.timegm(value.timetuple()) * 1000 + value.microsecond // 1000
+
+
+def test_datetime_to_unix_converts_aware_values_through_utc(local_timezone):
+
+    eastern = timezone(timedelta(hours=-5))
+
+    assert datetime_to_unix(datetime(2018, 1, 1, 7, tzinfo=eastern)) == \
+        datetime_to_unix(datetime(2018, 1, 1, 12, tzinfo=timezone.utc)) == \
+        datetime_to_unix(datetime(2018, 1, 1, 12)) == 1514808000000
+
+
+def test_date_to_unix_is_midnight_utc(local_timezone):
+
+    assert date_to_unix(date(1970, 1, 1)) == 0
+    assert date_to_unix(date(2018, 3, 11)) == 1520726400000
+    assert date_to_unix(date(1969, 12, 31)) == -86400000
+    assert datetime_to_unix(date(2018, 3, 11)) == date_to_unix(date(2018, 3, 11))
+
+
+def test_datetime_column_matches_scalar_encoding():
+
+    values = random_datetimes(2000) + [None, datetime(2018, 1, 1, tzinfo=timezone.utc)]
+    encoded = encode_datetime_column(values)
+
+    assert encoded == [datetime_to_unix(v) if v is not None else None for v in values]
+    assert all(type(v) is int for v in encoded[:-2])
+
+
+def test_date_column_matches_scalar_encoding(use_numpy):
+
+    values = [date(2018, 3, 11), datetime(2018, 3, 11, 23, 59), None, 'not a date',
+              date(1969, 12, 31)]
+    encoded = encode_date_column(values)
+
+    assert encoded == [
+        date_to_unix(date(2018, 3, 11)), date_to_unix(date(2018, 3, 11)), None, 'not a date',
+        date_to_unix(date(1969, 12, 31))
+    ]
+    assert type(encoded[0]) is int
+
+
+def test_registered_encoders_are_used_by_properties():
+
+    encoders = default_registry.copy()
+    encoders.register('number', lambda value: str(value) if type(value) is Decimal else value)
+
+    property_manager = UserPropertyManager(groups=[])
+    property_manager.add_prop(
+        AccessorProperty(name='some_org_balance', native_type='number', accessor='balance',
+                         encoders=encoders)
+    )
+    property_manager.add_prop(
+        AccessorProperty(name='some_org_plan', native_type='enumeration', accessor='plan',
+                         options=[], encoder=lambda plan: plan['id'])
+    )
+
+    class User:
+        email = 'test@test.com'
+        balance = Decimal('10.10')
+        plan = {'id': 'pro'}
+
+    expected = {
+        'properties': [
+            {'property': 'some_org_balance', 'value': '10.10'},
+            {'property': 'some_org_plan', 'value': 'pro'},
+        ]
+    }
+
+    assert property_manager.generate_sync_data(User()) == expected
+    assert property_manager.generate_bulk_sync_data([User()]) == [expected]
+    # the default registry is left alone
+    assert default_registry.encoder('number')(Decimal('1')) == Decimal('1')
+
+
+def test_custom_column_encoder():
+
+    encoders = EncoderRegistry()
+    encoders.register('varchar', str.upper, column=lambda values: ['column'] * len(values))
+    prop = AccessorProperty(name='some_org_name', native_type='varchar', accessor='name',
+                            encoders=encoders)
+
+    assert prop._compile_encoder()('a') == 'A'
+    assert prop._compile_column_encoder()(['a', None]) == ['column', 'column']
+
+
+def test_custom_native_type_syncs_end_to_end():
+
+    encoders = default_registry.copy()
+    encoders.register('money', lambda value: str(value.quantize(Decimal('0.01'))),
+                      hs_type='number')
+    property_manager = helpers.make_manager(
+        AccessorProperty(name='some_org_balance', label='Balance', group_name='some_org',
+                         native_type='money', accessor='balance', encoders=encoders),
+        groups=[{'name': 'some_org', 'displayName': 'Some Org'}])
+
+    class User:
+        email = 'test@test.com'
+        balance = Decimal('10.1')
+
+    with FakeHubSpotServer() as server:
+        with helpers.make_hubspot(HubSpot) as hubspot:
+            hubspot.user_property_manager = property_manager
+            point_at(hubspot, server.url)
+            report = hubspot.sync_schema()
+            hubspot.sync_user(User())
+
+    assert [r['success'] for r in report] == [True, True]
+    assert server.api.properties['some_org_balance']['type'] == 'number'
+    assert server.api.properties['some_org_balance']['fieldType'] == 'number'
+    assert server.api.contacts['test@test.com']['properties']['some_org_balance'] == '10.10'
+
+
+def test_custom_native_type_gets_the_field_type_of_its_hs_type():
+
+    encoders = default_registry.copy()
+    encoders.register('slug', lambda value: value.lower(), hs_type='string')
+    encoders.register('money', lambda value: str(value), hs_type='number')
+
+    slug, money = [
+        AccessorProperty(name='some_org_' + native_type, label='Label', group_name='some_org',
+                         native_type=native_type, accessor=native_type, encoders=encoders)
+        for native_type in ['slug', 'money']]
+
+    assert slug.get_dict()['type'] == 'string'
+    assert slug.get_dict()['fieldType'] == 'text'
+    assert money.get_dict()['fieldType'] == 'number'
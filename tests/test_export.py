@@ -0,0 +1,106 @@
+import asyncio
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+
+from hubbypy.benchmarks.fake_hubspot import FakeHubSpotServer, point_at
+from hubbypy.hubbypy.async_api import AsyncHubSpot
+from hubbypy.hubbypy.hub_api import HubSpot, read_ahead
+
+from .helpers import fill, make_hubspot
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_iter_contacts_pages_through_every_contact(prefetch):
+
+    with FakeHubSpotServer(max_calls=100, interval=1) as server, make_hubspot() as hubspot:
+        fill(server, ['%s@test.com' % i for i in range(250)], firstname='Jane',
+             notes='x' * 100)
+        point_at(hubspot, server.url)
+        contacts = hubspot.iter_contacts(['email', 'firstname'], prefetch=prefetch)
+        first = next(contacts)
+        requests_after_first = server.api.stats['requests']
+        rest = list(contacts)
+
+    # contacts are read lazily, at most a page ahead of the caller
+    assert requests_after_first <= (2 if prefetch else 1)
+    assert server.api.stats['requests'] == 3
+    assert first == {'vid': 1, 'properties': {'email': '0@test.com', 'firstname': 'Jane'}}
+    assert [c['vid'] for c in [first] + rest] == list(range(1, 251))
+
+
+def test_iter_contacts_raises_on_a_failed_page():
+
+    hubspot = make_hubspot()
+    page = Mock(status_code=200)
+    page.json.return_value = {'contacts': [{'vid': 1, 'properties': {}}],
+                              'has-more': True, 'vid-offset': 1}
+    failed = Mock(status_code=502)
+    failed.raise_for_status.side_effect = requests.HTTPError('502')
+
+    with patch.object(HubSpot, 'request', side_effect=[page, failed]) as request:
+        contacts = hubspot.iter_contacts(page_size=1, prefetch=True)
+        assert next(contacts) == {'vid': 1, 'properties': {}}
+        with pytest.raises(requests.HTTPError):
+            next(contacts)
+
+    assert request.call_args_list[1][1]['params']['vidOffset'] == 1
+
+
+def test_read_ahead_stops_when_the_caller_does():
+
+    produced = []
+
+    def numbers():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    items = read_ahead(numbers(), depth=2)
+    assert next(items) == 0
+    time.sleep(0.3)
+    # the item we hold, and two ready behind it
+    assert len(produced) == 3
+    items.close()
+    time.sleep(0.3)
+    assert len(produced) == 3
+
+
+def test_async_iter_contacts():
+
+    async def export(hubspot):
+        return [c async for c in hubspot.iter_contacts(['email'], page_size=40, prefetch=True)]
+
+    with FakeHubSpotServer(max_calls=100, interval=1) as server:
+        fill(server, ['%s@test.com' % i for i in range(100)], firstname='Jane',
+             notes='x' * 100)
+        hubspot = make_hubspot(AsyncHubSpot)
+        point_at(hubspot, server.url)
+        contacts = asyncio.run(export(hubspot))
+        hubspot.close()
+
+    assert len(contacts) == 100
+    assert contacts[-1] == {'vid': 100, 'properties': {'email': '99@test.com'}}
+
+
+def test_async_iter_contact_pages_cleans_up_when_the_caller_stops():
+
+    async def first_page(hubspot):
+        pages = hubspot.iter_contact_pages(['email'], page_size=10, prefetch=True)
+        page = await pages.__anext__()
+        await pages.aclose()
+        return page, asyncio.all_tasks() - {asyncio.current_task()}
+
+    with FakeHubSpotServer(max_calls=100, interval=1) as server:
+        fill(server, ['%s@test.com' % i for i in range(50)])
+        hubspot = make_hubspot(AsyncHubSpot)
+        point_at(hubspot, server.url)
+        page, pending = asyncio.run(first_page(hubspot))
+        hubspot.close()
+
+    assert len(page) == 10
+    # the read ahead of the second page has finished unwinding, rather than being left
+    # for garbage collection
+    assert not pending
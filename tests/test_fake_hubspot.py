@@ -0,0 +1,36 @@
+from unittest.mock import Mock
+
+from hubbypy.benchmarks.fake_hubspot import FakeHubSpotServer, point_at
+from hubbypy.hubbypy.contact_properties import AccessorProperty
+from hubbypy.hubbypy.hub_api import HubSpot
+from hubbypy.hubbypy.rate_limit import TokenBucket
+
+from . import helpers
+
+
+def make_manager():
+    return helpers.make_manager(
+        AccessorProperty(name='some_org_plan', label='Plan', group_name='some_org',
+                         native_type='varchar', accessor='plan'),
+        groups=[{'name': 'some_org', 'displayName': 'Some Org'}])
+
+
+def test_sync_against_fake_hubspot():
+
+    users = [Mock(email='%s@test.com' % i, plan='pro') for i in range(150)]
+    users.append(Mock(email='not an email', plan='pro'))
+
+    with FakeHubSpotServer(max_calls=5, interval=0.2) as server:
+        with HubSpot(api_key='testing', user_property_manager=make_manager(),
+                     rate_limiter=TokenBucket(max_calls=5, period=0.2)) as hubspot:
+            point_at(hubspot, server.url)
+            report = hubspot.sync_schema()
+            results = hubspot.sync_users(users)
+            second_report = hubspot.sync_schema()
+
+    assert [r['success'] for r in report] == [True, True]
+    assert second_report == []
+    assert [r['success'] for r in results] == [True] * 150 + [False]
+    assert results[-1]['error'] == 'Email address not an email is invalid'
+    assert len(server.api.contacts) == 150
+    assert server.api.contacts['7@test.com']['properties']['some_org_plan'] == 'pro'
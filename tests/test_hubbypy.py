@@ -1,16 +1,25 @@
+import calendar
+import itertools
+import json
 import pytest
 import time
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock, Mock, PropertyMock, patch
 
-from hubbypy.hubbypy.hub_api import HubSpot
+from hubbypy.hubbypy.hub_api import HubSpot, chunk_records
 from hubbypy.hubbypy.contact_properties import (
     AccessorProperty,
     BaseUserProperty,
+    AccessorTree,
     ConstantProperty,
     FunctionProperty,
     UserPropertyManager
 )
+from hubbypy.hubbypy.sent_state import MemorySentStateStore
+from hubbypy.hubbypy.rate_limit import TokenBucket
+
+from .helpers import SimpleCache, firstname_property, make_manager, unchanged_after_first
 
 hs_user_property_manager = UserPropertyManager(
     groups=[
@@ -22,18 +31,6 @@ hs_user_property_manager = UserPropertyManager(
 )
 
 
-class SimpleCache:
-
-    def __init__(self):
-        self._cache = {}
-
-    def set(self, key, value):
-        self._cache[key] = value
-
-    def get(self, key):
-        return self._cache.get(key)
-
-
 def test_bool_native_type_to_hs_type():
     active_user = BaseUserProperty(
         name='some_org_is_active',
@@ -195,7 +192,7 @@ def test_get_value_user_accessor_date():
         accessor='joined_date'
     )
 
-    expected = int(time.mktime(now.date().timetuple()) * 1000)
+    expected = calendar.timegm(now.date().timetuple()) * 1000
 
     assert active_user.get_formatted_value(user) == expected
 
@@ -214,7 +211,7 @@ def test_get_value_user_accessor_date_time():
         accessor='joined_date'
     )
 
-    expected = int(time.mktime(now.timetuple()) * 1e3 + now.microsecond / 1e3)
+    expected = calendar.timegm(now.timetuple()) * 1000 + now.microsecond // 1000
 
     assert active_user.get_formatted_value(user) == expected
 
@@ -287,8 +284,9 @@ def test_constant_property():
 
 def test_request_queing():
 
-    with patch('hubbypy.hubbypy.hub_api.HubSpot.client',
-               new_callable=PropertyMock) as mock_client:
+    with patch('hubbypy.hubbypy.hub_api.time.sleep', return_value=None), \
+            patch('hubbypy.hubbypy.hub_api.HubSpot.client',
+                  new_callable=PropertyMock) as mock_client:
 
         client = Mock()
         client.request = MagicMock(return_value=True)
@@ -306,7 +304,8 @@ def test_request_queing():
         test_hubspot.request('post', 'www.test.com')
         test_hubspot.request('post', 'www.test.com')
 
-        assert len(cache.get(test_hubspot.cache_key)) == 3
+        # one call went straight away and two more are queued behind it
+        assert test_hubspot.rate_limiter._level == pytest.approx(-2, abs=0.01)
         assert test_hubspot.client.request.called
 
 
@@ -329,13 +328,12 @@ def test_request_queing_sleeping():
                 cache_backend=cache
             )
 
-            cache.set(test_hubspot.cache_key, None)
-
             for _ in range(12):
                 test_hubspot.request('post', 'www.test.com')
 
-            assert len(cache.get(test_hubspot.cache_key)) == 12
-            assert sleeper.call_count == 4
+            # calls are spaced out, so all but the first wait for their slot
+            assert client.request.call_count == 12
+            assert sleeper.call_count == 11
 
 
 def test_old_requests_cleared_from_cache():
@@ -357,13 +355,772 @@ def test_old_requests_cleared_from_cache():
                 cache_backend=cache
             )
 
-            now = time.time()
-
-            old_time_stamps = [now - 11 for _ in range(11)]
+            for _ in range(8):
+                test_hubspot.request('post', 'www.test.com')
+            sleeps = sleeper.call_count
 
-            cache.set(test_hubspot.cache_key, old_time_stamps)
+            # pretend the calls were made more than a full period ago
+            test_hubspot.rate_limiter._updated -= 11
 
             test_hubspot.request('post', 'www.test.com')
 
-            assert len(cache.get(test_hubspot.cache_key)) == 1
-            assert sleeper.call_count == 0
+            assert sleeper.call_count == sleeps
+
+
+def test_client_session_is_reused():
+
+    test_hubspot = HubSpot(
+        api_key='testing',
+        user_property_manager=hs_user_property_manager,
+        cache_backend=SimpleCache(),
+        pool_size=25
+    )
+
+    session = test_hubspot.client
+
+    assert test_hubspot.client is session
+    assert session.params['hapikey'] == 'testing'
+    assert session.get_adapter('https://api.hubapi.com')._pool_maxsize == 25
+
+
+def test_close_discards_session():
+
+    with HubSpot(
+        api_key='testing',
+        user_property_manager=hs_user_property_manager,
+        cache_backend=SimpleCache()
+    ) as test_hubspot:
+        session = test_hubspot.client
+
+    assert test_hubspot._session is None
+    assert test_hubspot.client is not session
+
+
+def test_request_uses_default_timeout():
+
+    with patch('hubbypy.hubbypy.hub_api.time.sleep', return_value=None), \
+            patch('hubbypy.hubbypy.hub_api.HubSpot.client',
+                  new_callable=PropertyMock) as mock_client:
+
+        client = Mock()
+        client.request = MagicMock(return_value=True)
+        mock_client.return_value = client
+
+        test_hubspot = HubSpot(
+            api_key='testing',
+            user_property_manager=hs_user_property_manager,
+            cache_backend=SimpleCache(),
+            timeout=3
+        )
+
+        test_hubspot.request('get', 'www.test.com')
+        test_hubspot.request('get', 'www.test.com', timeout=60)
+
+        assert client.request.call_args_list[0][1]['timeout'] == 3
+        assert client.request.call_args_list[1][1]['timeout'] == 60
+
+
+def test_chunk_records_by_count_and_size():
+
+    records = [{'email': '%s@test.com' % i} for i in range(5)]
+
+    assert [len(c) for c in chunk_records(records, max_count=2)] == [2, 2, 1]
+
+    record_bytes = len(json.dumps(records[0]))
+    chunks = list(chunk_records(records, max_count=100, max_bytes=2 * record_bytes + 4))
+
+    assert [len(c) for c in chunks] == [2, 2, 1]
+    assert all(len(json.dumps(c)) <= 2 * record_bytes + 4 for c in chunks)
+
+
+def test_sync_users_reports_per_contact_results():
+
+    property_manager = UserPropertyManager(groups=[])
+    property_manager.add_prop(
+        AccessorProperty(name='email', native_type='varchar', accessor='email', built_in=True)
+    )
+
+    users = [Mock(email='%s@test.com' % i) for i in range(3)]
+
+    rejected = Mock(status_code=400)
+    rejected.json.return_value = {
+        'status': 'error',
+        'failureMessages': [{'index': 1, 'error': {'message': 'Email is invalid'}}]
+    }
+    accepted = Mock(status_code=202)
+
+    test_hubspot = HubSpot(
+        api_key='testing',
+        user_property_manager=property_manager,
+        cache_backend=SimpleCache()
+    )
+
+    with patch.object(HubSpot, 'request', side_effect=[rejected, accepted]) as request:
+        results = test_hubspot.sync_users(users)
+
+    assert [r['success'] for r in results] == [True, False, True]
+    assert results[1]['error'] == 'Email is invalid'
+    assert [c['email'] for c in request.call_args_list[1][1]['json']] == [
+        '0@test.com', '2@test.com']
+
+
+def test_rate_limit_headers_adjust_limiter():
+
+    with patch('hubbypy.hubbypy.hub_api.HubSpot.client',
+               new_callable=PropertyMock) as mock_client:
+
+        response = Mock(status_code=200, headers={
+            'X-HubSpot-RateLimit-Interval-Milliseconds': '10000',
+            'X-HubSpot-RateLimit-Max': '100',
+            'X-HubSpot-RateLimit-Remaining': '3',
+            'X-HubSpot-RateLimit-Daily-Remaining': '12345',
+        })
+        client = Mock()
+        client.request = MagicMock(return_value=response)
+        mock_client.return_value = client
+
+        test_hubspot = HubSpot(
+            api_key='testing',
+            user_property_manager=hs_user_property_manager,
+            rate_limiter=TokenBucket(burst=8)
+        )
+
+        test_hubspot.request('get', 'www.test.com')
+
+        assert test_hubspot.rate_limiter.max_calls == 100
+        assert test_hubspot.rate_limiter.period == 10
+        assert test_hubspot.rate_limiter._level == pytest.approx(3, abs=0.01)
+        assert test_hubspot.daily_remaining == 12345
+
+
+def test_throttled_request_is_retried_after_retry_after():
+
+    with patch('hubbypy.hubbypy.hub_api.time.sleep', return_value=None) as sleeper:
+
+        with patch('hubbypy.hubbypy.hub_api.HubSpot.client',
+                   new_callable=PropertyMock) as mock_client:
+
+            throttled = Mock(status_code=429, headers={'Retry-After': '2'})
+            ok = Mock(status_code=200, headers={})
+            client = Mock()
+            client.request = MagicMock(side_effect=[throttled, ok])
+            mock_client.return_value = client
+
+            test_hubspot = HubSpot(
+                api_key='testing',
+                user_property_manager=hs_user_property_manager
+            )
+
+            assert test_hubspot.request('get', 'www.test.com') is ok
+            # the retry waited in the limiter for at least the Retry-After
+            assert sleeper.call_args_list[-1][0][0] >= 2
+
+
+def test_server_errors_retried_until_max_retries():
+
+    with patch('hubbypy.hubbypy.hub_api.time.sleep', return_value=None) as sleeper:
+
+        with patch('hubbypy.hubbypy.hub_api.HubSpot.client',
+                   new_callable=PropertyMock) as mock_client:
+
+            failed = Mock(status_code=503, headers={})
+            client = Mock()
+            client.request = MagicMock(return_value=failed)
+            mock_client.return_value = client
+
+            test_hubspot = HubSpot(
+                api_key='testing',
+                user_property_manager=hs_user_property_manager,
+                max_retries=2
+            )
+
+            assert test_hubspot.request('get', 'www.test.com') is failed
+            assert client.request.call_count == 3
+            assert all(c[0][0] <= test_hubspot.backoff_cap for c in sleeper.call_args_list)
+
+
+def test_server_errors_only_retried_for_idempotent_requests():
+
+    with patch('hubbypy.hubbypy.hub_api.time.sleep', return_value=None):
+
+        with patch('hubbypy.hubbypy.hub_api.HubSpot.client',
+                   new_callable=PropertyMock) as mock_client:
+
+            failed = Mock(status_code=502, headers={})
+            throttled = Mock(status_code=429, headers={'Retry-After': '0'})
+            client = Mock()
+            client.request = MagicMock(return_value=failed)
+            mock_client.return_value = client
+
+            test_hubspot = HubSpot(
+                api_key='testing',
+                user_property_manager=hs_user_property_manager,
+                max_retries=2
+            )
+
+            # creating a company might have worked despite the 502
+            assert test_hubspot.request('post', 'www.test.com', json={}) is failed
+            assert client.request.call_count == 1
+
+            assert test_hubspot.request('post', 'www.test.com', json={},
+                                        idempotent=True) is failed
+            assert client.request.call_count == 4
+
+            client.request = MagicMock(side_effect=[throttled, failed])
+            assert test_hubspot.request('post', 'www.test.com', json={}) is failed
+            assert client.request.call_count == 2
+
+
+def test_generate_sync_data_matches_formatted_values():
+
+    property_manager = UserPropertyManager(groups=[])
+    properties = [
+        AccessorProperty(name='email', native_type='varchar', accessor='email',
+                         built_in=True),
+        AccessorProperty(name='some_org_joined', native_type='date', accessor='joined'),
+        AccessorProperty(name='some_org_login', native_type='datetime', accessor='login'),
+        AccessorProperty(name='some_org_missing', native_type='varchar',
+                         accessor='company.missing.name'),
+        FunctionProperty(name='some_org_active', native_type='bool',
+                         func=lambda user: user.is_active, send_user=True),
+        ConstantProperty(name='some_org_constant', native_type='bool', value=False),
+    ]
+    for prop in properties:
+        property_manager.add_prop(prop)
+
+    user = Mock(spec=['email', 'joined', 'login', 'is_active', 'company'])
+    user.email = 'test@test.com'
+    user.joined = datetime(2018, 3, 4, 15, 30)
+    user.login = datetime(2018, 3, 4, 15, 30, 1, 500)
+    user.is_active = True
+    user.company = Mock(spec=[])
+
+    assert property_manager.generate_sync_data(user) == {
+        'properties': [
+            {'property': p.name, 'value': p.get_formatted_value(user)} for p in properties
+        ]
+    }
+
+
+def test_sync_plan_rebuilt_when_property_added():
+
+    property_manager = UserPropertyManager(groups=[])
+    property_manager.add_prop(
+        ConstantProperty(name='some_org_constant', native_type='varchar', value='a')
+    )
+
+    assert len(property_manager.generate_sync_data(Mock())['properties']) == 1
+
+    property_manager.add_prop(
+        ConstantProperty(name='some_org_other', native_type='varchar', value='b')
+    )
+
+    assert [p['value'] for p in property_manager.generate_sync_data(Mock())['properties']] == [
+        'a', 'b']
+
+
+def test_constant_property_encoded_once():
+
+    encode = Mock(return_value=1)
+    property_manager = UserPropertyManager(groups=[])
+    property_manager.add_prop(
+        ConstantProperty(name='some_org_launch', native_type='datetime',
+                         value=datetime(2018, 1, 1), encoder=encode)
+    )
+
+    for _ in range(3):
+        property_manager.generate_sync_data(Mock())
+
+    assert encode.call_count == 1
+
+
+def test_shared_accessor_prefixes_resolved_once():
+
+    lookups = []
+
+    class Company:
+
+        name = 'Test Account'
+
+        @property
+        def subscription(self):
+            lookups.append('subscription')
+            return Mock(plan_id='gold', status='active')
+
+    class User:
+
+        email = 'test@test.com'
+
+        @property
+        def company(self):
+            lookups.append('company')
+            return Company()
+
+    property_manager = UserPropertyManager(groups=[])
+    for accessor in ['company.name', 'company.subscription.plan_id',
+                     'company.subscription.status']:
+        property_manager.add_prop(
+            AccessorProperty(name=accessor.replace('.', '_'), native_type='varchar',
+                             accessor=accessor)
+        )
+
+    data = property_manager.generate_sync_data(User())
+
+    assert [p['value'] for p in data['properties']] == ['Test Account', 'gold', 'active']
+    assert lookups == ['company', 'subscription']
+
+
+def test_failed_accessor_prefix_skips_dependent_properties():
+
+    class User:
+
+        email = 'test@test.com'
+        is_active = True
+
+        @property
+        def company(self):
+            raise ValueError('no company')
+
+    property_manager = UserPropertyManager(groups=[])
+    property_manager.add_prop(
+        AccessorProperty(name='some_org_active', native_type='bool', accessor='is_active')
+    )
+    for accessor in ['company.name', 'company.subscription.status']:
+        property_manager.add_prop(
+            AccessorProperty(name=accessor.replace('.', '_'), native_type='varchar',
+                             accessor=accessor)
+        )
+
+    data = property_manager.generate_sync_data(User())
+
+    assert [p['value'] for p in data['properties']] == ['true', None, None]
+
+
+def test_null_accessor_prefix_gives_none_for_dependent_properties():
+
+    class Company:
+
+        name = 'Acme'
+        plan = None
+
+    class User:
+
+        email = 'test@test.com'
+
+    property_manager = UserPropertyManager(groups=[])
+    for accessor in ['company.name', 'company.plan.name', 'company.plan.price']:
+        property_manager.add_prop(
+            AccessorProperty(name=accessor.replace('.', '_'), native_type='varchar',
+                             accessor=accessor)
+        )
+
+    user = User()
+    user.company = None
+    tree = AccessorTree(['company.name', 'company.plan.name'])
+
+    assert tree.resolve(user) == {'company.name': None, 'company.plan.name': None}
+    assert [p['value'] for p in property_manager.generate_sync_data(user)['properties']] == \
+        [None, None, None]
+
+    user.company = Company()
+
+    assert tree.resolve(user) == {'company.name': 'Acme', 'company.plan.name': None}
+    assert property_manager.generate_bulk_sync_data([user]) == \
+        [property_manager.generate_sync_data(user)]
+
+
+def test_sync_user_only_sends_changed_properties():
+
+    property_manager = UserPropertyManager(groups=[])
+    property_manager.add_prop(
+        AccessorProperty(name='firstname', native_type='varchar', accessor='first_name',
+                         built_in=True)
+    )
+    property_manager.add_prop(
+        AccessorProperty(name='lastname', native_type='varchar', accessor='last_name',
+                         built_in=True)
+    )
+
+    user = Mock(email='test@test.com', first_name='Jane', last_name='Doe')
+
+    test_hubspot = HubSpot(
+        api_key='testing',
+        user_property_manager=property_manager,
+        sent_state_store=MemorySentStateStore()
+    )
+
+    with patch.object(HubSpot, 'request',
+                      return_value=Mock(status_code=200)) as request:
+        test_hubspot.sync_user(user)
+        assert test_hubspot.sync_user(user) is None
+
+        user.last_name = 'Smith'
+        test_hubspot.sync_user(user)
+
+    assert request.call_count == 2
+    assert request.call_args_list[1][1]['json'] == {
+        'properties': [{'property': 'lastname', 'value': 'Smith'}]
+    }
+
+
+def test_sync_users_skips_unchanged_contacts():
+
+    property_manager = UserPropertyManager(groups=[])
+    property_manager.add_prop(
+        AccessorProperty(name='firstname', native_type='varchar', accessor='first_name',
+                         built_in=True)
+    )
+
+    users = [Mock(email='%s@test.com' % i, first_name='Jane') for i in range(3)]
+
+    test_hubspot = HubSpot(
+        api_key='testing',
+        user_property_manager=property_manager,
+        sent_state_store=MemorySentStateStore()
+    )
+
+    with patch.object(HubSpot, 'request', return_value=Mock(status_code=202)) as request:
+        test_hubspot.sync_users(users[:2])
+        users[1].first_name = 'Joan'
+        results = test_hubspot.sync_users(users)
+
+    assert [r['skipped'] for r in results] == [True, False, False]
+    assert [r['email'] for r in results] == [u.email for u in users]
+    assert [c['email'] for c in request.call_args_list[1][1]['json']] == [
+        '1@test.com', '2@test.com']
+
+
+def test_run_scoped_function_property_evaluated_once_per_run():
+
+    now = MagicMock(return_value='now')
+    stripe_plan = MagicMock(side_effect=lambda user: user.email + ' plan')
+
+    property_manager = UserPropertyManager(groups=[])
+    property_manager.add_prop(
+        FunctionProperty(name='some_org_last_sync', native_type='varchar', func=now,
+                         scope='run')
+    )
+    property_manager.add_prop(
+        FunctionProperty(name='some_org_plan', native_type='varchar', func=stripe_plan,
+                         send_user=True, scope='run', key=lambda user: user.email)
+    )
+
+    users = [Mock(email='a@test.com'), Mock(email='b@test.com'), Mock(email='a@test.com')]
+
+    run = {}
+    payloads = [property_manager.generate_sync_data(user, run=run) for user in users]
+
+    assert now.call_count == 1
+    assert stripe_plan.call_count == 2
+    assert payloads[2]['properties'][1]['value'] == 'a@test.com plan'
+
+    property_manager.generate_sync_data(users[0])
+
+    assert now.call_count == 2
+
+
+def test_ttl_scoped_function_property_cached_per_user():
+
+    func = MagicMock(side_effect=lambda user: user.email)
+
+    prop = FunctionProperty(name='some_org_plan', native_type='varchar', func=func,
+                            send_user=True, scope='ttl', ttl=60, max_size=1,
+                            key=lambda user: user.email)
+
+    first, second = Mock(email='a@test.com'), Mock(email='b@test.com')
+
+    assert prop.get_formatted_value(first) == 'a@test.com'
+    assert prop.get_formatted_value(first) == 'a@test.com'
+    assert func.call_count == 1
+
+    prop.get_formatted_value(second)
+    prop.get_formatted_value(first)
+
+    # max_size of 1 evicted the first user's value
+    assert func.call_count == 3
+
+
+def test_function_property_scope_validated():
+
+    with pytest.raises(ValueError):
+        FunctionProperty(name='some_org_plan', native_type='varchar', func=len,
+                         scope='forever')
+
+    with pytest.raises(ValueError):
+        FunctionProperty(name='some_org_plan', native_type='varchar', func=len, scope='ttl')
+
+
+def test_bulk_sync_data_matches_per_user_sync_data():
+
+    property_manager = UserPropertyManager(groups=[])
+    property_manager.add_prop(
+        AccessorProperty(name='email', native_type='varchar', accessor='email',
+                         built_in=True)
+    )
+    property_manager.add_prop(
+        AccessorProperty(name='some_org_joined', native_type='date', accessor='joined')
+    )
+    property_manager.add_prop(
+        AccessorProperty(name='some_org_login', native_type='datetime', accessor='login')
+    )
+    property_manager.add_prop(
+        FunctionProperty(name='some_org_active', native_type='bool',
+                         func=lambda user: user.is_active, send_user=True)
+    )
+    property_manager.add_prop(
+        FunctionProperty(name='some_org_sync', native_type='varchar',
+                         func=MagicMock(return_value='once'), scope='run')
+    )
+
+    users = []
+    for i in range(50):
+        user = Mock(spec=['email', 'joined', 'login', 'is_active'])
+        user.email = '%s@test.com' % i
+        user.joined = date(2018, 1, 1 + i % 28)
+        user.login = datetime(2018, 6, 1, 12, 30, 1, 1234) + i * timedelta(hours=7)
+        user.is_active = bool(i % 2)
+        if i % 5 == 0:
+            del user.login
+        users.append(user)
+
+    run = {}
+    expected = [property_manager.generate_sync_data(user, run=run) for user in users]
+
+    assert json.dumps(property_manager.generate_bulk_sync_data(users, run={})) == \
+        json.dumps(expected)
+
+
+def test_sync_stream_yields_results_in_order():
+
+    property_manager = UserPropertyManager(groups=[])
+    property_manager.add_prop(
+        AccessorProperty(name='firstname', native_type='varchar', accessor='first_name',
+                         built_in=True)
+    )
+
+    users = [Mock(email='%s@test.com' % i, first_name='Jane') for i in range(250)]
+
+    sent_state_store = MemorySentStateStore()
+    test_hubspot = HubSpot(
+        api_key='testing',
+        user_property_manager=property_manager,
+        sent_state_store=sent_state_store
+    )
+
+    with patch.object(HubSpot, 'request', return_value=Mock(status_code=202)) as request:
+        test_hubspot.sync_users(users[::3])
+        results = list(test_hubspot.sync_stream(users, batch_size=40))
+
+    assert [r['email'] for r in results] == [u.email for u in users]
+    assert [r['skipped'] for r in results] == [i % 3 == 0 for i in range(250)]
+    assert all(r['success'] for r in results)
+    assert sum(len(c[1]['json']) for c in request.call_args_list[1:]) == 166
+
+
+def test_sync_stream_consumes_users_lazily():
+
+    property_manager = UserPropertyManager(groups=[])
+    property_manager.add_prop(
+        AccessorProperty(name='email', native_type='varchar', accessor='email', built_in=True)
+    )
+
+    pulled = []
+
+    def endless_users():
+        for i in itertools.count():
+            pulled.append(i)
+            yield Mock(email='%s@test.com' % i)
+
+    test_hubspot = HubSpot(
+        api_key='testing',
+        user_property_manager=property_manager
+    )
+
+    with patch.object(HubSpot, 'request', return_value=Mock(status_code=202)):
+        stream = test_hubspot.sync_stream(endless_users(), batch_size=10, max_pending=1)
+        results = list(itertools.islice(stream, 25))
+        stream.close()
+
+    assert len(results) == 25
+    assert len(pulled) < 100
+
+
+def test_sync_stream_sends_a_partial_chunk_behind_unchanged_users():
+
+    sent_state_store = MemorySentStateStore()
+    pulled = []
+    test_hubspot = HubSpot(api_key='testing', user_property_manager=make_manager(
+        firstname_property()), sent_state_store=sent_state_store)
+
+    with patch.object(HubSpot, 'request', return_value=Mock(status_code=202)) as request:
+        stream = test_hubspot.sync_stream(unchanged_after_first(sent_state_store, pulled),
+                                          batch_size=10, max_pending=1)
+        first = next(stream)
+        stream.close()
+
+    assert first['email'] == '0@test.com' and not first['skipped']
+    assert request.call_count == 1
+    assert len(pulled) < 100
+
+
+def test_sync_stream_keeps_only_shared_run_values():
+
+    now = MagicMock(return_value='now')
+    property_manager = UserPropertyManager(groups=[])
+    property_manager.add_prop(
+        AccessorProperty(name='email', native_type='varchar', accessor='email', built_in=True)
+    )
+    property_manager.add_prop(
+        FunctionProperty(name='some_org_last_sync', native_type='varchar', func=now,
+                         scope='run')
+    )
+    property_manager.add_prop(
+        FunctionProperty(name='some_org_plan', native_type='varchar', func=lambda u: 'pro',
+                         send_user=True, scope='run')
+    )
+    build = property_manager.generate_bulk_sync_data
+    run_sizes = []
+
+    def generate_bulk_sync_data(users, run=None, sent_states=None):
+        run_sizes.append(len(run))
+        return build(users, run=run, sent_states=sent_states)
+
+    test_hubspot = HubSpot(api_key='testing', user_property_manager=property_manager)
+    users = [Mock(email='%s@test.com' % i, pk=i) for i in range(100)]
+
+    with patch.object(HubSpot, 'request', return_value=Mock(status_code=202)), \
+            patch.object(property_manager, 'generate_bulk_sync_data',
+                         side_effect=generate_bulk_sync_data):
+        results = list(test_hubspot.sync_stream(users, batch_size=10))
+
+    assert len(results) == 100
+    assert now.call_count == 1
+    assert run_sizes == [0] + [1] * 9
+
+
+def test_io_bound_properties_evaluated_concurrently():
+
+    def slow(value):
+        def func(user):
+            time.sleep(0.2)
+            return value
+        return func
+
+    property_manager = UserPropertyManager(groups=[], executor=ThreadPoolExecutor(8))
+    property_manager.add_prop(
+        AccessorProperty(name='email', native_type='varchar', accessor='email', built_in=True)
+    )
+    for i in range(4):
+        property_manager.add_prop(
+            FunctionProperty(name='some_org_remote_%s' % i, native_type='varchar',
+                             func=slow(str(i)), send_user=True, io_bound=True)
+        )
+
+    users = [Mock(email='%s@test.com' % i) for i in range(3)]
+
+    started = time.time()
+    single = property_manager.generate_sync_data(users[0])
+    bulk = property_manager.generate_bulk_sync_data(users)
+    elapsed = time.time() - started
+
+    assert [p['value'] for p in single['properties']] == ['0@test.com', '0', '1', '2', '3']
+    assert bulk[2]['properties'][0]['value'] == '2@test.com'
+    assert [p['value'] for p in bulk[2]['properties'][1:]] == ['0', '1', '2', '3']
+    # serially this would take 16 x 0.2 seconds
+    assert elapsed < 1.2
+
+
+def test_io_bound_property_errors_propagate():
+
+    def fail(user):
+        raise ValueError('service is down')
+
+    property_manager = UserPropertyManager(groups=[], executor=ThreadPoolExecutor(2))
+    property_manager.add_prop(
+        FunctionProperty(name='some_org_remote', native_type='varchar', func=fail,
+                         send_user=True, io_bound=True)
+    )
+
+    with pytest.raises(ValueError):
+        property_manager.generate_sync_data(Mock())
+
+
+def test_io_bound_accessor_failure_yields_none():
+
+    property_manager = UserPropertyManager(groups=[], executor=ThreadPoolExecutor(2))
+    property_manager.add_prop(
+        AccessorProperty(name='email', native_type='varchar', accessor='email',
+                         built_in=True, io_bound=True)
+    )
+    property_manager.add_prop(
+        AccessorProperty(name='some_org_company', native_type='varchar',
+                         accessor='company.name', io_bound=True)
+    )
+
+    data = property_manager.generate_sync_data(Mock(spec=['email'], email='a@test.com'))
+
+    assert [p['value'] for p in data['properties']] == ['a@test.com', None]
+
+
+def test_profiling_ranks_properties_by_cost():
+
+    def slow(user):
+        time.sleep(0.01)
+        return 'slow'
+
+    def broken(user):
+        raise RuntimeError('no value')
+
+    property_manager = UserPropertyManager(groups=[], profile=True)
+    property_manager.add_prop(
+        AccessorProperty(name='email', native_type='varchar', accessor='email', built_in=True)
+    )
+    property_manager.add_prop(
+        AccessorProperty(name='some_org_company', native_type='varchar',
+                         accessor='company.name')
+    )
+    property_manager.add_prop(
+        FunctionProperty(name='some_org_slow', native_type='varchar', func=slow,
+                         send_user=True)
+    )
+
+    users = [Mock(spec=['email', 'company'], email='%s@test.com' % i) for i in range(4)]
+    for user in users[:3]:
+        user.company.name = 'Test Account'
+    del users[3].company
+
+    expected = [
+        {'properties': [{'property': 'email', 'value': user.email},
+                        {'property': 'some_org_company',
+                         'value': 'Test Account' if i < 3 else None},
+                        {'property': 'some_org_slow', 'value': 'slow'}]}
+        for i, user in enumerate(users)
+    ]
+    assert [property_manager.generate_sync_data(user) for user in users[:2]] == expected[:2]
+    assert property_manager.generate_bulk_sync_data(users[2:]) == expected[2:]
+
+    report = property_manager.profile_report()
+    assert [r['name'] for r in report][0] == 'some_org_slow'
+    by_name = {r['name']: r for r in report}
+    assert by_name['some_org_slow']['calls'] == 4
+    assert by_name['some_org_slow']['total_seconds'] >= 0.04
+    assert by_name['some_org_company']['nones'] == 1
+    assert by_name['some_org_company']['none_rate'] == 0.25
+    assert by_name['email']['kind'] == 'AccessorProperty'
+    assert abs(sum(r['share'] for r in report) - 1) < 1e-9
+    assert 'some_org_slow' in property_manager.profile_report(text=True)
+
+    property_manager.add_prop(
+        FunctionProperty(name='some_org_broken', native_type='varchar', func=broken,
+                         send_user=True)
+    )
+    with pytest.raises(RuntimeError):
+        property_manager.generate_sync_data(users[0])
+    assert {r['name']: r for r in property_manager.profile_report()}['some_org_broken'][
+        'errors'] == 1
+    # timings survive the plan being rebuilt
+    assert len(property_manager.profile_report(limit=2)) == 2
+
+    property_manager.disable_profiling()
+    with pytest.raises(ValueError):
+        property_manager.profile_report()
@@ -0,0 +1,83 @@
+import json
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+
+from hubbypy.hubbypy.contact_properties import UserPropertyManager
+from hubbypy.hubbypy.hub_api import HubSpot
+from hubbypy.hubbypy.json_codec import (
+    JSONCodec,
+    OrjsonCodec,
+    UjsonCodec,
+    default_codec,
+    orjson,
+    ujson
+)
+
+CODECS = [JSONCodec,
+          pytest.param(OrjsonCodec, marks=pytest.mark.skipif(orjson is None,
+                                                               reason='orjson is not installed')),
+          pytest.param(UjsonCodec, marks=pytest.mark.skipif(ujson is None,
+                                                              reason='ujson is not installed'))]
+
+
+@pytest.mark.parametrize('codec_class', CODECS)
+def test_codecs_encode_to_bytes(codec_class):
+
+    codec = codec_class()
+    payload = [{'email': 'zoë@test.com', 'properties': [{'property': 'n', 'value': 1.5}]}]
+
+    encoded = codec.dumps(payload)
+    assert isinstance(encoded, bytes)
+    assert json.loads(encoded) == payload
+    assert codec.loads(encoded) == payload
+
+
+def test_default_codec_prefers_the_fastest():
+
+    expected = 'orjson' if orjson is not None else 'ujson' if ujson is not None else 'json'
+    assert default_codec().name == expected
+    with patch('hubbypy.hubbypy.json_codec.orjson', None), \
+            patch('hubbypy.hubbypy.json_codec.ujson', None):
+        assert default_codec().name == 'json'
+
+
+def test_request_encodes_with_the_codec_and_parses_once():
+
+    codec = Mock(wraps=JSONCodec())
+    test_hubspot = HubSpot(api_key='testing', user_property_manager=UserPropertyManager(groups=[]),
+                           codec=codec)
+    response = requests.Response()
+    response.status_code = 200
+    response._content = b'[{"name": "some_org_plan"}]'
+
+    with patch('hubbypy.hubbypy.hub_api.HubSpot.client') as client:
+        client.request.return_value = response
+        response = test_hubspot.request('post', 'https://api.hubapi.com/x', json={'a': 1})
+
+    assert client.request.call_args[1]['data'] == b'{"a":1}'
+    assert 'json' not in client.request.call_args[1]
+    assert response.json() is response.json()
+    assert response.json() == [{'name': 'some_org_plan'}]
+    assert codec.loads.call_count == 1
+
+
+@pytest.mark.parametrize('codec_class', CODECS)
+def test_malformed_body_raises_requests_json_error(codec_class):
+
+    test_hubspot = HubSpot(api_key='testing', user_property_manager=UserPropertyManager(groups=[]),
+                           codec=codec_class())
+    response = requests.Response()
+    response.status_code = 200
+    response._content = b'{"results": [1, 2'
+
+    with patch('hubbypy.hubbypy.hub_api.HubSpot.client') as client:
+        client.request.return_value = response
+        response = test_hubspot.request('get', 'https://api.hubapi.com/x')
+
+    with pytest.raises(requests.exceptions.JSONDecodeError):
+        response.json()
+    # callers that catch ValueError, as before the codec, still do
+    with pytest.raises(ValueError):
+        response.json()
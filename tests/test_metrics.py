@@ -0,0 +1,82 @@
+import socket
+from unittest.mock import MagicMock, Mock, PropertyMock, patch
+
+from hubbypy.hubbypy.hub_api import CONTACTS_URL, PROPERTIES_URL, HubSpot
+from hubbypy.hubbypy.metrics import MetricsCollector, StatsdMetrics, endpoint_name
+from hubbypy.hubbypy.rate_limit import TokenBucket
+
+from .helpers import make_manager
+
+
+def test_endpoint_name_hides_ids():
+
+    assert endpoint_name(CONTACTS_URL + '/createOrUpdate/email/jane@test.com/') == \
+        '/contacts/v1/contact/createOrUpdate/email/{email}'
+    assert endpoint_name(CONTACTS_URL + '/vid/1234/profile?hapikey=secret') == \
+        '/contacts/v1/contact/vid/{vid}/profile'
+    assert endpoint_name(PROPERTIES_URL + '/named/some_org_plan') == \
+        '/properties/v1/contacts/properties/named/{name}'
+
+
+def test_collector_records_requests_retries_and_waits():
+
+    throttled = Mock(status_code=429, headers={}, content=b'{}',
+                     request=Mock(body=b'{"properties": []}'))
+    ok = Mock(status_code=200, headers={}, content=b'{"vid": 1}',
+              request=Mock(body=b'{"properties": []}'))
+    client = Mock()
+    client.request = MagicMock(side_effect=[throttled, ok])
+    metrics = MetricsCollector()
+
+    with patch('hubbypy.hubbypy.hub_api.time.sleep', return_value=None), \
+            patch('hubbypy.hubbypy.hub_api.HubSpot.client',
+                  new_callable=PropertyMock, return_value=client):
+
+        test_hubspot = HubSpot(api_key='testing', user_property_manager=make_manager(),
+                               rate_limiter=TokenBucket(max_calls=1, period=1),
+                               metrics=metrics)
+        test_hubspot.sync_user(Mock(email='jane@test.com'))
+
+    endpoint = '/contacts/v1/contact/createOrUpdate/email/{email}'
+    snapshot = metrics.snapshot()
+    assert snapshot['requests'] == [
+        {'method': 'POST', 'endpoint': endpoint, 'status_code': '200', 'count': 1},
+        {'method': 'POST', 'endpoint': endpoint, 'status_code': '429', 'count': 1},
+    ]
+    assert snapshot['retries'] == [
+        {'method': 'POST', 'endpoint': endpoint, 'status_code': '429', 'count': 1}]
+    assert snapshot['latency'][0]['count'] == 2
+    assert snapshot['bytes_sent'] == 36
+    assert snapshot['bytes_received'] == 12
+    # the retry had to wait for the limiter to refill after the 429
+    assert snapshot['rate_limit_waits'] == 1
+    assert snapshot['rate_limit_wait_seconds'] > 0
+    assert snapshot['payloads'] == 1
+
+    exposition = metrics.prometheus()
+    assert ('hubbypy_requests_total{method="POST",endpoint="%s",status="429"} 1' % endpoint
+            in exposition)
+    assert ('hubbypy_request_duration_seconds_bucket{method="POST",endpoint="%s",le="+Inf"} 2'
+            % endpoint in exposition)
+    assert '# TYPE hubbypy_request_duration_seconds histogram' in exposition
+
+
+def test_statsd_metrics_sends_udp_packets():
+
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(5)
+    metrics = StatsdMetrics(port=receiver.getsockname()[1])
+
+    metrics.http_request(method='post', endpoint='/contacts/v1/contact/batch',
+                         status_code=202, duration=0.25, bytes_sent=100, bytes_received=0)
+    packet = receiver.recv(4096).decode('utf-8').splitlines()
+    metrics.close()
+    receiver.close()
+
+    assert packet == [
+        'hubbypy.request.post.contacts.v1.contact.batch.202:1|c',
+        'hubbypy.post.contacts.v1.contact.batch.duration:250.000|ms',
+        'hubbypy.post.contacts.v1.contact.batch.bytes_sent:100|c',
+        'hubbypy.post.contacts.v1.contact.batch.bytes_received:0|c',
+    ]
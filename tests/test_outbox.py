@@ -0,0 +1,188 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from unittest.mock import Mock, patch
+
+import pytest
+
+from hubbypy.hubbypy.async_api import AsyncHubSpot
+from hubbypy.hubbypy.hub_api import HubSpot
+from hubbypy.hubbypy.outbox import SQLiteOutbox, run_outbox_worker
+from hubbypy.hubbypy.sent_state import MemorySentStateStore
+
+from .helpers import firstname_property, make_manager
+
+
+def test_outbox_coalesces_by_email_and_survives_restarts():
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'outbox.sqlite3')
+        outbox = SQLiteOutbox(path=path)
+
+        outbox.enqueue('a@test.com', [{'property': 'firstname', 'value': 'Jane'},
+                                      {'property': 'lastname', 'value': 'Doe'}])
+        outbox.enqueue('b@test.com', [{'property': 'firstname', 'value': 'Bob'}])
+        outbox.enqueue('a@test.com', [{'property': 'firstname', 'value': 'Janet'}])
+
+        reopened = SQLiteOutbox(path=path)
+        assert len(reopened) == 2
+        entries = reopened.claim(limit=10)
+
+    assert [e.email for e in entries] == ['a@test.com', 'b@test.com']
+    assert entries[0].properties == [{'property': 'firstname', 'value': 'Janet'},
+                                     {'property': 'lastname', 'value': 'Doe'}]
+    assert entries[0].version == 2
+
+
+def test_outbox_claims_acks_and_releases():
+
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = SQLiteOutbox(path=os.path.join(directory, 'outbox.sqlite3'), max_attempts=2)
+        outbox.enqueue('a@test.com', [{'property': 'firstname', 'value': 'Jane'}])
+        outbox.enqueue('b@test.com', [{'property': 'firstname', 'value': 'Bob'}])
+
+        a, b = outbox.claim(limit=10)
+        # claimed entries are leased to their worker
+        assert outbox.claim(limit=10) == []
+
+        # a changed while it was being sent, so acking the old version keeps the new one
+        outbox.enqueue('a@test.com', [{'property': 'firstname', 'value': 'Janet'}])
+        outbox.ack(a)
+        outbox.release(b, 'boom')
+        a, b = outbox.claim(limit=10)
+        assert a.properties == [{'property': 'firstname', 'value': 'Janet'}]
+        assert b.attempts == 1
+
+        outbox.ack(a)
+        outbox.release(b, 'boom again')
+        assert outbox.claim(limit=10) == []
+        assert outbox.failed() == [('b@test.com', 2, 'boom again')]
+        assert len(outbox) == 1
+
+
+def test_drain_outbox_sends_batches_and_retries_failures():
+
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = SQLiteOutbox(path=os.path.join(directory, 'outbox.sqlite3'))
+        sent_state_store = MemorySentStateStore()
+        test_hubspot = HubSpot(api_key='testing',
+                               user_property_manager=make_manager(firstname_property()),
+                               outbox=outbox, sent_state_store=sent_state_store)
+
+        for i in range(5):
+            for name in ('Jane', 'Janet'):
+                test_hubspot.enqueue_user(Mock(email='%s@test.com' % i, first_name=name))
+
+        def batch(contacts):
+            return [test_hubspot._batch_result(c, 202 if c['email'] != '3@test.com' else 400,
+                                               None if c['email'] != '3@test.com' else 'bad')
+                    for c in contacts]
+
+        with patch.object(HubSpot, 'batch_create_or_update_contacts',
+                          side_effect=batch) as send:
+            results = test_hubspot.drain_outbox(batch_size=2)
+
+            assert send.call_count == 3
+            assert [len(c[0][0]) for c in send.call_args_list] == [2, 2, 1]
+            assert send.call_args_list[0][0][0][0]['properties'] == [
+                {'property': 'email', 'value': '0@test.com'},
+                {'property': 'firstname', 'value': 'Janet'}]
+            assert [r['success'] for r in results] == [True, True, True, False, True]
+            assert len(outbox) == 1
+
+            # only the failure is left, and it is retried once its delay has passed
+            assert test_hubspot.drain_outbox() == []
+            with patch('hubbypy.hubbypy.outbox.time.time', return_value=time.time() + 61):
+                test_hubspot.drain_outbox()
+            assert send.call_args_list[-1][0][0] == [
+                {'email': '3@test.com', 'properties': [
+                    {'property': 'email', 'value': '3@test.com'},
+                    {'property': 'firstname', 'value': 'Janet'}]}]
+
+            # unchanged contacts are acked without being sent
+            test_hubspot.enqueue_user(Mock(email='0@test.com', first_name='Janet'))
+            results = test_hubspot.drain_outbox()
+
+        assert send.call_count == 4
+        assert results[0]['skipped']
+
+
+def test_outbox_worker_drains_until_stopped():
+
+    hubspot = Mock()
+    stop = threading.Event()
+    calls = []
+
+    def drain(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 3:
+            stop.set()
+        return []
+
+    hubspot.drain_outbox.side_effect = drain
+    run_outbox_worker(hubspot, batch_size=50, poll_interval=0.01, stop=stop)
+
+    assert calls == [{'batch_size': 50, 'max_batches': 1}] * 3
+
+
+def test_drain_outbox_sends_only_changed_properties():
+
+    with tempfile.TemporaryDirectory() as directory:
+        sent_state_store = MemorySentStateStore()
+        test_hubspot = HubSpot(api_key='testing',
+                               user_property_manager=make_manager(firstname_property()),
+                               outbox=SQLiteOutbox(path=os.path.join(directory, 'o.sqlite3')),
+                               sent_state_store=sent_state_store)
+        test_hubspot._remember_sent('a@test.com', [{'property': 'email', 'value': 'a@test.com'},
+                                                   {'property': 'firstname', 'value': 'Jane'}])
+        test_hubspot.enqueue_user(Mock(email='a@test.com', first_name='Janet'))
+
+        def batch(contacts):
+            return [test_hubspot._batch_result(c, 202) for c in contacts]
+
+        with patch.object(HubSpot, 'batch_create_or_update_contacts',
+                          side_effect=batch) as send:
+            test_hubspot.drain_outbox()
+
+    assert send.call_args[0][0] == [
+        {'email': 'a@test.com', 'properties': [{'property': 'firstname', 'value': 'Janet'}]}]
+
+
+def test_async_drain_outbox():
+
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = SQLiteOutbox(path=os.path.join(directory, 'outbox.sqlite3'))
+        test_hubspot = AsyncHubSpot(api_key='testing',
+                                    user_property_manager=make_manager(firstname_property()),
+                                    outbox=outbox)
+        enqueued_in = []
+        enqueue = outbox.enqueue
+
+        def record_thread(*args):
+            enqueued_in.append(threading.current_thread())
+            enqueue(*args)
+
+        async def batch(contacts):
+            return [test_hubspot._batch_result(c, 202) for c in contacts]
+
+        async def enqueue_and_drain():
+            for i in range(3):
+                await test_hubspot.enqueue_user(Mock(email='%s@test.com' % i,
+                                                     first_name='Jane'))
+            return await test_hubspot.drain_outbox(batch_size=2)
+
+        with patch.object(outbox, 'enqueue', side_effect=record_thread), \
+                patch.object(AsyncHubSpot, 'batch_create_or_update_contacts',
+                             side_effect=batch) as send:
+            results = asyncio.run(enqueue_and_drain())
+
+        # the outbox is only used from the thread pool
+        assert threading.main_thread() not in enqueued_in
+        assert send.call_count == 2
+        assert [r['email'] for r in results] == ['0@test.com', '1@test.com', '2@test.com']
+        assert len(outbox) == 0
+
+    with pytest.raises(TypeError):
+        run_outbox_worker(test_hubspot)
@@ -0,0 +1,301 @@
+import os
+import tempfile
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from hubbypy.hubbypy.hub_api import HubSpot
+from hubbypy.hubbypy.rate_limit import (
+    CacheRateLimiter,
+    SQLiteTokenBucket,
+    TokenBucket,
+    backoff_delay,
+    parse_rate_limit_headers,
+    parse_retry_after
+)
+
+
+def test_token_bucket_allows_burst_then_paces():
+
+    bucket = TokenBucket(max_calls=4, period=2, burst=2)
+
+    with patch.object(TokenBucket, '_now', return_value=100.0):
+        waits = [bucket.reserve() for _ in range(5)]
+
+    # the burst of 2 leaves room for 3 refills in any 2 seconds
+    assert waits[:2] == [0, 0]
+    assert waits[2:] == [pytest.approx(2 / 3), pytest.approx(4 / 3), pytest.approx(2)]
+
+
+@pytest.mark.parametrize('burst', [1, 4, 8])
+def test_token_bucket_keeps_every_window_within_budget(burst):
+
+    bucket = TokenBucket(max_calls=8, period=10, burst=burst)
+
+    with patch.object(TokenBucket, '_now', return_value=0.0):
+        calls = [bucket.reserve() for _ in range(40)]
+
+    for start in calls:
+        assert len([call for call in calls if start <= call < start + 10]) <= 8
+
+
+def test_token_bucket_refills_up_to_capacity():
+
+    bucket = TokenBucket(max_calls=4, period=2, burst=4)
+
+    with patch.object(TokenBucket, '_now', return_value=100.0):
+        for _ in range(4):
+            bucket.reserve()
+
+    with patch.object(TokenBucket, '_now', return_value=200.0):
+        waits = [bucket.reserve() for _ in range(5)]
+
+    assert waits[:4] == [0, 0, 0, 0]
+    assert waits[4] > 0
+
+
+def test_sqlite_token_bucket_is_shared_between_workers():
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'limiter.sqlite3')
+        waits = []
+
+        def worker():
+            # each worker has its own bucket object and connection, like separate processes
+            bucket = SQLiteTokenBucket(path=path, max_calls=10, period=1000)
+            for _ in range(5):
+                waits.append(bucket.reserve())
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert len(waits) == 40
+    assert len([w for w in waits if w == 0]) == 1
+    # every other reservation waits for its own refill slot
+    assert sorted(w for w in waits if w)[-1] == pytest.approx(39 * 100, rel=0.01)
+
+
+def test_sqlite_token_bucket_shares_the_adopted_budget():
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'limiter.sqlite3')
+        first = SQLiteTokenBucket(path=path)
+        second = SQLiteTokenBucket(path=path)
+
+        with patch.object(SQLiteTokenBucket, '_now', return_value=100.0):
+            first.update(max_calls=100, period=10, remaining=100)
+        # the second process never saw HubSpot's headers, but paces calls by the new budget
+        with patch.object(SQLiteTokenBucket, '_now', return_value=200.0):
+            waits = [second.reserve() for _ in range(20)]
+
+    assert waits == [pytest.approx(i * 0.1) for i in range(20)]
+    assert second.max_calls == 100
+
+
+class AtomicCache:
+    """
+    The parts of Django's cache API that `CacheRateLimiter` needs. Keys expire by the
+    clock in `now`, and `incr` leaves the expiry alone, as Django's backends do.
+    """
+
+    def __init__(self):
+        self.now = 0
+        self.gets = 0
+        self.incrs = 0
+        self.touches = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        if key in self._cache and self._cache[key][1] <= self.now:
+            del self._cache[key]
+        return key in self._cache
+
+    def get(self, key):
+        with self._lock:
+            self.gets += 1
+            return self._cache[key][0] if self._live(key) else None
+
+    def set(self, key, value, timeout=None):
+        self._cache[key] = (value, self.now + timeout if timeout is not None else float('inf'))
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self._live(key):
+                return False
+            self.set(key, value, timeout)
+            return True
+
+    def incr(self, key, delta=1):
+        with self._lock:
+            if not self._live(key):
+                raise ValueError('Key %r not found' % key)
+            self.incrs += 1
+            value, expires = self._cache[key]
+            self._cache[key] = (value + delta, expires)
+            return value + delta
+
+    def touch(self, key, timeout=None):
+        with self._lock:
+            if not self._live(key):
+                return False
+            self.touches += 1
+            self.set(key, self._cache[key][0], timeout)
+            return True
+
+
+def test_cache_rate_limiter_is_shared_between_workers():
+
+    cache = AtomicCache()
+    cache.now = 101.0
+    workers = [CacheRateLimiter(cache, max_calls=4, period=2) for _ in range(2)]
+
+    with patch.object(CacheRateLimiter, '_now', side_effect=lambda: cache.now):
+        waits = [workers[i % 2].reserve() for i in range(10)]
+
+    # one slot every half second, whichever worker asks
+    assert waits == [pytest.approx(i * 0.5) for i in range(10)]
+
+    with patch.object(CacheRateLimiter, '_now', side_effect=lambda: cache.now):
+        workers[0].pause(10)
+        assert workers[1].reserve() == pytest.approx(10)
+
+
+def test_cache_rate_limiter_keeps_a_backlog_within_budget():
+
+    cache = AtomicCache()
+    limiter = CacheRateLimiter(cache, max_calls=8, period=10)
+    calls = []
+
+    with patch.object(CacheRateLimiter, '_now', side_effect=lambda: cache.now):
+        calls.extend(limiter.reserve() for _ in range(60))
+        # the queue reaches 75 seconds out, long after the first slots were handed out
+        cache.now = 30.0
+        incrs = cache.incrs
+        calls.extend(30 + limiter.reserve() for _ in range(16))
+        # a reservation at the back of the queue costs one incr, like one at the front
+        assert cache.incrs - incrs == 16
+
+        # once the queue has drained, idle time does not turn into a burst
+        cache.now = 200.0
+        assert [limiter.reserve() for _ in range(3)] == [0, 1.25, 2.5]
+
+    assert len(set(calls)) == 76
+    for start in calls:
+        assert len([call for call in calls if start <= call < start + 10]) <= 8
+    assert max(calls) == pytest.approx(75 * 1.25)
+
+
+def test_cache_rate_limiter_reserves_in_one_round_trip():
+
+    cache = AtomicCache()
+    limiter = CacheRateLimiter(cache, max_calls=100, period=10)
+
+    with patch.object(CacheRateLimiter, '_now', side_effect=lambda: cache.now):
+        waits = [limiter.reserve() for _ in range(100)]
+        limiter.update(max_calls=100, period=10, remaining=50)
+
+    assert waits == [pytest.approx(i * 0.1) for i in range(100)]
+    # the budget is read once, and the expiry is only moved every few seconds of slots
+    assert cache.gets == 1
+    assert cache.incrs == 100
+    assert cache.touches <= 5
+
+
+def test_cache_rate_limiter_shares_the_adopted_budget():
+
+    cache = AtomicCache()
+    first = CacheRateLimiter(cache)
+    second = CacheRateLimiter(cache)
+
+    with patch.object(CacheRateLimiter, '_now', side_effect=lambda: cache.now):
+        first.update(max_calls=100, period=10, remaining=100)
+        # the second process never saw HubSpot's headers, but spaces calls by the new budget
+        waits = [second.reserve() for _ in range(20)]
+
+    assert waits == [pytest.approx(i * 0.1) for i in range(20)]
+    assert second.max_calls == 100
+
+
+def test_cache_rate_limiter_waits_out_a_spent_window():
+
+    cache = AtomicCache()
+    first = CacheRateLimiter(cache, max_calls=10, period=10)
+    second = CacheRateLimiter(cache, max_calls=10, period=10)
+
+    with patch.object(CacheRateLimiter, '_now', side_effect=lambda: cache.now):
+        # calls already made in HubSpot's window are not charged a second time
+        first.update(remaining=2)
+        assert [second.reserve() for _ in range(2)] == [0, pytest.approx(1)]
+
+        cache.now = 2.0
+        first.update(remaining=0)
+        # nothing is left and we don't know when the window started, so wait a full period
+        assert second.reserve() == pytest.approx(10)
+
+        cache.now = 12.0
+        first.update(remaining=9)
+        cache.now = 15.0
+        first.update(remaining=0)
+        # more calls were left at 12 than before, so that window ends at 22
+        assert second.reserve() == pytest.approx(7)
+
+
+def test_cache_rate_limiter_leaves_the_old_call_list_alone():
+
+    cache = AtomicCache()
+    # what older versions keep under the key: the times of recent calls
+    cache.set('hub_api_calls', [95.0, 96.5], 10)
+    limiter = CacheRateLimiter(cache, key='hub_api_calls', max_calls=4, period=2)
+
+    with patch.object(CacheRateLimiter, '_now', side_effect=lambda: cache.now):
+        waits = [limiter.reserve() for _ in range(3)]
+
+    assert waits == [0, pytest.approx(0.5), pytest.approx(1)]
+    assert cache.get('hub_api_calls') == [95.0, 96.5]
+
+
+def test_hubspot_rate_limits_through_an_atomic_cache_backend():
+
+    cache = AtomicCache()
+    hubspot = HubSpot(api_key='key', user_property_manager=None, cache_backend=cache)
+
+    assert isinstance(hubspot.rate_limiter, CacheRateLimiter)
+    assert hubspot.rate_limiter.key == HubSpot.cache_key
+
+    hubspot = HubSpot(api_key='key', user_property_manager=None, cache_backend=object())
+
+    assert isinstance(hubspot.rate_limiter, TokenBucket)
+
+
+def test_parse_rate_limit_headers():
+
+    limits = parse_rate_limit_headers({
+        'X-HubSpot-RateLimit-Interval-Milliseconds': '10000',
+        'X-HubSpot-RateLimit-Max': '100',
+        'X-HubSpot-RateLimit-Remaining': '0',
+    })
+
+    assert limits == {'max_calls': 100, 'period': 10, 'remaining': 0,
+                      'daily_remaining': None}
+
+
+def test_backoff_delay_respects_retry_after_and_cap():
+
+    assert all(0 <= backoff_delay(10, base=0.5, cap=4) <= 4 for _ in range(50))
+    assert all(3 <= backoff_delay(0, base=0.5, retry_after=3) <= 3.5 for _ in range(50))
+    assert parse_retry_after({'Retry-After': '7'}) == 7
+    assert parse_retry_after({}) is None
+
+
+def test_pause_holds_back_next_reservation():
+
+    bucket = TokenBucket(max_calls=10, period=1)
+
+    with patch.object(TokenBucket, '_now', return_value=100.0):
+        bucket.pause(3)
+        assert bucket.reserve() == pytest.approx(3)
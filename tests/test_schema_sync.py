@@ -0,0 +1,183 @@
+import json
+import threading
+import time
+from unittest.mock import Mock, patch
+
+from hubbypy.hubbypy.contact_properties import (
+    AccessorProperty,
+    ConstantProperty,
+    EnumerationOption
+)
+from hubbypy.hubbypy.hub_api import HubSpot
+from hubbypy.hubbypy.schema_sync import (
+    SchemaOperation,
+    matches,
+    plan_group_operations,
+    plan_property_operations,
+    schema_phases
+)
+
+from . import helpers
+
+
+def remote_version(prop_dict, **changes):
+    """
+    What HubSpot sends back for a property we created from `prop_dict`.
+    """
+    remote = dict(prop_dict, description='', formField=False, displayOrder=-1,
+                  readOnlyValue=False, hidden=False)
+    if 'options' in remote:
+        remote['options'] = [dict(o, readOnly=False, doubleData=None)
+                             for o in reversed(remote['options'])]
+    remote.update(changes)
+    return remote
+
+
+def make_manager():
+    return helpers.make_manager(
+        AccessorProperty(name='some_org_active', label='Active', group_name='some_org',
+                         native_type='bool', accessor='is_active'),
+        AccessorProperty(name='some_org_plan', label='Plan', group_name='some_org',
+                         native_type='varchar', accessor='company.plan'),
+        ConstantProperty(name='some_org_source', label='Source', group_name='some_org',
+                         native_type='varchar', value='app'),
+        groups=[{'name': 'some_org', 'displayName': 'Some Org'}])
+
+
+def test_matches_ignores_fields_hubspot_adds():
+
+    prop_dict = make_manager().custom_user_properties[0].get_dict()
+
+    assert matches(prop_dict, remote_version(prop_dict))
+    assert not matches(prop_dict, remote_version(prop_dict, label='Is Active'))
+
+
+def test_plan_property_operations_only_includes_changes():
+
+    prop_dicts = [p.get_dict() for p in make_manager().custom_user_properties]
+    remote = [
+        remote_version(prop_dicts[0]),
+        remote_version(prop_dicts[1], label='Old Label'),
+        remote_version(dict(prop_dicts[1], name='some_org_retired')),
+        remote_version(dict(prop_dicts[1], name='other_org_plan', groupName='other_org')),
+    ]
+
+    operations = plan_property_operations(prop_dicts, remote, ['some_org'])
+
+    assert [(o.action, o.name) for o in operations] == [
+        ('update_property', 'some_org_plan'),
+        ('create_property', 'some_org_source'),
+        ('delete_property', 'some_org_retired'),
+    ]
+    assert 'name' not in operations[0].data
+
+
+def test_unchanged_enumeration_property_needs_no_operations():
+
+    prop = AccessorProperty(
+        name='some_org_tier', label='Tier', group_name='some_org', native_type='enumeration',
+        accessor='company.tier',
+        options=[EnumerationOption(value='free', label='Free', display_order=1),
+                 EnumerationOption(value='paid', label='Paid', display_order=2)])
+    prop_dict = prop.get_dict()
+    # HubSpot always reports a type, and picks a field type for enumerations we leave blank
+    remote = [remote_version(prop_dict, type='enumeration', fieldType='select')]
+
+    assert prop_dict['type'] == 'enumeration'
+    assert plan_property_operations([prop_dict], remote, ['some_org']) == []
+
+
+def test_plan_group_operations():
+
+    operations = plan_group_operations(
+        [{'name': 'a', 'displayName': 'A'}, {'name': 'b', 'displayName': 'B'},
+         {'name': 'c', 'displayName': 'C'}],
+        [{'name': 'a', 'displayName': 'A', 'displayOrder': 1},
+         {'name': 'b', 'displayName': 'Bee', 'displayOrder': 2}]
+    )
+
+    assert operations == [
+        SchemaOperation('update_group', 'b', {'displayName': 'B'}),
+        SchemaOperation('create_group', 'c', {'name': 'c', 'displayName': 'C'}),
+    ]
+
+
+def test_sync_contact_properties_sends_only_needed_calls():
+
+    property_manager = make_manager()
+    prop_dicts = [p.get_dict() for p in property_manager.custom_user_properties]
+    remote = Mock(status_code=200)
+    remote.json.return_value = [remote_version(d) for d in prop_dicts[:2]]
+
+    test_hubspot = HubSpot(api_key='testing', user_property_manager=property_manager)
+
+    with patch.object(HubSpot, 'request', return_value=remote) as request:
+        planned = test_hubspot.sync_contact_properties(dry_run=True)
+
+    assert request.call_count == 1
+    assert [r['operation'].action for r in planned] == ['create_property']
+    assert [r['success'] for r in planned] == [None]
+
+    with patch.object(HubSpot, 'request', return_value=remote) as request:
+        test_hubspot.sync_contact_properties()
+
+    assert request.call_count == 2
+    assert request.call_args_list[1][0][0] == 'post'
+    assert remote.json.call_count == 2
+
+
+def test_schema_phases_order_dependent_operations():
+
+    operations = [
+        SchemaOperation('delete_property', 'old', None),
+        SchemaOperation('create_property', 'x', {'name': 'x', 'groupName': 'new'}),
+        SchemaOperation('create_property', 'y', {'name': 'y', 'groupName': 'existing'}),
+        SchemaOperation('create_group', 'new', {'name': 'new'}),
+        SchemaOperation('update_group', 'existing', {'displayName': 'E'}),
+    ]
+
+    phases = schema_phases(operations)
+
+    assert [[o.name for o in phase] for phase in phases] == [
+        ['y', 'new', 'existing'],
+        ['x'],
+        ['old'],
+    ]
+
+
+def test_apply_schema_operations_runs_concurrently_and_reports():
+
+    operations = [
+        SchemaOperation('create_group', 'new', {'name': 'new'}),
+        SchemaOperation('create_property', 'a', {'name': 'a', 'groupName': 'new'}),
+        SchemaOperation('create_property', 'b', {'name': 'b', 'groupName': 'new'}),
+        SchemaOperation('delete_property', 'old', None),
+    ]
+    sent = []
+    lock = threading.Lock()
+    both_running = threading.Barrier(2, timeout=5)
+
+    def request(method, url, **kwargs):
+        name = json.loads(kwargs['data'])['name'] if 'data' in kwargs else url.rsplit('/', 1)[-1]
+        with lock:
+            sent.append(name)
+        if name in ('a', 'b'):
+            # a and b only get past here if they are sent at the same time
+            both_running.wait()
+        time.sleep(0.01)
+        if method == 'delete':
+            return Mock(status_code=404, json=Mock(return_value={'message': 'not found'}))
+        return Mock(status_code=200)
+
+    test_hubspot = HubSpot(api_key='testing', user_property_manager=make_manager())
+    with patch.object(HubSpot, 'request', side_effect=request):
+        report = test_hubspot.apply_schema_operations(operations, max_workers=2)
+
+    assert sent[0] == 'new'
+    assert sorted(sent[1:3]) == ['a', 'b']
+    assert sent[3] == 'old'
+    assert [r['operation'].name for r in report] == ['new', 'a', 'b', 'old']
+    assert [r['success'] for r in report] == [True, True, True, False]
+    assert report[3]['status_code'] == 404
+    assert report[3]['error'] == 'not found'
+    assert all(r['duration'] >= 0.01 for r in report)
@@ -0,0 +1,48 @@
+import os
+import tempfile
+
+from hubbypy.hubbypy.sent_state import (
+    MemorySentStateStore,
+    SQLiteSentStateStore,
+    digest_properties,
+    digest_value
+)
+
+
+def test_digest_value_is_stable_and_distinguishes_values():
+
+    assert digest_value('a') == digest_value('a')
+    assert digest_value('1') != digest_value(1)
+    assert digest_value(None) != digest_value('')
+    assert digest_properties([{'property': 'x', 'value': 1}]) == {'x': digest_value(1)}
+
+
+def test_memory_store_merges_and_evicts_least_recently_used():
+
+    store = MemorySentStateStore(max_size=2)
+
+    store.update('a@test.com', {'x': '1'})
+    store.update('a@test.com', {'y': '2'})
+    store.update('b@test.com', {'x': '1'})
+    store.get('a@test.com')
+    store.update('c@test.com', {'x': '1'})
+
+    assert store.get('a@test.com') == {'x': '1', 'y': '2'}
+    assert store.get('b@test.com') is None
+    assert store.get('c@test.com') == {'x': '1'}
+
+
+def test_sqlite_store_persists_between_instances():
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'sent.sqlite3')
+
+        SQLiteSentStateStore(path=path).update('a@test.com', {'x': '1', 'y': '2'})
+        store = SQLiteSentStateStore(path=path)
+        store.update('a@test.com', {'y': '3'})
+
+        assert store.get('a@test.com') == {'x': '1', 'y': '3'}
+
+        store.delete('a@test.com')
+
+        assert store.get('a@test.com') is None
@@ -0,0 +1,60 @@
+import os
+import sqlite3
+import tempfile
+import threading
+
+import pytest
+
+from hubbypy.hubbypy.storage import LRUCache, SQLiteDatabase
+
+
+def test_lru_cache_evicts_least_recently_used_and_expired_entries():
+
+    cache = LRUCache(max_size=2, expired=lambda value: value < 0)
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set_many([('c', 3), ('d', -1)])
+
+    assert cache.get('a') is None
+    assert cache.get('b') is None
+    assert cache.get('d', 'gone') == 'gone'
+    assert len(cache) == 1
+
+    cache.update_value('c', lambda value: value + 1)
+    cache.update_value('e', lambda value: value or 10)
+
+    assert (cache.get('c'), cache.get('e')) == (4, 10)
+
+
+def test_sqlite_database_rolls_back_and_closes_every_thread():
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = SQLiteDatabase(os.path.join(tmp_dir, 'test.sqlite3'))
+        db.connection().execute('CREATE TABLE items (name TEXT)')
+
+        def fail(connection):
+            connection.execute("INSERT INTO items VALUES ('a')")
+            raise ValueError('failed')
+
+        with pytest.raises(ValueError):
+            db.transaction(fail)
+        thread = threading.Thread(
+            target=db.transaction,
+            args=(lambda connection: connection.execute("INSERT INTO items VALUES ('b')"),))
+        thread.start()
+        thread.join()
+
+        assert db.connection().execute('SELECT name FROM items').fetchall() == [('b',)]
+
+        connections = list(db._connections.values())
+        db.close()
+
+        assert len(connections) == 2
+        for connection in connections:
+            with pytest.raises(sqlite3.ProgrammingError):
+                connection.execute('SELECT 1')
+        # a thread that carries on gets a new connection
+        assert db.connection().execute('SELECT COUNT(*) FROM items').fetchone() == (1,)
+        db.close()
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import time
+from unittest.mock import Mock, patch
+
+from hubbypy.benchmarks.fake_hubspot import FakeHubSpotServer, point_at
+from hubbypy.hubbypy.hub_api import CONTACT_BY_VID_URL, CONTACTS_URL, HubSpot
+from hubbypy.hubbypy.rate_limit import TokenBucket
+from hubbypy.hubbypy.vid_index import MemoryVidIndex, SQLiteVidIndex
+
+from .helpers import firstname_property, make_manager
+
+
+def test_memory_vid_index_evicts_and_expires():
+
+    vid_index = MemoryVidIndex(max_size=2, ttl=60)
+    vid_index.set_many([('A@test.com ', 1), ('b@test.com', 2)])
+    assert vid_index.get('a@test.com') == 1
+    vid_index.set('c@test.com', 3)
+
+    # b was the least recently used
+    assert vid_index.get('b@test.com') is None
+    assert vid_index.get('a@TEST.com') == 1
+    with patch('hubbypy.hubbypy.vid_index.time.time', return_value=time.time() + 61):
+        assert vid_index.get('c@test.com') is None
+
+
+def test_sqlite_vid_index_survives_restarts():
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'vids.sqlite3')
+        SQLiteVidIndex(path=path).set_many([('a@test.com', 1), ('b@test.com', 2)])
+        SQLiteVidIndex(path=path).delete('b@test.com')
+
+        vid_index = SQLiteVidIndex(path=path, max_size=1, ttl=60)
+        assert vid_index.get('a@test.com') == 1
+        assert vid_index.get('b@test.com') is None
+        assert len(vid_index) == 1
+        with patch('hubbypy.hubbypy.vid_index.time.time', return_value=time.time() + 61):
+            assert SQLiteVidIndex(path=path, ttl=60).get('a@test.com') is None
+
+
+def test_sync_user_writes_by_vid_and_falls_back_to_email():
+
+    vid_index = MemoryVidIndex()
+    test_hubspot = HubSpot(api_key='testing',
+                           user_property_manager=make_manager(firstname_property()),
+                           vid_index=vid_index)
+    user = Mock(email='jane@test.com', first_name='Jane')
+
+    created = Mock(status_code=200)
+    created.json.return_value = {'vid': 51, 'isNew': True}
+    updated = Mock(status_code=204)
+    with patch.object(HubSpot, 'request', side_effect=[created, updated]) as request:
+        assert test_hubspot.sync_user(user) == {'vid': 51, 'isNew': True}
+        assert test_hubspot.sync_user(user) == {'vid': 51, 'isNew': False}
+
+    assert request.call_args_list[1][0] == ('post', CONTACT_BY_VID_URL.format(51))
+
+    # the contact was merged away, so its vid is gone
+    missing = Mock(status_code=404)
+    created.json.return_value = {'vid': 77, 'isNew': False}
+    with patch.object(HubSpot, 'request', side_effect=[missing, created]) as request:
+        assert test_hubspot.sync_user(user) == {'vid': 77, 'isNew': False}
+
+    assert request.call_args_list[1][0] == (
+        'post', CONTACTS_URL + '/createOrUpdate/email/jane@test.com')
+    assert vid_index.get('jane@test.com') == 77
+
+
+def test_export_fills_the_index_for_batch_writes_by_vid():
+
+    users = [Mock(email='%s@test.com' % i, first_name='Jane') for i in range(10)]
+
+    with FakeHubSpotServer(max_calls=100, interval=1) as server, \
+            HubSpot(api_key='testing', user_property_manager=make_manager(firstname_property()),
+                    rate_limiter=TokenBucket(max_calls=100, period=1),
+                    vid_index=MemoryVidIndex()) as hubspot:
+        point_at(hubspot, server.url)
+        hubspot.sync_users(users)
+        list(hubspot.iter_contacts(['firstname']))
+        assert len(hubspot.vid_index) == 10
+
+        # a contact deleted in HubSpot fails by vid, and is recreated by email next time
+        del server.api.contacts['3@test.com']
+        first = hubspot.sync_users(users)
+        second = hubspot.sync_users(users)
+
+    assert [r['success'] for r in first] == [True] * 3 + [False] + [True] * 6
+    assert first[3]['error'] == 'Contact 4 does not exist'
+    assert all(r['success'] for r in second)
+    assert server.api.contacts['3@test.com']['vid'] == 11
+
+
+def test_create_or_update_user_falls_back_to_email_when_the_indexed_vid_is_stale():
+
+    vid_index = MemoryVidIndex()
+    vid_index.set('jane@test.com', 51)
+    test_hubspot = HubSpot(api_key='testing',
+                           user_property_manager=make_manager(firstname_property()),
+                           vid_index=vid_index)
+    user = Mock(spec=['email'], email='jane@test.com')
+
+    missing = Mock(status_code=404)
+    created = Mock(status_code=200)
+    created.json.return_value = {'vid': 77, 'isNew': False}
+    with patch.object(HubSpot, 'request', side_effect=[missing, created]) as request:
+        assert test_hubspot.create_or_update_user(user, {'properties': []}) == {
+            'vid': 77, 'isNew': False}
+
+    assert [c[0] for c in request.call_args_list] == [
+        ('post', CONTACT_BY_VID_URL.format(51)),
+        ('post', CONTACTS_URL + '/createOrUpdate/email/jane@test.com')]
+    assert vid_index.get('jane@test.com') == 77